@@ -28,19 +28,3727 @@
 __author__ = 'jordan.bouvier@analytemedia.com (Jordan Bouvier)'
 
 
-from urllib import urlencode
+from urllib import quote_plus, urlencode
+import Queue
+import array
+import bisect
+import collections
+import datetime
+import errno
+import functools
+import hashlib
+import heapq
+import httplib
+import itertools
+import logging
+import os
+import random
 import re
+import select
+import socket
+import struct
+import sys
+import threading
+import time
 import urllib2
+import urlparse
+import zlib
 
-try:
-    from google.appengine.api import urlfetch
-    APPENGINE = True
-except:
-    APPENGINE = False
 
+logger = logging.getLogger(__name__)
 
 
-class PaymentProcessor(object):
+class Transport(object):
+    """How a Gateway gets its post data to the gateway and the answer back.
+    
+    Subclass it and override request() to plug in another HTTP client,
+    then hand an instance to a gateway or processor:
+    >>> p.transport = MyTransport()
+    
+    PyAuthorize ships ConnectionPool, which keeps connections alive with
+    httplib, UrllibTransport and AppEngineTransport. A transport is shared
+    by every gateway using it, so request() must be thread-safe.
+    """
+    
+    def request(self, url, data, timeout=None):
+        """POST data to url and return the response body.
+        
+        Args:
+            url: The URL to post to.
+            data: The encoded form data.
+            timeout: Optional seconds the request may take.
+        
+        Raises:
+            urllib2.HTTPError if the server doesn't answer with a 200.
+            socket.timeout if the request takes longer than timeout.
+            socket.error, httplib.HTTPException or urllib2.URLError on
+            connection failures.
+        """
+        
+        raise NotImplementedError
+    
+    def warm(self, url, connections=1, timeout=None):
+        """Connect to url ahead of the first request.
+        
+        Transports that keep connections open resolve the host and open,
+        and for HTTPS handshake, up to connections connections to it.
+        
+        Returns:
+            The number of connections opened.
+        """
+        
+        return 0
+    
+    def close(self):
+        """Release any connections the transport holds on to."""
+
+
+class UrllibTransport(Transport):
+    """Transport opening a new connection with urllib2 for every request.
+    
+    Requests go through opener, or urllib2.urlopen() and the globally
+    installed opener if there is none. The timeout applies to each socket
+    operation rather than to the whole request.
+    """
+    
+    def __init__(self, opener=None):
+        self.opener = opener
+    
+    def request(self, url, data, timeout=None):
+        request = urllib2.Request(url=url, data=data)
+        if self.opener is None:
+            open_url = urllib2.urlopen
+        else:
+            open_url = self.opener.open
+        
+        if timeout is None:
+            response = open_url(request)
+        else:
+            response = open_url(request, timeout=timeout)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+
+class AppEngineTransport(Transport):
+    """Transport posting with Google App Engine's urlfetch service.
+    
+    Requests without a timeout get a deadline of default_deadline seconds.
+    
+    Raises:
+        ImportError outside of App Engine.
+    """
+    
+    def __init__(self, default_deadline=10):
+        from google.appengine.api import urlfetch
+        self.urlfetch = urlfetch
+        self.default_deadline = default_deadline
+    
+    def request(self, url, data, timeout=None):
+        response = self.urlfetch.fetch(url=url, method=self.urlfetch.POST,
+                payload=data, deadline=timeout or self.default_deadline)
+        if response.status_code != 200:
+            raise urllib2.HTTPError(url, response.status_code,
+                    'HTTP status %d' % response.status_code,
+                    response.headers, None)
+        return response.content
+
+
+class ConnectionPool(Transport):
+    """Thread-safe pool of persistent HTTP(S) connections.
+    
+    Idle connections are kept per (scheme, host, port) and reused by later
+    requests to the same gateway so that a transaction doesn't pay for a
+    fresh TCP connect and TLS handshake every time:
+    >>> pool = ConnectionPool(maxsize=4, idle_timeout=30)
+    >>> body = pool.request('https://secure.authorize.net/gateway/'
+    ...         'transact.dll', 'x_login=abcdef&...')
+    
+    At most maxsize idle connections are kept for each host; connections
+    idle for longer than idle_timeout seconds are closed instead of being
+    reused. A kept-alive connection the server has already dropped is
+    replaced by a new one transparently, but only while the request
+    provably hasn't reached the gateway: when the idle connection is found
+    closed before sending, or writing the request to it fails. A failure
+    after the request went out is raised, as resending a charge could
+    charge the card twice; a RetryPolicy decides whether that is safe.
+    warm() opens connections before the first request needs them.
+    
+    The timeout of a request is a deadline for the whole request: the
+    connect, sending the data and reading the response share it.
+    
+    The stats dictionary counts pool hits (reused connections), new
+    connections, evictions and reconnects after a stale connection.
+    
+    Once close() has been called, the pool still serves requests but
+    closes their connections instead of keeping them.
+    """
+    
+    def __init__(self, maxsize=10, idle_timeout=60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.stats = {
+                'hits' : 0,
+                'connections' : 0,
+                'evictions' : 0,
+                'reconnects' : 0,
+        }
+        self._idle = {}
+        self._closed = False
+        self._lock = threading.Lock()
+    
+    def request(self, url, data, timeout=None):
+        """POST data to url and return the response body.
+        
+        Args:
+            url: The URL to post to.
+            data: The encoded form data.
+            timeout: Optional seconds the whole request may take.
+        
+        Raises:
+            urllib2.HTTPError if the server doesn't answer with a 200.
+            socket.timeout if the request takes longer than timeout.
+            socket.error or httplib.HTTPException on connection failures.
+        """
+        
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        
+        connection, is_reused = self._get(key, timeout)
+        if is_reused and _is_closed(connection):
+            # The server dropped the kept-alive connection while it was
+            # idle; nothing has been sent on it yet.
+            connection.close()
+            self._count('reconnects')
+            connection, is_reused = self._connect(key, timeout), False
+        try:
+            self._send(connection, path, data, deadline)
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not is_reused:
+                raise
+            # The gateway can't have the whole request if writing it
+            # failed, so it is safe to send it once more on a fresh
+            # connection.
+            self._count('reconnects')
+            connection = self._connect(key, timeout)
+            try:
+                self._send(connection, path, data, deadline)
+            except:
+                connection.close()
+                raise
+        
+        # From here on the gateway may have processed the request, so
+        # failures are raised rather than retried.
+        try:
+            if deadline is not None:
+                connection.sock.settimeout(_remaining(deadline))
+            response = connection.getresponse()
+            if deadline is not None and connection.sock is not None:
+                connection.sock.settimeout(_remaining(deadline))
+            body = response.read()
+        except:
+            connection.close()
+            raise
+        
+        if response.will_close:
+            connection.close()
+        else:
+            self._put(key, connection)
+        
+        if response.status != 200:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                    response.msg, None)
+        
+        return body
+    
+    def warm(self, url, connections=1, timeout=None):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        
+        self._lock.acquire()
+        try:
+            idle = len(self._idle.get(key, ()))
+        finally:
+            self._lock.release()
+        
+        opened = 0
+        for i in range(min(connections, self.maxsize) - idle):
+            connection = self._connect(key, timeout)
+            try:
+                connection.connect()
+            except:
+                connection.close()
+                raise
+            self._put(key, connection)
+            opened += 1
+        return opened
+    
+    def close(self):
+        self._closed = True
+        self.clear()
+    
+    def clear(self):
+        """Close every idle connection in the pool."""
+        
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        
+        for connections in idle.values():
+            for connection, last_used in connections:
+                connection.close()
+    
+    def _send(self, connection, path, data, deadline):
+        """Write a form POST to connection without reading the response."""
+        
+        timeout = _remaining(deadline)
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        connection.request('POST', path, data,
+                {'Content-Type': 'application/x-www-form-urlencoded'})
+    
+    def _get(self, key, timeout):
+        """Return an idle connection for key, or a new one.
+        
+        Returns:
+            A (connection, is_reused) tuple.
+        """
+        
+        expired = []
+        connection = None
+        now = time.time()
+        
+        self._lock.acquire()
+        try:
+            connections = self._idle.get(key, [])
+            while connections:
+                idle_connection, last_used = connections.pop()
+                if now - last_used > self.idle_timeout:
+                    expired.append(idle_connection)
+                    self.stats['evictions'] += 1
+                else:
+                    connection = idle_connection
+                    self.stats['hits'] += 1
+                    break
+        finally:
+            self._lock.release()
+        
+        for idle_connection in expired:
+            idle_connection.close()
+        
+        if connection is None:
+            return (self._connect(key, timeout), False)
+        
+        return (connection, True)
+    
+    def _put(self, key, connection):
+        """Return connection to the pool, closing it if the pool is full."""
+        
+        self._lock.acquire()
+        try:
+            if not self._closed:
+                connections = self._idle.setdefault(key, [])
+                if len(connections) < self.maxsize:
+                    connections.append((connection, time.time()))
+                    connection = None
+                else:
+                    self.stats['evictions'] += 1
+        finally:
+            self._lock.release()
+        
+        if connection is not None:
+            connection.close()
+    
+    def _connect(self, key, timeout):
+        """Open a new connection for key."""
+        
+        scheme, host, port = key
+        if scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        
+        self._count('connections')
+        return connection_class(host, port, timeout=timeout)
+    
+    def _count(self, stat):
+        """Increment one of the pool statistics."""
+        
+        self._lock.acquire()
+        try:
+            self.stats[stat] += 1
+        finally:
+            self._lock.release()
+
+
+def _is_closed(connection):
+    """Has the server closed the idle connection?
+    
+    An idle HTTP connection has nothing to read, so a readable socket means
+    the server hung up (or sent something it shouldn't have); either way
+    the connection can't be used for another request.
+    """
+    
+    if connection.sock is None:
+        return True
+    try:
+        readable = select.select([connection.sock], [], [], 0)[0]
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+def _remaining(deadline):
+    """Return the seconds left until deadline, or None if there is none.
+    
+    Raises:
+        socket.timeout if the deadline has passed.
+    """
+    
+    if deadline is None:
+        return None
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise socket.timeout('timed out')
+    return remaining
+
+
+class TransactionTimeout(Exception):
+    """Waiting for a PendingTransaction took longer than allowed."""
+
+
+class TransactionCancelled(Exception):
+    """The PendingTransaction was cancelled before it ran."""
+
+
+class PendingTransaction(object):
+    """Handle on a call submitted to a WorkerPool.
+    
+    The caller can wait for the outcome with result(), be told about it
+    through add_done_callback(), or cancel() the call if a worker hasn't
+    picked it up yet.
+    """
+    
+    def __init__(self, function, args=()):
+        self._function = function
+        self._args = args
+        self._state = 'pending'
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+    
+    def cancel(self):
+        """Cancel the call if it hasn't started.
+        
+        Returns:
+            True if the call was cancelled.
+            False if it is already running or done.
+        """
+        
+        self._lock.acquire()
+        try:
+            if self._state != 'pending':
+                return self._state == 'cancelled'
+            self._state = 'cancelled'
+        finally:
+            self._lock.release()
+        
+        self._finish()
+        return True
+    
+    def cancelled(self):
+        """Was the call cancelled?"""
+        
+        return self._state == 'cancelled'
+    
+    def done(self):
+        """Has the call finished or been cancelled?"""
+        
+        return self._done.isSet()
+    
+    def result(self, timeout=None):
+        """Wait for the call and return its result.
+        
+        An exception raised by the call is re-raised here.
+        
+        Raises:
+            TransactionTimeout if the call isn't done within timeout seconds.
+            TransactionCancelled if the call was cancelled.
+        """
+        
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise TransactionTimeout, 'Transaction still pending.'
+        elif self._state == 'cancelled':
+            raise TransactionCancelled, 'Transaction was cancelled.'
+        elif self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        else:
+            return self._result
+    
+    def add_done_callback(self, callback):
+        """Call callback(pending) once the call finishes.
+        
+        The callback runs on the worker thread, or right away if the call
+        has already finished.
+        """
+        
+        self._lock.acquire()
+        try:
+            if not self._done.isSet():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        
+        callback(self)
+    
+    def _run(self):
+        """Run the call on the current thread unless it was cancelled."""
+        
+        self._lock.acquire()
+        try:
+            if self._state != 'pending':
+                return
+            self._state = 'running'
+        finally:
+            self._lock.release()
+        
+        try:
+            self._result = self._function(*self._args)
+        except:
+            self._exc_info = sys.exc_info()
+        
+        self._state = 'finished'
+        self._finish()
+    
+    def _finish(self):
+        """Wake up waiters and run the done callbacks."""
+        
+        self._lock.acquire()
+        try:
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+        
+        for callback in callbacks:
+            callback(self)
+
+
+class WorkerPool(object):
+    """Fixed number of daemon threads running submitted calls in order.
+    
+    Threads are started on first use:
+    >>> pool = WorkerPool(size=4)
+    >>> pending = pool.submit(p.process)
+    >>> is_processed = pending.result(timeout=30)
+    """
+    
+    def __init__(self, size=10):
+        self.size = size
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+    
+    def submit(self, function, *args):
+        """Queue function(*args) to run on a worker thread.
+        
+        Returns:
+            A PendingTransaction for the call.
+        """
+        
+        pending = PendingTransaction(function, args)
+        self._start()
+        self._queue.put(pending)
+        return pending
+    
+    def shutdown(self, wait=False):
+        """Stop the worker threads once the queued calls have run.
+        
+        With wait, return only once the threads have stopped.
+        """
+        
+        self._lock.acquire()
+        try:
+            threads = self._threads
+            self._threads = []
+        finally:
+            self._lock.release()
+        
+        for thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+    
+    def _start(self):
+        """Start worker threads until there are size of them."""
+        
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+    
+    def _work(self):
+        """Run queued calls until told to stop."""
+        
+        while True:
+            pending = self._queue.get()
+            if pending is None:
+                break
+            pending._run()
+
+
+# Shared by every PaymentProcessor unless told otherwise.
+connection_pool = ConnectionPool()
+worker_pool = WorkerPool()
+
+# Transport of new gateways, chosen by default_transport() unless set.
+transport = None
+
+
+def default_transport():
+    """Return the transport new gateways and processors use.
+    
+    That is the module-level transport if it is set. Otherwise it is
+    chosen once, on first use: an AppEngineTransport on Google App Engine
+    and the shared connection_pool everywhere else. Set transport before
+    creating processors to make every one of them use another transport:
+    >>> pyauthorize.transport = UrllibTransport()
+    """
+    
+    global transport
+    if transport is None:
+        try:
+            transport = AppEngineTransport()
+        except ImportError:
+            transport = connection_pool
+    return transport
+
+
+def process_many(transactions, max_concurrency=10, ordered=False,
+                 timeout=None, gateway=None):
+    """Set up and process many transactions concurrently.
+    
+    Each transaction is a (processor, transaction_type) pair, where
+    transaction_type names the setup method to call before process():
+    >>> for (processor, transaction_type), is_processed, error in (
+    ...         process_many(refunds, max_concurrency=8)):
+    ...     if error:
+    ...         log_failure(processor.transaction, error)
+    
+    Every processor must be a separate PaymentProcessor instance.
+    
+    If a Gateway is given, transactions are Transactions instead, which
+    are all submitted through it, and each result is the gateway's Response:
+    >>> for transaction, response, error in process_many(refunds,
+    ...         gateway=gateway):
+    ...     pass
+    
+    If the gateway has a concurrency_limiter, max_concurrency only caps the
+    transactions in flight and the limiter adjusts how many there are.
+    
+    transactions may be any iterable, including a generator over millions
+    of rows; it is only read a little ahead of the results, so no more than
+    2 * max_concurrency transactions are held at a time.
+    
+    Args:
+        transactions: Iterable of (processor, transaction_type) pairs.
+        max_concurrency: Number of transactions processed at once.
+        ordered: Yield results in input order instead of as they finish.
+        timeout: Optional seconds each request may take.
+        gateway: Optional Gateway to submit Transactions through.
+    
+    Yields:
+        ((processor, transaction_type), is_processed, error) tuples, or
+        (transaction, response, error) tuples with a gateway. error is None
+        when the transaction was processed, successfully or not, and the
+        exception that stopped it otherwise, e.g. the ValueError of an
+        invalid record; is_processed is then False and response None. A bad
+        record never stops the batch.
+    """
+    
+    if gateway is None:
+        process_one = _process_one
+        failed = False
+    else:
+        process_one = gateway.submit
+        failed = None
+    
+    workers = WorkerPool(size=max_concurrency)
+    finished = Queue.Queue()
+    transactions = iter(transactions)
+    window = 2 * max_concurrency
+    
+    in_flight = {}
+    completed = {}
+    submitted = 0
+    next_result = 0
+    is_exhausted = False
+    
+    try:
+        while True:
+            while (not is_exhausted
+                   and len(in_flight) + len(completed) < window):
+                try:
+                    item = next(transactions)
+                except StopIteration:
+                    is_exhausted = True
+                    break
+                
+                pending = workers.submit(process_one, item, timeout)
+                in_flight[submitted] = pending
+                pending.add_done_callback(
+                        lambda pending, index=submitted, item=item:
+                        finished.put((index, item, pending)))
+                submitted += 1
+            
+            if not in_flight and not completed:
+                break
+            
+            index, item, pending = finished.get()
+            del in_flight[index]
+            try:
+                result = (item, pending.result(), None)
+            except Exception, error:
+                result = (item, failed, error)
+            
+            if not ordered:
+                yield result
+                continue
+            
+            completed[index] = result
+            while next_result in completed:
+                yield completed.pop(next_result)
+                next_result += 1
+    finally:
+        # Don't send transactions the caller has stopped waiting for, nor
+        # wait for those already being sent.
+        for pending in in_flight.values():
+            pending.cancel()
+        workers.shutdown(wait=not in_flight)
+
+
+def _process_one(item, timeout):
+    """Set up and process one process_many() transaction."""
+    
+    processor, transaction_type = item
+    getattr(processor, transaction_type)()
+    return processor.process(timeout)
+
+
+# Names of the AIM response fields, in order; None marks reserved fields.
+RESPONSE_FIELDS = (
+        'response_code', 'response_subcode', 'reason_code', 'reason_text',
+        'approval_code', 'avs_response', 'trans_id', 'invoice_number',
+        'description', 'amount', 'method', 'transaction_type',
+        'customer_id', 'first_name', 'last_name', 'company', 'address',
+        'city', 'state', 'zip', 'country', 'phone', 'fax', 'email',
+        'ship_to_first_name', 'ship_to_last_name', 'ship_to_company',
+        'ship_to_address', 'ship_to_city', 'ship_to_state', 'ship_to_zip',
+        'ship_to_country', 'tax', 'duty', 'freight', 'tax_exempt',
+        'purchase_order_number', 'md5_hash', 'card_code_response',
+        'cavv_response', None, None, None, None, None, None, None, None,
+        None, None, 'account_number', 'card_type', 'split_tender_id',
+        'requested_amount', 'balance_on_card',
+)
+
+
+class Response(object):
+    """Result of a transaction as returned by the gateway.
+    
+    Only the raw response is kept. It is split into fields the first time
+    one is read, and then only into a compact array of offsets, so
+    responses are cheap to hold on to in bulk.
+    
+    Every documented field is available by name, e.g. response.amount or
+    response.card_type, and any field by position, response[9]. Fields
+    missing from a short response read as ''. Fields encapsulated with
+    x_encap_char may contain the delimiter.
+    """
+    
+    __slots__ = ('raw', 'delim_char', 'encap_char', '_offsets')
+    
+    def __init__(self, raw, delim_char='|', encap_char=''):
+        self.raw = raw
+        self.delim_char = delim_char
+        self.encap_char = encap_char
+        self._offsets = None
+    
+    def __len__(self):
+        return len(self._field_offsets()) // 2
+    
+    def __getitem__(self, index):
+        offsets = self._field_offsets()
+        if index < 0:
+            index += len(offsets) // 2
+        if not 0 <= index < len(offsets) // 2:
+            raise IndexError, 'Response field index out of range.'
+        return self.raw[offsets[2 * index]:offsets[2 * index + 1]]
+    
+    def __repr__(self):
+        return '<Response %s %s>' % (self.response_code, self.reason_code)
+    
+    def field(self, index, default=''):
+        """Return the field at index, or default if there is none."""
+        
+        try:
+            return self[index]
+        except IndexError:
+            return default
+    
+    @property
+    def is_approved(self):
+        """Was the transaction successful?"""
+        
+        return str(self.response_code) == '1'
+    
+    @property
+    def classification(self):
+        """The Classification of the response's reason code."""
+        
+        classification = REASON_CODES.get(self.reason_code)
+        if classification is None:
+            classification = RESPONSE_CODES.get(self.response_code,
+                    UNKNOWN_RESPONSE)
+        return classification
+    
+    @property
+    def category(self):
+        """The category of the reason code, e.g. 'soft_decline'."""
+        
+        return self.classification.category
+    
+    @property
+    def is_retryable(self):
+        """May sending the same request again later succeed?"""
+        
+        return self.classification.is_retryable
+    
+    @property
+    def user_message(self):
+        """A message about the outcome that is safe to show customers."""
+        
+        return self.classification.message
+    
+    @property
+    def avs_result(self):
+        """The Classification of the AVS response."""
+        
+        return AVS_RESPONSES.get(self.avs_response, UNAVAILABLE_CHECK)
+    
+    @property
+    def card_code_result(self):
+        """The Classification of the card code response."""
+        
+        return CARD_CODE_RESPONSES.get(self.card_code_response,
+                UNAVAILABLE_CHECK)
+    
+    def _field_offsets(self):
+        """Return the start and end offsets of every field.
+        
+        Offsets are found on first use and kept as an array of
+        start, end pairs.
+        """
+        
+        if self._offsets is not None:
+            return self._offsets
+        
+        raw = self.raw
+        delim = self.delim_char
+        encap = self.encap_char
+        offsets = array.array('i')
+        position = 0
+        while True:
+            if encap and raw.startswith(encap, position):
+                # The value ends at an encap char followed by a delimiter.
+                start = position + len(encap)
+                end = raw.find(encap + delim, start)
+                if end == -1:
+                    end = raw.rfind(encap, start)
+                    if end == -1:
+                        end = len(raw)
+                    next_position = -1
+                else:
+                    next_position = end + len(encap) + len(delim)
+            else:
+                start = position
+                end = raw.find(delim, start)
+                if end == -1:
+                    end = len(raw)
+                    next_position = -1
+                else:
+                    next_position = end + len(delim)
+            
+            offsets.append(start)
+            offsets.append(end)
+            if next_position == -1:
+                break
+            position = next_position
+        
+        self._offsets = offsets
+        return offsets
+
+
+def _response_field(index, name):
+    """Return a property reading Response field index."""
+    
+    return property(lambda self: self.field(index),
+            doc='The %s field (position %d).' % (name, index + 1))
+
+
+for _index, _name in enumerate(RESPONSE_FIELDS):
+    if _name:
+        setattr(Response, _name, _response_field(_index, _name))
+
+# Position 40 has always been read as the ccv_response; the card code
+# response proper is card_code_response.
+Response.ccv_response = _response_field(39, 'ccv_response')
+del _index, _name
+
+
+class Classification(collections.namedtuple('Classification',
+        'category is_retryable message')):
+    """What a response, AVS or card code result means.
+    
+    Reason codes are classified in one of the categories:
+        approved: The transaction went through.
+        declined: The card was declined; don't try it again.
+        soft_decline: The card was declined for something the customer
+            can fix, such as a billing address or card code mismatch.
+        duplicate: The transaction repeats one already processed.
+        held: The transaction is held for review by the merchant.
+        error: The gateway or processor failed; is_retryable tells whether
+            sending the same request again later may work.
+        invalid: The request itself is wrong.
+        merchant: The merchant's account or configuration is wrong.
+    
+    AVS and card code results are classified as match, partial, no_match,
+    unavailable or error. message is safe to show to customers.
+    """
+    
+    __slots__ = ()
+
+
+_DECLINED = 'Your card was declined. Please use another card.'
+_TRY_AGAIN = 'We could not process your payment. Please try again later.'
+_CANNOT_PROCESS = 'We could not process your payment.'
+
+# AIM reason codes, as (codes, category, is_retryable, message) rows.
+_REASON_CODE_ROWS = (
+        (('1',), 'approved', False, 'Your payment was approved.'),
+        (('2', '3', '4', '41', '128', '141', '145', '250', '251', '254'),
+         'declined', False, _DECLINED),
+        (('8',), 'declined', False, 'Your card has expired.'),
+        (('17', '28'), 'declined', False,
+         'We do not accept this type of card.'),
+        (('27', '127'), 'soft_decline', False,
+         'The billing address does not match the card. Please check it.'),
+        (('44', '65', '165'), 'soft_decline', False,
+         'The card security code does not match. Please check it.'),
+        (('45',), 'soft_decline', False,
+         'The billing address and security code do not match the card.'),
+        (('11',), 'duplicate', False,
+         'This payment has already been submitted.'),
+        (('310',), 'duplicate', False,
+         'This transaction has already been voided.'),
+        (('311',), 'duplicate', False,
+         'This transaction has already been captured.'),
+        (('193', '252', '253'), 'held', False,
+         'Your payment is being reviewed.'),
+        (('19', '20', '21', '22', '23', '25', '26', '57', '58', '59', '60',
+          '61', '62', '63'), 'error', True, _TRY_AGAIN),
+        (('35', '36', '52', '120', '121', '122', '152', '170', '171', '172',
+          '173', '174', '175', '180', '181', '261', '303'), 'error', False,
+         _TRY_AGAIN),
+        (('5',), 'invalid', False, 'The amount is invalid.'),
+        (('6', '37', '315'), 'invalid', False, 'The card number is invalid.'),
+        (('7', '316', '317'), 'invalid', False,
+         'The card expiration date is invalid.'),
+        (('78',), 'invalid', False, 'The card security code is invalid.'),
+        (('9', '10', '100', '101', '102', '103', '104', '105', '106', '107',
+          '108', '109'), 'invalid', False,
+         'The bank account details are invalid.'),
+        (('12', '15', '16', '33', '46', '47', '48', '49', '50', '51', '53',
+          '54', '55', '64', '66', '68', '69', '70', '71', '72', '73', '74',
+          '75', '76', '77', '79', '80', '81', '82', '83', '88', '89', '91',
+          '92', '97', '98', '116', '117', '118', '119', '270', '271', '289',
+          '290', '296', '297', '298', '300', '301', '302', '304', '306',
+          '308', '318', '319'), 'invalid', False, _CANNOT_PROCESS),
+        (('13', '14', '18', '24', '29', '30', '31', '34', '38', '40', '43',
+          '56', '84', '85', '86', '87', '90', '99', '130', '131', '132',
+          '288', '305', '309'), 'merchant', False, _CANNOT_PROCESS),
+)
+
+# Classification of every AIM reason code.
+REASON_CODES = dict((code, Classification(category, is_retryable, message))
+                    for codes, category, is_retryable, message
+                    in _REASON_CODE_ROWS for code in codes)
+
+# Classification of reason codes missing from REASON_CODES, by response
+# code.
+RESPONSE_CODES = {
+        '1' : REASON_CODES['1'],
+        '2' : REASON_CODES['2'],
+        '3' : Classification('error', False, _CANNOT_PROCESS),
+        '4' : REASON_CODES['252'],
+}
+UNKNOWN_RESPONSE = Classification('error', False, _CANNOT_PROCESS)
+
+# Classification of the AVS response codes.
+AVS_RESPONSES = {
+        'A' : Classification('partial', False,
+                'The street address matches, but the ZIP code does not.'),
+        'B' : Classification('unavailable', False,
+                'No address was provided.'),
+        'E' : Classification('error', False,
+                'The address could not be verified.'),
+        'G' : Classification('unavailable', False,
+                'The card issuer does not support address verification.'),
+        'N' : Classification('no_match', False,
+                'Neither the street address nor the ZIP code match.'),
+        'P' : Classification('unavailable', False,
+                'Address verification does not apply to this transaction.'),
+        'R' : Classification('error', True,
+                'Address verification is unavailable. Please try again.'),
+        'S' : Classification('unavailable', False,
+                'The card issuer does not support address verification.'),
+        'U' : Classification('unavailable', False,
+                'The card issuer has no address on file.'),
+        'W' : Classification('partial', False,
+                'The ZIP code matches, but the street address does not.'),
+        'X' : Classification('match', False,
+                'The street address and ZIP code match.'),
+        'Y' : Classification('match', False,
+                'The street address and ZIP code match.'),
+        'Z' : Classification('partial', False,
+                'The ZIP code matches, but the street address does not.'),
+}
+
+# Classification of the card code (CVV2/CVC2/CID) response codes.
+CARD_CODE_RESPONSES = {
+        'M' : Classification('match', False,
+                'The card security code matches.'),
+        'N' : Classification('no_match', False,
+                'The card security code does not match.'),
+        'P' : Classification('unavailable', False,
+                'The card security code was not checked.'),
+        'S' : Classification('unavailable', False,
+                'The card security code should be on the card.'),
+        'U' : Classification('unavailable', False,
+                'The card issuer does not check security codes.'),
+}
+UNAVAILABLE_CHECK = Classification('unavailable', False,
+        'The check was not performed.')
+
+
+class Transaction(object):
+    """An immutable, validated transaction request.
+    
+    Transactions are built with the constructor for their type, which
+    validates the fields just like the matching PaymentProcessor setup
+    method and raises ValueError if one is invalid:
+    >>> t = Transaction.auth_and_capture(card_num='4111111111111111',
+    ...         exp_date='0512', amount='12.00', invoice_number='1001')
+    >>> t = Transaction.prior_auth_capture(transaction='2149186775')
+    >>> t = Transaction.void(transaction='2149186775')
+    >>> t = Transaction.credit(transaction='2149186775', card_num='1111',
+    ...         amount='12.00')
+    
+    Attributes:
+        type: The x_type of the transaction, e.g. 'AUTH_CAPTURE'.
+        fields: Tuple of (name, value) pairs posted to the gateway.
+    """
+    
+    __slots__ = ('type', 'fields')
+    
+    def __init__(self, type, fields):
+        object.__setattr__(self, 'type', type)
+        object.__setattr__(self, 'fields',
+                (('x_type', type),) + tuple(fields))
+    
+    def __setattr__(self, name, value):
+        raise AttributeError, 'Transaction is immutable.'
+    
+    def __delattr__(self, name):
+        raise AttributeError, 'Transaction is immutable.'
+    
+    def __repr__(self):
+        return '<Transaction %s>' % self.type
+    
+    def get(self, name, default=None):
+        """Return the value of the field called name."""
+        
+        for field_name, value in self.fields:
+            if field_name == name:
+                return value
+        return default
+    
+    @classmethod
+    def auth_only(cls, card_num, exp_date, amount, **kwargs):
+        """Authorization only.
+        
+        Takes the same optional keyword arguments as auth_and_capture().
+        """
+        
+        return cls('AUTH_ONLY', _auth_fields(card_num, exp_date, amount,
+                **kwargs))
+    
+    @classmethod
+    def auth_and_capture(cls, card_num, exp_date, amount, card_code=None,
+                         address=None, zip=None, invoice_number=None,
+                         first_name=None, last_name=None, customer_id=None,
+                         description=None, is_avs_required=False,
+                         is_ccv_required=False):
+        """Authorization and immediate capture.
+        
+        address and zip are required if is_avs_required is set, card_code
+        if is_ccv_required is set.
+        """
+        
+        return cls('AUTH_CAPTURE', _auth_fields(card_num, exp_date, amount,
+                card_code, address, zip, invoice_number, first_name,
+                last_name, customer_id, description, is_avs_required,
+                is_ccv_required))
+    
+    @classmethod
+    def prior_auth_capture(cls, transaction, amount=None):
+        """Capture of a previous authorization, optionally for less."""
+        
+        fields = [('x_trans_id', _valid_transaction(transaction))]
+        if amount:
+            fields.append(('x_amount', _valid_amount(amount)))
+        return cls('PRIOR_AUTH_CAPTURE', fields)
+    
+    @classmethod
+    def void(cls, transaction):
+        """Void of an unsettled transaction."""
+        
+        return cls('VOID', [('x_trans_id', _valid_transaction(transaction))])
+    
+    @classmethod
+    def credit(cls, transaction, card_num, amount):
+        """Credit against a settled transaction.
+        
+        card_num may be the full card number or just its last four digits.
+        """
+        
+        return cls('CREDIT', [
+                ('x_trans_id', _valid_transaction(transaction)),
+                ('x_card_num', _valid_card_num_or_last_four(card_num)),
+                ('x_amount', _valid_amount(amount)),
+        ])
+
+
+# BIN ranges of the major card networks, as (low, high, brand) prefixes.
+DEFAULT_BIN_RANGES = (
+        ('4', '4', 'Visa'),
+        ('51', '55', 'MasterCard'),
+        ('2221', '2720', 'MasterCard'),
+        ('34', '34', 'American Express'),
+        ('37', '37', 'American Express'),
+        ('6011', '6011', 'Discover'),
+        ('622126', '622925', 'Discover'),
+        ('644', '649', 'Discover'),
+        ('65', '65', 'Discover'),
+        ('3528', '3589', 'JCB'),
+        ('300', '305', 'Diners Club'),
+        ('36', '36', 'Diners Club'),
+        ('38', '39', 'Diners Club'),
+)
+
+
+class BinIndex(object):
+    """Index of card brands by BIN (bank identification number) range.
+    
+    Ranges are given as digit prefixes of any length up to 8 and stored as
+    three parallel sorted arrays of 8 digit bounds and brand numbers,
+    searched with bisect. Where ranges overlap the narrowest one wins, so a
+    table can refine a network-wide range with more specific ones.
+    """
+    
+    DIGITS = 8
+    
+    def __init__(self, ranges=DEFAULT_BIN_RANGES):
+        self.brands = []
+        self._starts = array.array('L')
+        self._ends = array.array('L')
+        self._brand_numbers = array.array('H')
+        self._build(ranges)
+    
+    def __len__(self):
+        return len(self._starts)
+    
+    @classmethod
+    def load(cls, path):
+        """Build an index from a CSV file of low,high,brand rows.
+        
+        Blank lines and lines starting with # are skipped.
+        """
+        
+        import csv
+        table = open(path, 'rb')
+        try:
+            rows = [row for row in csv.reader(table)
+                    if row and not row[0].startswith('#')]
+        finally:
+            table.close()
+        
+        ranges = []
+        for row in rows:
+            if len(row) != 3:
+                raise ValueError, 'Invalid BIN range. %s' % ','.join(row)
+            ranges.append(tuple(field.strip() for field in row))
+        return cls(ranges)
+    
+    def brand(self, card_num):
+        """Return the brand of card_num, or None if it isn't known."""
+        
+        key = int(card_num[:self.DIGITS].ljust(self.DIGITS, '0'))
+        i = bisect.bisect_right(self._starts, key) - 1
+        if i >= 0 and key <= self._ends[i]:
+            return self.brands[self._brand_numbers[i]]
+        return None
+    
+    def _build(self, ranges):
+        """Flatten ranges into sorted, disjoint arrays."""
+        
+        numbers = {}
+        bounds = []
+        for low, high, brand in ranges:
+            if not (low.isdigit() and high.isdigit()
+                    and len(low) <= self.DIGITS
+                    and len(high) <= self.DIGITS):
+                raise ValueError, 'Invalid BIN range. %s-%s' % (low, high)
+            start = int(low.ljust(self.DIGITS, '0'))
+            end = int(high.ljust(self.DIGITS, '9'))
+            if start > end:
+                raise ValueError, 'Invalid BIN range. %s-%s' % (low, high)
+            if brand not in numbers:
+                numbers[brand] = len(self.brands)
+                self.brands.append(brand)
+            bounds.append((start, end, numbers[brand]))
+        bounds.sort()
+        
+        points = set()
+        for start, end, number in bounds:
+            points.add(start)
+            points.add(end + 1)
+        points = sorted(points)
+        
+        # Sweep the elementary segments between points, keeping the
+        # ranges covering the current one in a heap, narrowest first.
+        active = []
+        i = 0
+        for segment_start, next_point in zip(points, points[1:]):
+            while i < len(bounds) and bounds[i][0] == segment_start:
+                start, end, number = bounds[i]
+                heapq.heappush(active, (end - start, end, number))
+                i += 1
+            while active and active[0][1] < segment_start:
+                heapq.heappop(active)
+            if not active:
+                continue
+            
+            number = active[0][2]
+            if (self._ends and self._ends[-1] == segment_start - 1
+                    and self._brand_numbers[-1] == number):
+                self._ends[-1] = next_point - 1
+            else:
+                self._starts.append(segment_start)
+                self._ends.append(next_point - 1)
+                self._brand_numbers.append(number)
+
+
+class CardPrescreen(object):
+    """Rejects cards the gateway would decline before they are sent.
+    
+    Card numbers must pass the Luhn checksum, the card must not have
+    expired, and if supported_brands is given the card's BIN must belong to
+    one of them:
+    >>> p.prescreen = CardPrescreen(
+    ...         bin_index=BinIndex.load('bin_ranges.csv'),
+    ...         supported_brands=['Visa', 'MasterCard'])
+    
+    Failing cards raise a ValueError from auth_only() / auth_and_capture()
+    or Gateway.submit().
+    """
+    
+    def __init__(self, bin_index=None, supported_brands=None):
+        if bin_index is None:
+            bin_index = BinIndex()
+        self.bin_index = bin_index
+        self.supported_brands = supported_brands
+        if supported_brands is not None:
+            self.supported_brands = frozenset(supported_brands)
+    
+    def check(self, card_num, exp_date, today=None):
+        """Check a card that has already passed format validation.
+        
+        Returns:
+            The card's brand, or None if it isn't in the BIN index.
+        
+        Raises:
+            ValueError if the card is rejected.
+        """
+        
+        card_num = str(card_num)
+        if not luhn_valid(card_num):
+            raise ValueError, 'Invalid card_num checksum. %s' % card_num
+        
+        year, month = _exp_month(str(exp_date))
+        today = today or datetime.date.today()
+        if (year, month) < (today.year, today.month):
+            raise ValueError, 'Card has expired. %s' % exp_date
+        
+        brand = self.bin_index.brand(card_num)
+        if (self.supported_brands is not None
+                and brand not in self.supported_brands):
+            raise ValueError, 'Unsupported card brand. %s' % brand
+        return brand
+
+
+# Luhn values of the digits, as they are and in the doubled positions.
+_LUHN_SINGLE = dict((str(digit), digit) for digit in range(10))
+_LUHN_DOUBLED = dict((str(digit), (digit * 2) // 10 + (digit * 2) % 10)
+                     for digit in range(10))
+
+
+def luhn_valid(card_num):
+    """Does the card number pass the Luhn checksum?"""
+    
+    digits = card_num[::-1]
+    total = (sum(map(_LUHN_SINGLE.__getitem__, digits[0::2]))
+             + sum(map(_LUHN_DOUBLED.__getitem__, digits[1::2])))
+    return total % 10 == 0
+
+
+def _exp_month(exp_date):
+    """Return (year, month) of an exp_date that passed _valid_exp_date."""
+    
+    digits = exp_date.replace('/', '').replace('-', '')
+    year = int(digits[2:])
+    if len(digits) == 4:
+        year += 2000
+    return (year, int(digits[:2]))
+
+
+class VelocityExceeded(ValueError):
+    """An authorization was rejected by a VelocityFilter."""
+
+
+class SlidingCountMinSketch(object):
+    """Approximate counts of keys over a sliding time window.
+    
+    The window is split into slots, each a count-min sketch of depth (up
+    to 4) rows of width counters, and counts are dropped a slot at a time
+    as they leave the window. Memory is fixed at 4 * width * depth * slots
+    bytes however many distinct keys are counted, 1 MB by default. Counts
+    are never under estimated; they are over estimated only once the keys
+    counted within the window approach width.
+    
+    Not thread-safe.
+    """
+    
+    def __init__(self, window, width=2 ** 14, depth=4, slots=4):
+        if width < 1 or width & (width - 1) or width > 2 ** 32:
+            raise ValueError, 'width must be a power of 2. %s' % width
+        if not 1 <= depth <= 4:
+            raise ValueError, 'depth must be 1 to 4. %s' % depth
+        if slots < 1:
+            raise ValueError, 'slots must be at least 1. %s' % slots
+        if not window > 0:
+            raise ValueError, 'window must be positive. %s' % window
+        self.window = window
+        self.width = width
+        self.depth = depth
+        self.slots = slots
+        self._slot_seconds = float(window) / slots
+        self._tables = [array.array('I', [0]) * (width * depth)
+                        for slot in range(slots)]
+        # The counters of each slot raised from 0, to clear it in place.
+        self._touched = [array.array('I') for slot in range(slots)]
+        self._epochs = [None] * slots
+        self._offsets = [row * width for row in range(depth)]
+        self._hasher = hashlib.md5(os.urandom(16))
+    
+    @property
+    def memory(self):
+        """Bytes taken by the counters."""
+        
+        return sum(table.itemsize * len(table) for table in self._tables)
+    
+    def add(self, key, count=1, now=None):
+        """Count key count times and return its new estimated count.
+        
+        Only the rows below the new estimate are raised (conservative
+        update), which keeps over estimates down.
+        """
+        
+        slot, live = self._live_tables(now)
+        current = self._tables[slot]
+        touched = self._touched[slot]
+        cells = self._cells(key)
+        totals = [sum([table[cell] for table in live]) for cell in cells]
+        estimate = min(totals) + count
+        for cell, total in zip(cells, totals):
+            if total < estimate:
+                if not current[cell]:
+                    touched.append(cell)
+                current[cell] += estimate - total
+        return estimate
+    
+    def estimate(self, key, now=None):
+        """Return the estimated count of key within the window."""
+        
+        slot, live = self._live_tables(now)
+        return min([sum([table[cell] for table in live])
+                    for cell in self._cells(key)])
+    
+    def _cells(self, key):
+        """Return the counter of key in each row."""
+        
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        hasher = self._hasher.copy()
+        hasher.update(key)
+        mask = self.width - 1
+        return [offset + (hash & mask) for offset, hash
+                in zip(self._offsets, _SKETCH_HASH.unpack(hasher.digest()))]
+    
+    def _live_tables(self, now):
+        """Return the current slot and the tables of all those in the window.
+        
+        The current slot is cleared first if it last held an older slot.
+        """
+        
+        if now is None:
+            now = time.time()
+        epoch = int(now / self._slot_seconds)
+        slot = epoch % self.slots
+        if self._epochs[slot] != epoch:
+            current = self._tables[slot]
+            touched = self._touched[slot]
+            for cell in touched:
+                current[cell] = 0
+            del touched[:]
+            self._epochs[slot] = epoch
+        
+        oldest = epoch - self.slots
+        live = [table for table, table_epoch in zip(self._tables, self._epochs)
+                if table_epoch is not None and table_epoch > oldest]
+        return slot, live
+
+
+# The MD5 of a key, as a 32-bit hash for each row.
+_SKETCH_HASH = struct.Struct('<4I')
+
+
+class VelocityRule(collections.namedtuple('VelocityRule',
+        'fields limit window')):
+    """At most limit authorizations per window seconds with the same fields.
+    
+    fields is a tuple of names among 'card_num', 'customer_id', 'zip',
+    'address' and 'amount'; amounts are compared by bucket. Authorizations
+    missing one of the fields aren't counted by the rule.
+    """
+    
+    __slots__ = ()
+
+
+# Upper bounds of the amount buckets, in dollars.
+DEFAULT_AMOUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Transaction fields VelocityRules may count.
+_VELOCITY_FIELDS = {
+        'card_num' : 'x_card_num',
+        'customer_id' : 'x_customer_id',
+        'zip' : 'x_zip',
+        'address' : 'x_address',
+        'amount' : 'x_amount',
+}
+
+
+class VelocityFilter(object):
+    """Rejects authorizations that come too fast, before they are sent.
+    
+    Card testing shows up as many small authorizations for the same card,
+    customer or billing zip code:
+    >>> p.velocity_filter = VelocityFilter([
+    ...         VelocityRule(('card_num',), limit=5, window=3600),
+    ...         VelocityRule(('customer_id',), limit=10, window=3600),
+    ...         VelocityRule(('zip', 'amount'), limit=20, window=600),
+    ... ])
+    
+    Authorizations over the limit of a rule raise VelocityExceeded, a
+    ValueError, from auth_only() / auth_and_capture() or Gateway.submit().
+    Rejected authorizations are counted too, so an attack stays blocked
+    for as long as it goes on.
+    
+    Each rule counts in a SlidingCountMinSketch, so memory doesn't grow
+    with the number of cards or customers seen; see that class for the
+    trade-off between width and accuracy. Card numbers are only hashed, with
+    a key random to the filter. One filter may be shared between threads.
+    
+    stats counts the authorizations checked and rejected.
+    """
+    
+    def __init__(self, rules, amount_buckets=DEFAULT_AMOUNT_BUCKETS,
+                 width=2 ** 14, depth=4, slots=4):
+        self.rules = list(rules)
+        self.amount_buckets = tuple(amount_buckets)
+        self.sketches = []
+        self._fields = []
+        for rule in self.rules:
+            for name in rule.fields:
+                if name not in _VELOCITY_FIELDS:
+                    raise ValueError, 'Unknown velocity field. %s' % name
+            self._fields.append([_VELOCITY_FIELDS[name]
+                                 for name in rule.fields])
+            self.sketches.append(SlidingCountMinSketch(rule.window, width,
+                    depth, slots))
+        self.stats = {'checked': 0, 'rejected': 0}
+        self._lock = threading.Lock()
+    
+    def check(self, transaction_data, now=None):
+        """Count an authorization and reject it if it is over a limit.
+        
+        Args:
+            transaction_data: The validated fields of the authorization, a
+                dictionary or Transaction.
+            now: Optional time of the authorization, for testing.
+        
+        Raises:
+            VelocityExceeded if the authorization is over the limit of one
+            of the rules.
+        """
+        
+        keys = []
+        for rule, sketch, fields in zip(self.rules, self.sketches,
+                                        self._fields):
+            values = []
+            for field in fields:
+                value = transaction_data.get(field)
+                if not value:
+                    break
+                if field == 'x_amount':
+                    value = bisect.bisect_left(self.amount_buckets,
+                            float(value))
+                values.append(str(value))
+            else:
+                keys.append((rule, sketch, '\0'.join(values)))
+        
+        exceeded = None
+        self._lock.acquire()
+        try:
+            self.stats['checked'] += 1
+            for rule, sketch, key in keys:
+                if sketch.add(key, now=now) > rule.limit and exceeded is None:
+                    exceeded = rule
+            if exceeded is not None:
+                self.stats['rejected'] += 1
+        finally:
+            self._lock.release()
+        
+        if exceeded is not None:
+            raise VelocityExceeded, (
+                    'Too many authorizations with the same %s. '
+                    '%d per %s seconds at most.' % ('/'.join(exceeded.fields),
+                    exceeded.limit, exceeded.window))
+
+
+class Observer(object):
+    """Receives timings and outcomes of the transactions a Gateway sends.
+    
+    Subclass it and override the methods of interest, then attach an
+    instance to a gateway or processor:
+    >>> p.observers.append(metrics)
+    
+    Transactions are timed in phases: 'validation' (PaymentProcessor setup
+    methods only), 'encoding', 'network' and 'parsing'. Observers are
+    called on the thread processing the transaction; an exception raised
+    by one is logged and otherwise ignored.
+    """
+    
+    def on_phase(self, transaction_type, phase, seconds):
+        """A phase of a transaction took seconds."""
+    
+    def on_response(self, transaction_type, response, request_size,
+                    response_size, seconds):
+        """The gateway answered a transaction with response.
+        
+        request_size and response_size are the sizes in bytes of the post
+        data and the response; seconds is the total time from encoding to
+        parsing.
+        """
+    
+    def on_error(self, transaction_type, error, seconds):
+        """A transaction failed with the exception error."""
+    
+    def on_retry(self, transaction_type, attempt, error):
+        """A transaction is about to be sent again.
+        
+        attempt is the number of the attempt that failed, and error the
+        exception it raised or the Response asking to try again.
+        """
+
+
+class LatencyHistogram(object):
+    """Fixed-memory histogram of latencies in seconds.
+    
+    Buckets grow by about 19% from 50 microseconds to two minutes, so
+    percentiles are estimated within that precision.
+    """
+    
+    BOUNDS = tuple(0.00005 * 2 ** (i / 4.0) for i in range(86))
+    
+    def __init__(self):
+        self.counts = array.array('L', [0] * (len(self.BOUNDS) + 1))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def add(self, seconds):
+        """Count one latency."""
+        
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+    
+    def percentile(self, percent):
+        """Estimate a percentile from the upper bound of its bucket."""
+        
+        if not self.count:
+            return 0.0
+        
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if i == len(self.BOUNDS):
+                    return self.max
+                return min(self.BOUNDS[i], self.max)
+        return self.max
+    
+    def snapshot(self):
+        """Return count, mean, p50, p95, p99 and max as a dictionary."""
+        
+        return {
+                'count' : self.count,
+                'mean' : self.count and self.total / self.count,
+                'p50' : self.percentile(50),
+                'p95' : self.percentile(95),
+                'p99' : self.percentile(99),
+                'max' : self.max,
+        }
+
+
+class MetricsAggregator(Observer):
+    """Observer keeping counters and latency histograms in memory.
+    
+    Share one aggregator between all processors and scrape it with
+    snapshot():
+    >>> metrics = MetricsAggregator()
+    >>> p.observers.append(metrics)
+    >>> p.process()
+    >>> metrics.snapshot()['responses']
+    [{'transaction_type': 'AUTH_CAPTURE', 'response_code': '1',
+      'reason_code': '1', 'count': 1}]
+    
+    Memory use doesn't grow with the number of transactions.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """Forget everything counted so far."""
+        
+        self._lock.acquire()
+        try:
+            self.responses = {}
+            self.categories = {}
+            self.errors = {}
+            self.retries = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.phases = {}
+            self.latencies = {}
+        finally:
+            self._lock.release()
+    
+    def on_phase(self, transaction_type, phase, seconds):
+        self._lock.acquire()
+        try:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = LatencyHistogram()
+            histogram.add(seconds)
+        finally:
+            self._lock.release()
+    
+    def on_response(self, transaction_type, response, request_size,
+                    response_size, seconds):
+        key = (transaction_type, response.response_code, response.reason_code)
+        category = response.category
+        self._lock.acquire()
+        try:
+            self.responses[key] = self.responses.get(key, 0) + 1
+            self.categories[category] = self.categories.get(category, 0) + 1
+            self.bytes_sent += request_size
+            self.bytes_received += response_size
+            self._latency(transaction_type).add(seconds)
+        finally:
+            self._lock.release()
+    
+    def on_error(self, transaction_type, error, seconds):
+        key = (transaction_type, error.__class__.__name__)
+        self._lock.acquire()
+        try:
+            self.errors[key] = self.errors.get(key, 0) + 1
+            self._latency(transaction_type).add(seconds)
+        finally:
+            self._lock.release()
+    
+    def on_retry(self, transaction_type, attempt, error):
+        self._lock.acquire()
+        try:
+            self.retries[transaction_type] = (
+                    self.retries.get(transaction_type, 0) + 1)
+        finally:
+            self._lock.release()
+    
+    def snapshot(self):
+        """Return the metrics gathered so far as plain data."""
+        
+        self._lock.acquire()
+        try:
+            return {
+                    'responses' : [{
+                            'transaction_type' : transaction_type,
+                            'response_code' : response_code,
+                            'reason_code' : reason_code,
+                            'count' : count,
+                    } for (transaction_type, response_code, reason_code),
+                            count in sorted(self.responses.items())],
+                    'categories' : dict(self.categories),
+                    'errors' : [{
+                            'transaction_type' : transaction_type,
+                            'error' : error,
+                            'count' : count,
+                    } for (transaction_type, error), count
+                            in sorted(self.errors.items())],
+                    'retries' : dict(self.retries),
+                    'bytes_sent' : self.bytes_sent,
+                    'bytes_received' : self.bytes_received,
+                    'phases' : dict((phase, histogram.snapshot())
+                            for phase, histogram in self.phases.items()),
+                    'latencies' : dict((transaction_type, histogram.snapshot())
+                            for transaction_type, histogram
+                            in self.latencies.items()),
+            }
+        finally:
+            self._lock.release()
+    
+    def _latency(self, transaction_type):
+        """Return the latency histogram of transaction_type."""
+        
+        histogram = self.latencies.get(transaction_type)
+        if histogram is None:
+            histogram = self.latencies[transaction_type] = LatencyHistogram()
+        return histogram
+
+
+class Profiler(object):
+    """Profiles a sample of transactions to show where their CPU time goes.
+    
+    Attach a profiler to a processor or gateway, let it see some traffic
+    and dump its report:
+    >>> p.profiler = Profiler(sample_rate=0.01)
+    ...
+    >>> p.profiler.dump('profile-1.1.3.json')
+    
+    A sample_rate share of the setup method, process() and Gateway.submit()
+    calls run under cProfile with the process's CPU clock, and the CPU time
+    of every function they call, such as _auth, the validators, urlencode,
+    the transport and Response._field_offsets, is added up by transaction
+    type. Other busy threads inflate the clock, so profile a quiet process
+    or a benchmark.
+    
+    With no profiler set, profiling costs an attribute check per call, and
+    an unsampled call costs a random number more. diff_profiles() compares two
+    reports, e.g. from before and after a deploy.
+    """
+    
+    def __init__(self, sample_rate=0.01):
+        import cProfile
+        self.sample_rate = sample_rate
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self._cProfile = cProfile
+        self.reset()
+    
+    def reset(self):
+        """Forget the samples taken so far."""
+        
+        self._lock.acquire()
+        try:
+            self._types = {}
+        finally:
+            self._lock.release()
+    
+    def call(self, transaction_type, function, *args):
+        """Return function(*args), profiling the call if it is sampled.
+        
+        The call counts as a transaction. A Response returned is split
+        before the profile stops, as it is once read.
+        """
+        
+        if self._random.random() >= self.sample_rate:
+            return function(*args)
+        return self._profile(transaction_type, function, args, 1)
+    
+    def call_setup(self, transaction_type, function, *args):
+        """call() for the setup of a transaction.
+        
+        Setups and the calls processing the transactions are sampled
+        alike, so the CPU time of the sampled setups is added to that of
+        the sampled transactions without counting as more of them.
+        """
+        
+        if self._random.random() >= self.sample_rate:
+            return function(*args)
+        return self._profile(transaction_type, function, args, 0)
+    
+    def _profile(self, transaction_type, function, args, transactions):
+        """Profile function(*args) as a number of transactions."""
+        
+        profile = self._cProfile.Profile(_cpu_clock)
+        profile.enable()
+        try:
+            result = function(*args)
+            if isinstance(result, Response):
+                result.response_code
+        finally:
+            profile.disable()
+            self._add(transaction_type, profile.getstats(), transactions)
+        return result
+    
+    def report(self):
+        """Return the profile so far as plain data, averaged per sample.
+        
+        For each transaction type, the report has the number of
+        transactions sampled, their CPU time in microseconds, setup
+        included, and, for each function, its calls
+        and the microseconds spent in it (own_us) and in it and what it
+        called (total_us). Functions are named module.function.
+        """
+        
+        self._lock.acquire()
+        try:
+            types = {}
+            for transaction_type, totals in self._types.items():
+                samples = float(totals['samples'] or 1)
+                functions = {}
+                for name, (calls, own, total) in totals['functions'].items():
+                    functions[name] = {
+                            'calls' : calls / samples,
+                            'own_us' : own / samples * 1e6,
+                            'total_us' : total / samples * 1e6,
+                    }
+                types[transaction_type] = {
+                        'samples' : totals['samples'],
+                        'cpu_us' : totals['cpu'] / samples * 1e6,
+                        'functions' : functions,
+                }
+        finally:
+            self._lock.release()
+        
+        return {
+                'python' : sys.version.split()[0],
+                'sample_rate' : self.sample_rate,
+                'transaction_types' : types,
+        }
+    
+    def dump(self, path):
+        """Write the report to a file as JSON."""
+        
+        import json
+        output = open(path, 'w')
+        try:
+            json.dump(self.report(), output, indent=2, sort_keys=True)
+        finally:
+            output.close()
+    
+    def _add(self, transaction_type, entries, transactions):
+        """Add up the profile entries of a sampled call."""
+        
+        self._lock.acquire()
+        try:
+            totals = self._types.get(transaction_type)
+            if totals is None:
+                totals = self._types[transaction_type] = {
+                        'samples' : 0,
+                        'cpu' : 0.0,
+                        'functions' : {},
+                }
+            totals['samples'] += transactions
+            
+            functions = totals['functions']
+            for entry in entries:
+                name = _profile_name(entry.code)
+                if name is None:
+                    continue
+                function = functions.get(name)
+                if function is None:
+                    function = functions[name] = [0, 0.0, 0.0]
+                function[0] += entry.callcount
+                function[1] += entry.inlinetime
+                function[2] += entry.totaltime
+                totals['cpu'] += entry.inlinetime
+        finally:
+            self._lock.release()
+
+
+# CPU time of the process.
+_cpu_clock = getattr(time, 'process_time', time.clock)
+
+
+def _profile_name(code):
+    """Return the module.function name of a profiled code object.
+    
+    Built-in functions keep cProfile's description of them. Returns None
+    for the profiler itself.
+    """
+    
+    if isinstance(code, str):
+        if '_lsprof.Profiler' in code:
+            return None
+        return code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return '%s.%s' % (module, code.co_name)
+
+
+def diff_profiles(old, new, min_change_us=1.0):
+    """Compare two Profiler reports.
+    
+    Args:
+        old: The earlier report, as returned by Profiler.report() or read
+            back from Profiler.dump().
+        new: The later report.
+        min_change_us: Changes of fewer microseconds per sample are left
+            out.
+    
+    Returns:
+        List of (transaction_type, function, old_us, new_us) tuples, the
+        CPU time per sample spent in the function itself, biggest changes
+        first. The function '*' is the whole call. Functions missing from a
+        report count as 0.
+    """
+    
+    changes = []
+    old_types = old['transaction_types']
+    new_types = new['transaction_types']
+    for transaction_type in sorted(set(old_types) | set(new_types)):
+        old_type = old_types.get(transaction_type, {})
+        new_type = new_types.get(transaction_type, {})
+        old_functions = old_type.get('functions', {})
+        new_functions = new_type.get('functions', {})
+        rows = [('*', old_type.get('cpu_us', 0.0),
+                 new_type.get('cpu_us', 0.0))]
+        for name in set(old_functions) | set(new_functions):
+            rows.append((name,
+                    old_functions.get(name, {}).get('own_us', 0.0),
+                    new_functions.get(name, {}).get('own_us', 0.0)))
+        for name, old_us, new_us in rows:
+            if abs(new_us - old_us) >= min_change_us:
+                changes.append((transaction_type, name, old_us, new_us))
+    
+    changes.sort(key=lambda change: -abs(change[3] - change[2]))
+    return changes
+
+
+class TransactionRecord(collections.namedtuple('TransactionRecord',
+        'trans_id type amount last_four timestamp')):
+    """A transaction remembered by a cache.
+    
+    type is the x_type of the latest approved request for the transaction,
+    e.g. 'AUTH_ONLY' until it is captured with 'PRIOR_AUTH_CAPTURE', and
+    timestamp the time.time() of that request.
+    """
+    
+    __slots__ = ()
+
+
+class MemoryTransactionCache(object):
+    """Thread-safe in-memory cache of TransactionRecords.
+    
+    Holds at most max_size records, dropping the least recently used, and
+    forgets records older than max_age seconds.
+    """
+    
+    def __init__(self, max_size=100000, max_age=120 * 24 * 60 * 60):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._records = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._records)
+    
+    def get(self, trans_id):
+        """Return the record of trans_id, or None."""
+        
+        self._lock.acquire()
+        try:
+            record = self._records.pop(trans_id, None)
+            if record is None:
+                return None
+            elif time.time() - record.timestamp > self.max_age:
+                return None
+            self._records[trans_id] = record
+            return record
+        finally:
+            self._lock.release()
+    
+    def put(self, record):
+        """Remember record, replacing any record of the same transaction."""
+        
+        self._lock.acquire()
+        try:
+            self._records.pop(record.trans_id, None)
+            self._records[record.trans_id] = record
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+        finally:
+            self._lock.release()
+
+
+class ShelveTransactionCache(object):
+    """TransactionRecord cache kept on disk with shelve.
+    
+    Records survive restarts and can be shared by the worker processes of
+    one host, as long as only one process has the file open at a time.
+    Records older than max_age seconds are pruned when the cache is opened
+    and every prune_interval puts.
+    """
+    
+    def __init__(self, path, max_age=120 * 24 * 60 * 60, prune_interval=1000):
+        import shelve
+        self.max_age = max_age
+        self.prune_interval = prune_interval
+        self._shelf = shelve.open(path)
+        self._puts = 0
+        self._lock = threading.Lock()
+        self.prune()
+    
+    def __len__(self):
+        return len(self._shelf)
+    
+    def get(self, trans_id):
+        """Return the record of trans_id, or None."""
+        
+        self._lock.acquire()
+        try:
+            values = self._shelf.get(str(trans_id))
+        finally:
+            self._lock.release()
+        
+        if values is None:
+            return None
+        record = TransactionRecord(*values)
+        if time.time() - record.timestamp > self.max_age:
+            return None
+        return record
+    
+    def put(self, record):
+        """Remember record, replacing any record of the same transaction."""
+        
+        self._lock.acquire()
+        try:
+            self._shelf[str(record.trans_id)] = tuple(record)
+            self._puts += 1
+            if self._puts % self.prune_interval == 0:
+                self._prune()
+            self._shelf.sync()
+        finally:
+            self._lock.release()
+    
+    def prune(self):
+        """Drop records older than max_age."""
+        
+        self._lock.acquire()
+        try:
+            self._prune()
+        finally:
+            self._lock.release()
+    
+    def close(self):
+        """Write out and close the shelf."""
+        
+        self._lock.acquire()
+        try:
+            self._shelf.close()
+        finally:
+            self._lock.release()
+    
+    def _prune(self):
+        oldest = time.time() - self.max_age
+        for trans_id in self._shelf.keys():
+            if self._shelf[trans_id][4] < oldest:
+                del self._shelf[trans_id]
+
+
+def predict_settled(record, cutoff, now=None):
+    """Has the transaction of record probably settled?
+    
+    Captured transactions settle in the first batch closed after their
+    capture, at the merchant's daily cutoff time.
+    
+    Args:
+        record: The TransactionRecord.
+        cutoff: datetime.time of the batch cutoff, in local time.
+        now: Optional time.time() to predict for.
+    """
+    
+    if record.type not in ('AUTH_CAPTURE', 'PRIOR_AUTH_CAPTURE'):
+        return False
+    
+    captured = datetime.datetime.fromtimestamp(record.timestamp)
+    batch_closes = datetime.datetime.combine(captured.date(), cutoff)
+    if captured >= batch_closes:
+        batch_closes += datetime.timedelta(days=1)
+    
+    if now is None:
+        now = time.time()
+    return datetime.datetime.fromtimestamp(now) >= batch_closes
+
+
+class RetryPolicy(object):
+    """When and how often a Gateway sends a transaction again.
+    
+    Attach a policy to a gateway or processor:
+    >>> p.retry_policy = RetryPolicy(max_attempts=4, budget=20)
+    
+    Transactions are retried after network errors and timeouts, HTTP 5xx
+    and 429 answers, and responses whose reason code is in
+    retry_reason_codes, the gateway's "please try again". Attempt n is
+    followed by a random wait of up to backoff * 2 ** (n - 1) seconds,
+    capped at max_backoff, so that clients failing together don't retry
+    together. No attempt starts more than budget seconds after the first
+    one, and the timeout of each attempt is cut to what is left of the
+    budget.
+    
+    Retries never charge a card twice. VOID and PRIOR_AUTH_CAPTURE can be
+    repeated safely since the gateway refuses to void or capture a
+    transaction twice. AUTH_ONLY, AUTH_CAPTURE and CREDIT are retried after
+    a failure that may have reached the gateway only when they carry an
+    invoice number: x_duplicate_window is then posted, and the gateway
+    answers a repeat of a charge that went through with reason code 11 and
+    the original transaction id and approval code. When an earlier attempt
+    may have reached the gateway, that answer is returned as the approval
+    of the original charge. Failures that never reached the gateway,
+    such as refused connections or HTTP 503 and 429, are retried for every
+    transaction.
+    """
+    
+    # "An error occurred during processing. Please try again in 5 minutes."
+    RETRY_REASON_CODES = frozenset(code for code, classification
+            in REASON_CODES.items() if classification.is_retryable)
+    
+    def __init__(self, max_attempts=3, backoff=0.5, max_backoff=5,
+                 budget=30, duplicate_window=120, retry_reason_codes=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self.duplicate_window = duplicate_window
+        if retry_reason_codes is None:
+            retry_reason_codes = self.RETRY_REASON_CODES
+        self.retry_reason_codes = retry_reason_codes
+    
+    def delay(self, attempt):
+        """Return the seconds to wait after attempt failed."""
+        
+        return random.uniform(0, min(self.max_backoff,
+                self.backoff * 2 ** (attempt - 1)))
+    
+    def is_transient(self, error):
+        """Return True if a request failing with error may succeed later."""
+        
+        return _is_transient(error)
+    
+    def is_unsent(self, error):
+        """Return True if error shows the gateway didn't get the request."""
+        
+        if isinstance(error, urllib2.HTTPError):
+            return error.code in (429, 503)
+        if isinstance(error, urllib2.URLError):
+            error = error.reason
+        if isinstance(error, socket.gaierror):
+            return True
+        return (isinstance(error, socket.error)
+                and error.errno == errno.ECONNREFUSED)
+
+
+def _is_transient(error):
+    """Return True if error is a network or gateway failure."""
+    
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 or error.code == 429
+    # urlfetch is only loaded on App Engine; don't import it here.
+    urlfetch = sys.modules.get('google.appengine.api.urlfetch')
+    if urlfetch is not None and isinstance(error, urlfetch.Error):
+        return True
+    return isinstance(error, (socket.error, httplib.HTTPException,
+            urllib2.URLError))
+
+
+def _original_approval(response):
+    """Return the approval a duplicate transaction response refers to.
+    
+    A charge repeated within x_duplicate_window is rejected with reason
+    code 11, the original transaction id and its approval code; the result
+    reads as the approval of the original instead.
+    """
+    
+    fields = [response[i] for i in xrange(len(response))]
+    fields[0] = '1'
+    fields[2] = '1'
+    fields[3] = 'This transaction has been approved.'
+    encap_char = response.encap_char
+    return Response(response.delim_char.join('%s%s%s' % (encap_char, value,
+            encap_char) for value in fields), response.delim_char, encap_char)
+
+
+class CircuitOpen(Exception):
+    """The gateway is failing, so the request wasn't sent.
+    
+    retry_after is the number of seconds until the circuit breaker lets a
+    request through again.
+    """
+    
+    def __init__(self, message, retry_after=0):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to a gateway that is failing.
+    
+    Share one breaker between every gateway and processor posting to the
+    same URL:
+    >>> breaker = CircuitBreaker(failure_rate=0.5, slow_call_seconds=5)
+    >>> p.circuit_breaker = breaker
+    
+    The breaker starts closed and keeps the outcome of the last window
+    requests. Once it has seen min_calls of them, it opens when at least
+    failure_rate of them failed with a network error, timeout or HTTP
+    5xx, or when at least slow_call_rate of them took slow_call_seconds or
+    longer. While it is open, requests fail at once with CircuitOpen
+    instead of waiting on the gateway.
+    
+    After open_seconds the breaker is half-open: half_open_probes requests
+    are let through, and further ones still fail fast. The breaker closes
+    again when all of the probes succeed, and opens again as soon as one
+    of them fails or is slow.
+    
+    state is 'closed', 'open' or 'half_open'. The last transitions are
+    kept in transitions as (timestamp, old_state, new_state) tuples, and
+    each callable in listeners is called with the breaker, the old state
+    and the new state on every transition. stats counts the calls,
+    failures, slow calls and rejected calls; snapshot() returns all of it
+    for monitoring.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, failure_rate=0.5, slow_call_seconds=None,
+                 slow_call_rate=0.5, window=20, min_calls=10, open_seconds=30,
+                 half_open_probes=3):
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.window = window
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self.transitions = collections.deque(maxlen=100)
+        self.listeners = []
+        self.stats = {
+                'calls' : 0,
+                'failures' : 0,
+                'slow_calls' : 0,
+                'rejected' : 0,
+        }
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._probes = 0
+        self._probe_successes = 0
+        self._reset_window()
+    
+    def call(self, function, *args):
+        """Return function(*args) if the breaker lets the call through.
+        
+        Raises:
+            CircuitOpen if the breaker is open.
+        """
+        
+        is_probe = self._before_call()
+        started = time.time()
+        try:
+            result = function(*args)
+        except Exception, error:
+            exc_info = sys.exc_info()
+            self._after_call(is_probe, time.time() - started,
+                    self.is_failure(error))
+            raise exc_info[0], exc_info[1], exc_info[2]
+        
+        self._after_call(is_probe, time.time() - started, False)
+        return result
+    
+    def is_failure(self, error):
+        """Return True if a call failing with error counts as a failure."""
+        
+        return _is_transient(error)
+    
+    def snapshot(self):
+        """Return the state, statistics and transitions as plain data."""
+        
+        self._lock.acquire()
+        try:
+            return {
+                    'state' : self.state,
+                    'stats' : dict(self.stats),
+                    'window_calls' : self._calls,
+                    'window_failures' : self._failures,
+                    'window_slow_calls' : self._slow_calls,
+                    'transitions' : list(self.transitions),
+            }
+        finally:
+            self._lock.release()
+    
+    def _before_call(self):
+        """Let a call through or raise CircuitOpen.
+        
+        Returns:
+            True if the call is a half-open probe.
+        """
+        
+        transitions = []
+        self._lock.acquire()
+        try:
+            if self.state == self.OPEN:
+                retry_after = self._opened + self.open_seconds - time.time()
+                if retry_after > 0:
+                    self.stats['rejected'] += 1
+                    raise CircuitOpen('The circuit breaker is open.',
+                            retry_after)
+                transitions.append(self._transition(self.HALF_OPEN))
+            
+            if self.state == self.HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    self.stats['rejected'] += 1
+                    raise CircuitOpen('The circuit breaker is half-open.')
+                self._probes += 1
+                is_probe = True
+            else:
+                is_probe = False
+        finally:
+            self._lock.release()
+        
+        self._notify(transitions)
+        return is_probe
+    
+    def _after_call(self, is_probe, seconds, failed):
+        """Count the outcome of a call and open or close the breaker."""
+        
+        is_slow = (self.slow_call_seconds is not None
+                   and seconds >= self.slow_call_seconds)
+        transitions = []
+        self._lock.acquire()
+        try:
+            self.stats['calls'] += 1
+            self.stats['failures'] += failed
+            self.stats['slow_calls'] += is_slow
+            
+            if is_probe and self.state == self.HALF_OPEN:
+                if failed or is_slow:
+                    transitions.append(self._open())
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_probes:
+                        transitions.append(self._transition(self.CLOSED))
+            elif not is_probe and self.state == self.CLOSED:
+                i = self._next % self.window
+                self._failures += failed - self._outcomes[i][0]
+                self._slow_calls += is_slow - self._outcomes[i][1]
+                self._outcomes[i] = (failed, is_slow)
+                self._next += 1
+                self._calls = min(self._next, self.window)
+                if self._calls >= self.min_calls and (
+                        self._failures >= self.failure_rate * self._calls or
+                        self._slow_calls >= self.slow_call_rate * self._calls):
+                    transitions.append(self._open())
+        finally:
+            self._lock.release()
+        
+        self._notify(transitions)
+    
+    def _open(self):
+        """Open the breaker."""
+        
+        self._opened = time.time()
+        return self._transition(self.OPEN)
+    
+    def _transition(self, state):
+        """Change state and return the transition."""
+        
+        transition = (time.time(), self.state, state)
+        self.transitions.append(transition)
+        self.state = state
+        self._probes = 0
+        self._probe_successes = 0
+        self._reset_window()
+        return transition
+    
+    def _reset_window(self):
+        """Forget the outcomes of past calls."""
+        
+        self._outcomes = [(False, False)] * self.window
+        self._next = 0
+        self._calls = 0
+        self._failures = 0
+        self._slow_calls = 0
+    
+    def _notify(self, transitions):
+        """Log transitions and call the listeners."""
+        
+        for timestamp, old_state, new_state in transitions:
+            logger.warning('Circuit breaker %s -> %s.', old_state, new_state)
+            for listener in self.listeners:
+                try:
+                    listener(self, old_state, new_state)
+                except Exception:
+                    logger.exception('Circuit breaker listener %r failed.',
+                            listener)
+
+
+class JournalRecord(collections.namedtuple('JournalRecord',
+        'request_id timestamp kind data')):
+    """A record read back from a TransactionJournal.
+    
+    kind is 'request', 'response' or 'error', and data respectively the
+    dictionary of posted fields, the Response, or the error message. The
+    records of one request share its request_id.
+    """
+    
+    __slots__ = ()
+
+
+# Record kinds, as stored in the journal.
+_JOURNAL_KINDS = {1: 'request', 2: 'response', 3: 'error'}
+
+# Length and CRC32 of the payload, then timestamp, request id and kind.
+_JOURNAL_FRAME = struct.Struct('>Ii')
+_JOURNAL_HEADER = struct.Struct('>dQB')
+
+
+class TransactionJournal(object):
+    """Append-only log of every request a Gateway sends and its outcome.
+    
+    Attach a journal to a gateway or processor:
+    >>> p.journal = TransactionJournal('/var/lib/payments/journal')
+    
+    Each request is written before it is sent, and its response or error
+    once it is back, both durably: process() returns only once they are on
+    disk. Card numbers are cut to their last four digits and card codes
+    left out. Threads writing at the same time share one fsync, and a
+    writer waits up to commit_interval seconds for others to join it.
+    
+    Records are framed with their length and a CRC32, so a record torn by
+    a crash is detected and ignored by JournalReader. The journal is a
+    directory of segment files, a new one being started once the current
+    one reaches segment_size bytes. Only one journal may write to a
+    directory at a time.
+    
+    stats counts the records, bytes, commits (fsyncs) and segments
+    written.
+    """
+    
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 commit_interval=0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.stats = {
+                'records' : 0,
+                'bytes' : 0,
+                'commits' : 0,
+                'segments' : 0,
+        }
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        
+        self._request_ids = itertools.count(int(time.time() * 1000000))
+        self._condition = threading.Condition(threading.Lock())
+        self._written = 0
+        self._synced = 0
+        self._is_syncing = False
+        self._file = None
+        segments = _journal_segments(directory)
+        self._segment_number = segments and segments[-1][0] or 0
+        self._rotate()
+    
+    def log_request(self, transaction_data):
+        """Durably record the fields of a request about to be sent.
+        
+        Returns:
+            The request id to log its outcome with.
+        """
+        
+        request_id = self._request_ids.next()
+        fields = []
+        if hasattr(transaction_data, 'iteritems'):
+            transaction_data = transaction_data.iteritems()
+        for name, value in transaction_data:
+            if name == 'x_card_num':
+                value = str(value)[-4:]
+            elif name == 'x_card_code':
+                continue
+            fields.append((name, str(value)))
+        self._commit(self._append(request_id, 1, urlencode(fields)))
+        return request_id
+    
+    def log_response(self, request_id, response):
+        """Durably record the Response to a request."""
+        
+        self._commit(self._append(request_id, 2, '%s%s%s%s%s' % (
+                chr(len(response.delim_char)), response.delim_char,
+                chr(len(response.encap_char)), response.encap_char,
+                response.raw)))
+    
+    def log_error(self, request_id, error):
+        """Durably record the exception a request failed with."""
+        
+        self._commit(self._append(request_id, 3, '%s: %s' % (
+                error.__class__.__name__, error)))
+    
+    def close(self):
+        """Write out and close the current segment."""
+        
+        self._condition.acquire()
+        try:
+            while self._is_syncing:
+                self._condition.wait()
+            if self._file is not None:
+                self._sync_locked()
+                self._file.close()
+                self._file = None
+        finally:
+            self._condition.release()
+    
+    def _append(self, request_id, kind, body):
+        """Write a record to the current segment.
+        
+        Returns:
+            The number of the record, to wait for its commit with.
+        """
+        
+        payload = _JOURNAL_HEADER.pack(time.time(), request_id, kind) + body
+        record = _JOURNAL_FRAME.pack(len(payload),
+                zlib.crc32(payload)) + payload
+        
+        self._condition.acquire()
+        try:
+            while (self._file.tell()
+                   and self._file.tell() + len(record) > self.segment_size):
+                if self._is_syncing:
+                    self._condition.wait()
+                else:
+                    self._rotate()
+            self._file.write(record)
+            self._written += 1
+            self.stats['records'] += 1
+            self.stats['bytes'] += len(record)
+            return self._written
+        finally:
+            self._condition.release()
+    
+    def _commit(self, record_number):
+        """Wait until record_number is on disk, syncing if no one else is.
+        
+        The thread that syncs writes out every record appended so far, so
+        the threads waiting behind it usually find theirs already synced.
+        """
+        
+        self._condition.acquire()
+        try:
+            while self._synced < record_number:
+                if self._is_syncing:
+                    self._condition.wait()
+                    continue
+                
+                self._is_syncing = True
+                try:
+                    if self.commit_interval:
+                        self._condition.release()
+                        try:
+                            time.sleep(self.commit_interval)
+                        finally:
+                            self._condition.acquire()
+                    self._file.flush()
+                    written = self._written
+                    fileno = self._file.fileno()
+                    self._condition.release()
+                    try:
+                        os.fsync(fileno)
+                    finally:
+                        self._condition.acquire()
+                    self._synced = max(self._synced, written)
+                    self.stats['commits'] += 1
+                finally:
+                    self._is_syncing = False
+                    self._condition.notifyAll()
+        finally:
+            self._condition.release()
+    
+    def _sync_locked(self):
+        """Write out the current segment while holding the lock."""
+        
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._synced = self._written
+        self.stats['commits'] += 1
+    
+    def _rotate(self):
+        """Close the current segment and start the next one."""
+        
+        if self._file is not None:
+            self._sync_locked()
+            self._file.close()
+        self._segment_number += 1
+        self._file = open(os.path.join(self.directory,
+                _JOURNAL_SEGMENT % self._segment_number), 'ab')
+        self.stats['segments'] += 1
+
+
+_JOURNAL_SEGMENT = 'journal-%08d.log'
+_JOURNAL_SEGMENT_PATTERN = re.compile(r'^journal-(\d{8})\.log$')
+
+
+def _journal_segments(directory):
+    """Return the (number, path) of every segment in directory, in order."""
+    
+    segments = []
+    for name in os.listdir(directory):
+        match = _JOURNAL_SEGMENT_PATTERN.match(name)
+        if match:
+            segments.append((int(match.group(1)),
+                             os.path.join(directory, name)))
+    segments.sort()
+    return segments
+
+
+class JournalReader(object):
+    """Reads the records of a TransactionJournal directory.
+    
+    Segments are memory-mapped and records decoded as they are iterated:
+    >>> for record in JournalReader('/var/lib/payments/journal'):
+    ...     print record.request_id, record.kind
+    
+    lookup() finds the records of the requests involving a transaction id
+    or invoice number through an index built on first use.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        self._index = None
+    
+    def __iter__(self):
+        for segment, offset, record in self._scan():
+            yield record
+    
+    def lookup(self, trans_id=None, invoice_number=None):
+        """Return the records of the requests with trans_id or invoice_number.
+        
+        A request matches if it was posted with the value as x_trans_id or
+        x_invoice_num, or if its response carries it. Records are in the
+        order they were written.
+        """
+        
+        if self._index is None:
+            self.build_index()
+        keys, locations = self._index
+        
+        request_ids = set()
+        if trans_id is not None:
+            request_ids.update(keys.get(('trans_id', str(trans_id)), ()))
+        if invoice_number is not None:
+            request_ids.update(keys.get(('invoice_number',
+                    str(invoice_number)), ()))
+        
+        found = []
+        for request_id in request_ids:
+            found.extend(locations[request_id])
+        found.sort()
+        return [self._read(path, offset) for path, offset in found]
+    
+    def build_index(self):
+        """Index the journal by transaction id and invoice number.
+        
+        Only the locations of records are kept in memory; records are read
+        again from the segments by lookup().
+        """
+        
+        keys = {}
+        locations = {}
+        for path, offset, record in self._scan():
+            locations.setdefault(record.request_id, []).append(
+                    (path, offset))
+            if record.kind == 'request':
+                values = (('trans_id', record.data.get('x_trans_id')),
+                          ('invoice_number',
+                           record.data.get('x_invoice_num')))
+            elif record.kind == 'response':
+                values = (('trans_id', record.data.trans_id),
+                          ('invoice_number', record.data.invoice_number))
+            else:
+                continue
+            for key in values:
+                if key[1] and key[1] != '0':
+                    keys.setdefault(key, set()).add(record.request_id)
+        self._index = (keys, locations)
+    
+    def _scan(self):
+        """Yield (path, offset, record) for every intact record."""
+        
+        for number, path in _journal_segments(self.directory):
+            for offset, record in self._scan_segment(path):
+                yield (path, offset, record)
+    
+    def _scan_segment(self, path):
+        """Yield (offset, record) for a segment, up to any torn record."""
+        
+        import mmap
+        segment = open(path, 'rb')
+        try:
+            size = os.fstat(segment.fileno()).st_size
+            if not size:
+                return
+            data = mmap.mmap(segment.fileno(), size, access=mmap.ACCESS_READ)
+        finally:
+            segment.close()
+        
+        try:
+            offset = 0
+            while offset + _JOURNAL_FRAME.size <= size:
+                record = _decode_journal_record(data, offset, size)
+                if record is None:
+                    break
+                yield (offset, record[0])
+                offset = record[1]
+        finally:
+            data.close()
+    
+    def _read(self, path, offset):
+        """Read the record at offset of a segment."""
+        
+        segment = open(path, 'rb')
+        try:
+            segment.seek(offset)
+            frame = segment.read(_JOURNAL_FRAME.size)
+            length = _JOURNAL_FRAME.unpack(frame)[0]
+            data = frame + segment.read(length)
+        finally:
+            segment.close()
+        return _decode_journal_record(data, 0, len(data))[0]
+
+
+def _decode_journal_record(data, offset, size):
+    """Decode the record at offset of data.
+    
+    Returns:
+        (record, next_offset), or None if the record is incomplete or
+        corrupt.
+    """
+    
+    length, crc = _JOURNAL_FRAME.unpack_from(data, offset)
+    start = offset + _JOURNAL_FRAME.size
+    end = start + length
+    if length < _JOURNAL_HEADER.size or end > size:
+        return None
+    payload = data[start:end]
+    if zlib.crc32(payload) != crc:
+        return None
+    
+    timestamp, request_id, kind = _JOURNAL_HEADER.unpack_from(payload)
+    body = payload[_JOURNAL_HEADER.size:]
+    if kind == 1:
+        value = dict(urlparse.parse_qsl(body, keep_blank_values=True))
+    elif kind == 2:
+        delim_end = 1 + ord(body[0])
+        encap_end = delim_end + 1 + ord(body[delim_end])
+        value = Response(body[encap_end:], body[1:delim_end],
+                body[delim_end + 1:encap_end])
+    else:
+        value = body
+    return (JournalRecord(request_id, timestamp, _JOURNAL_KINDS[kind], value),
+            end)
+
+
+class TrafficRecord(collections.namedtuple('TrafficRecord',
+        'timestamp seconds fields response error')):
+    """A request read back from a TrafficRecorder file.
+    
+    fields is the list of (name, value) pairs posted, with the card number
+    and card code masked, seconds the time the request took, and response
+    the Response, or error the message of the exception it failed with.
+    """
+    
+    __slots__ = ()
+
+
+class TrafficRecorder(object):
+    """Records the requests a Gateway sends, to replay them later.
+    
+    Attach a recorder to a gateway or processor and close it when done:
+    >>> p.recorder = TrafficRecorder('traffic.gz')
+    >>> p.process()
+    >>> p.recorder.close()
+    
+    Every request is written as it completes, once however many times it
+    was retried, with the time it was made, the seconds it took and its
+    response or error, as a gzipped JSON line. Card numbers keep their
+    first six and last four digits only, card codes only their length, and
+    the login and transaction key, which aren't transaction fields, are
+    never written. Recording to an existing file appends to it.
+    
+    read_traffic() reads the records back, and pyauthorize_bench replays
+    them.
+    """
+    
+    def __init__(self, path):
+        import gzip
+        import json
+        self.path = path
+        self.stats = {'records': 0}
+        self._json = json
+        self._lock = threading.Lock()
+        self._file = gzip.GzipFile(path, 'ab')
+    
+    def record(self, transaction_data, started, response=None, error=None):
+        """Write a request made at started, now complete."""
+        
+        seconds = time.time() - started
+        if hasattr(transaction_data, 'iteritems'):
+            transaction_data = transaction_data.iteritems()
+        fields = []
+        for name, value in transaction_data:
+            value = str(value)
+            if name == 'x_card_num':
+                value = _mask_card_num(value)
+            elif name == 'x_card_code':
+                value = '*' * len(value)
+            fields.append((name, value))
+        
+        if response is not None:
+            outcome = [response.raw, response.delim_char, response.encap_char]
+        else:
+            outcome = ['%s: %s' % (error.__class__.__name__, error)]
+        line = self._json.dumps([started, seconds, fields] + outcome,
+                separators=(',', ':'))
+        
+        self._lock.acquire()
+        try:
+            self._file.write(line + '\n')
+            self.stats['records'] += 1
+        finally:
+            self._lock.release()
+    
+    def close(self):
+        """Write out and close the file."""
+        
+        self._lock.acquire()
+        try:
+            self._file.close()
+        finally:
+            self._lock.release()
+
+
+def _mask_card_num(card_num):
+    """Mask all but the first six and last four digits of a card number."""
+    
+    if len(card_num) <= 10:
+        return card_num
+    return card_num[:6] + '*' * (len(card_num) - 10) + card_num[-4:]
+
+
+def read_traffic(path):
+    """Yield the TrafficRecords of a TrafficRecorder file, in order.
+    
+    A line cut short by a crash ends the file.
+    """
+    
+    import gzip
+    import json
+    traffic = gzip.GzipFile(path, 'rb')
+    try:
+        while True:
+            try:
+                line = traffic.readline()
+                values = json.loads(line)
+            except (IOError, EOFError, ValueError, zlib.error):
+                return
+            fields = [(str(name), str(value)) for name, value in values[2]]
+            if len(values) == 6:
+                yield TrafficRecord(values[0], values[1], fields,
+                        Response(str(values[3]), str(values[4]),
+                                 str(values[5])), None)
+            else:
+                yield TrafficRecord(values[0], values[1], fields, None,
+                        values[3])
+    finally:
+        traffic.close()
+
+
+class RateLimited(Exception):
+    """A request was held back by the rate limiter for too long."""
+
+
+class RateLimiter(object):
+    """Token buckets limiting the requests sent for each x_login.
+    
+    Each merchant login may send burst requests at once, and then rate
+    requests a second. Share one limiter between the gateways and
+    processors of a process:
+    >>> limiter = RateLimiter(rate=20, burst=40)
+    >>> p.rate_limiter = limiter
+    
+    Requests then wait for a token before they are sent, for no longer than
+    their timeout, and fail with RateLimited if none comes in time. Jobs
+    can also take tokens themselves, without waiting, to pace their work:
+    >>> if not limiter.acquire(x_login, blocking=False):
+    ...     requeue(transaction)
+    
+    Use a SharedRateLimiter to share the buckets between processes.
+    """
+    
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self._buckets = {}
+        self._lock = threading.Lock()
+    
+    def acquire(self, key, blocking=True, timeout=None):
+        """Take a token from the bucket of key.
+        
+        Args:
+            key: The bucket to take from, usually the x_login.
+            blocking: Wait for a token if there is none.
+            timeout: Optional seconds to wait for at most.
+        
+        Returns:
+            True if a token was taken, False if there was none in time.
+        """
+        
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        
+        while True:
+            wait = self._take(key, time.time())
+            if not wait:
+                return True
+            if not blocking:
+                return False
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining < wait:
+                    return False
+            time.sleep(wait)
+    
+    def _take(self, key, now):
+        """Take a token if there is one.
+        
+        Returns:
+            0 if a token was taken, or the seconds until there is one.
+        """
+        
+        self._lock.acquire()
+        try:
+            tokens, last_refill = self._buckets.get(key, (self.burst, now))
+            tokens, wait = self._refill(tokens, last_refill, now)
+            self._buckets[key] = (tokens, now)
+            return wait
+        finally:
+            self._lock.release()
+    
+    def _refill(self, tokens, last_refill, now):
+        """Refill a bucket and take a token from it if there is one.
+        
+        Returns:
+            (tokens, wait), wait being as returned by _take().
+        """
+        
+        tokens = min(self.burst,
+                tokens + max(0, now - last_refill) * self.rate)
+        if tokens >= 1:
+            return (tokens - 1, 0)
+        return (tokens, (1 - tokens) / self.rate)
+
+
+class SharedRateLimiter(RateLimiter):
+    """RateLimiter whose buckets are shared by the processes of a host.
+    
+    Each bucket is a small memory-mapped file in directory, locked with
+    flock while a token is taken, so every process using the same
+    directory draws from the same buckets:
+    >>> p.rate_limiter = SharedRateLimiter('/var/run/pyauthorize', rate=20)
+    
+    Bucket files are named after a hash of their key, so logins don't
+    appear on disk. Only available where fcntl is, i.e. not on Windows.
+    """
+    
+    _BUCKET = struct.Struct('=dd')
+    
+    def __init__(self, directory, rate, burst=None):
+        import fcntl
+        import mmap
+        RateLimiter.__init__(self, rate, burst)
+        self.directory = directory
+        self._fcntl = fcntl
+        self._mmap = mmap
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    
+    def close(self):
+        """Unmap and close the bucket files."""
+        
+        self._lock.acquire()
+        try:
+            for bucket_file, bucket in self._buckets.values():
+                bucket.close()
+                bucket_file.close()
+            self._buckets = {}
+        finally:
+            self._lock.release()
+    
+    def _take(self, key, now):
+        # flock only excludes other processes, so threads take the lock too.
+        self._lock.acquire()
+        try:
+            bucket_file, bucket = self._bucket(key)
+            self._fcntl.flock(bucket_file.fileno(), self._fcntl.LOCK_EX)
+            try:
+                tokens, last_refill = self._BUCKET.unpack_from(bucket)
+                if not last_refill:
+                    tokens, last_refill = (self.burst, now)
+                tokens, wait = self._refill(tokens, last_refill,
+                        max(now, last_refill))
+                self._BUCKET.pack_into(bucket, 0, tokens,
+                        max(now, last_refill))
+                return wait
+            finally:
+                self._fcntl.flock(bucket_file.fileno(), self._fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+    
+    def _bucket(self, key):
+        """Return the open (file, mmap) of the bucket of key."""
+        
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            path = os.path.join(self.directory, '%s.bucket' %
+                    hashlib.sha1(str(key)).hexdigest()[:20])
+            bucket_file = open(path, 'a+b')
+            if os.fstat(bucket_file.fileno()).st_size < self._BUCKET.size:
+                # A new bucket reads as (0, 0), i.e. not yet used.
+                bucket_file.truncate(self._BUCKET.size)
+            bucket = self._buckets[key] = (bucket_file,
+                    self._mmap.mmap(bucket_file.fileno(),
+                                    self._BUCKET.size))
+        return bucket
+
+
+class ConcurrencyLimited(Exception):
+    """A request waited too long for its turn to be sent."""
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """Adapts how many requests a gateway has in flight at once.
+    
+    Share one limiter between the gateways and processors posting to the
+    same gateway, and give bulk jobs at least max_limit workers:
+    >>> limiter = AdaptiveConcurrencyLimiter(max_limit=50)
+    >>> gateway.concurrency_limiter = limiter
+    >>> results = process_many(transactions, max_concurrency=50,
+    ...         gateway=gateway)
+    
+    Requests beyond the limit wait for one in flight to finish, for no
+    longer than their timeout, and fail with ConcurrencyLimited if their
+    turn doesn't come in time.
+    
+    The limit is adjusted by AIMD on every answer. It grows by about one
+    per limit successful requests, and is multiplied by backoff after a
+    failure or a slow round trip. A failure is a network error, timeout,
+    HTTP 5xx or "please try again" response. A round trip is slow when it
+    takes more than latency_tolerance times the fastest one in the last
+    window requests, i.e. when requests queue up at the gateway. The limit
+    is cut at most once per round trip, so requests failing together
+    count as one congestion signal.
+    
+    limit, in_flight and queued (requests waiting for their turn) may be
+    read at any time; snapshot() returns them with the counters in stats.
+    """
+    
+    def __init__(self, initial_limit=10, min_limit=1, max_limit=100,
+                 backoff=0.7, latency_tolerance=2.0, window=100):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.window = window
+        self.in_flight = 0
+        self.queued = 0
+        self.stats = {
+                'requests' : 0,
+                'failures' : 0,
+                'slow' : 0,
+                'decreases' : 0,
+                'rejected' : 0,
+        }
+        self._condition = threading.Condition(threading.Lock())
+        self._baseline = None
+        self._window_fastest = None
+        self._window_samples = 0
+        self._last_decrease = 0
+    
+    def acquire(self, timeout=None):
+        """Wait for a request to be let through.
+        
+        Returns:
+            The time the request was let through, to pass to release(), or
+            None if it wasn't within timeout seconds. Call cancel() instead
+            of release() if the request isn't sent after all.
+        """
+        
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        
+        self._condition.acquire()
+        try:
+            self.queued += 1
+            try:
+                while self.in_flight >= int(self.limit):
+                    if deadline is None:
+                        self._condition.wait()
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.stats['rejected'] += 1
+                        return None
+                    self._condition.wait(remaining)
+            finally:
+                self.queued -= 1
+            self.in_flight += 1
+            return time.time()
+        finally:
+            self._condition.release()
+    
+    def release(self, started, error=None, response=None):
+        """Count the outcome of a request let through at started.
+        
+        Args:
+            started: What acquire() returned.
+            error: The exception the request failed with, if it did.
+            response: The Response it got, if it did.
+        """
+        
+        now = time.time()
+        seconds = now - started
+        failed = (error is not None and _is_transient(error)) or (
+                response is not None and response.response_code == '3'
+                and response.is_retryable)
+        
+        self._condition.acquire()
+        try:
+            self.in_flight -= 1
+            self.stats['requests'] += 1
+            self.stats['failures'] += failed
+            
+            is_slow = False
+            if error is None:
+                is_slow = self._is_slow(seconds)
+                self.stats['slow'] += is_slow
+            
+            if failed or is_slow:
+                # Requests started before the last cut saw the old limit.
+                if started >= self._last_decrease:
+                    self.limit = max(self.min_limit,
+                            self.limit * self.backoff)
+                    self._last_decrease = now
+                    self.stats['decreases'] += 1
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+    
+    def cancel(self):
+        """Give back a turn acquire() gave to a request that isn't sent."""
+        
+        self._condition.acquire()
+        try:
+            self.in_flight -= 1
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+    
+    def snapshot(self):
+        """Return the limit, requests in flight and queued, and stats."""
+        
+        self._condition.acquire()
+        try:
+            return {
+                    'limit' : int(self.limit),
+                    'in_flight' : self.in_flight,
+                    'queued' : self.queued,
+                    'baseline_latency' : self._baseline,
+                    'stats' : dict(self.stats),
+            }
+        finally:
+            self._condition.release()
+    
+    def _is_slow(self, seconds):
+        """Track the fastest round trip and compare seconds to it."""
+        
+        if self._window_fastest is None or seconds < self._window_fastest:
+            self._window_fastest = seconds
+        if self._baseline is None or seconds < self._baseline:
+            self._baseline = seconds
+        
+        self._window_samples += 1
+        if self._window_samples >= self.window:
+            # Let the baseline follow a gateway that got slower for good.
+            self._baseline = self._window_fastest
+            self._window_fastest = None
+            self._window_samples = 0
+        
+        return seconds > self.latency_tolerance * self._baseline
+
+
+class Configuration(dict):
+    """Gateway configuration that counts the changes made to it.
+    
+    Gateways use the version to know when the request prefix they have
+    encoded from the configuration has to be encoded again.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.version = 0
+    
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.version += 1
+    
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.version += 1
+    
+    def clear(self):
+        dict.clear(self)
+        self.version += 1
+    
+    def pop(self, *args):
+        self.version += 1
+        return dict.pop(self, *args)
+    
+    def popitem(self):
+        self.version += 1
+        return dict.popitem(self)
+    
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return dict.setdefault(self, key, default)
+    
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.version += 1
+
+
+class Gateway(object):
+    """Thread-safe client for the Authorize.net AIM gateway.
+    
+    A gateway only holds configuration, so one instance can process
+    Transactions for a whole application, from any number of threads:
+    >>> gateway = Gateway(x_login='abcdef', x_tran_key='abc123')
+    >>> response = gateway.submit(Transaction.void(transaction='2149186775'))
+    >>> response.is_approved
+    True
+    
+    Like PaymentProcessor, it runs in test mode unless x_test_request=False
+    is passed.
+    
+    Requests are posted with transport, a Transport chosen by
+    default_transport() when the gateway is created; set it to another
+    one to change how this gateway reaches Authorize.net.
+    
+    Requests take as long as the gateway does unless timeout is set to
+    the seconds one may take. Set retry_policy to a RetryPolicy to retry
+    transient failures, and circuit_breaker to a CircuitBreaker to fail
+    fast with CircuitOpen while the gateway is down. Set journal to a
+    TransactionJournal to keep a durable record of every request, recorder
+    to a TrafficRecorder to capture the traffic for load tests, and
+    rate_limiter to a RateLimiter to pace the requests sent for the login.
+    An AdaptiveConcurrencyLimiter set as concurrency_limiter decides how
+    many requests are in flight at once.
+    
+    The configuration part of the request is encoded once and reused until
+    configuration or x_test_request changes, so only the transaction's own
+    fields are encoded for each request.
+    """
+    
+    def __init__(self, x_login, x_tran_key, x_test_request=True):
+        self.post_url = 'https://secure.authorize.net/gateway/transact.dll'
+        self.x_test_request = x_test_request
+        self.transport = default_transport()
+        self.worker_pool = worker_pool
+        self.timeout = None
+        self.retry_policy = None
+        self.circuit_breaker = None
+        self.journal = None
+        self.recorder = None
+        self.rate_limiter = None
+        self.concurrency_limiter = None
+        self.observers = []
+        self.profiler = None
+        self.prescreen = None
+        self.velocity_filter = None
+        self.transaction_cache = None
+        self.settlement_cutoff = None
+        self.configuration = Configuration({
+                'x_login' : x_login,
+                'x_tran_key' : x_tran_key,
+                'x_version' : '3.1',
+                'x_relay_response' : 'FALSE',
+                'x_delim_data' : 'TRUE',
+                'x_delim_char' : '|',
+                'x_method': 'CC',
+        })
+        self._encoded_configuration = None
+    
+    def _get_connection_pool(self):
+        return self.transport
+    
+    def _set_connection_pool(self, pool):
+        if pool is None:
+            pool = UrllibTransport()
+        self.transport = pool
+    
+    # Older name of transport; setting it to None opens a new connection
+    # for every request.
+    connection_pool = property(_get_connection_pool, _set_connection_pool)
+    
+    def submit(self, transaction, timeout=None):
+        """Process a Transaction.
+        
+        Args:
+            transaction: The Transaction to process.
+            timeout: Optional seconds the request may take, overriding the
+                gateway's timeout.
+        
+        Returns:
+            The gateway's Response.
+        
+        Raises:
+            ValueError if the prescreen rejects an authorization's card, or
+            VelocityExceeded if the velocity filter does.
+        """
+        
+        if self.profiler is not None:
+            return self.profiler.call(transaction.type,
+                    self._submit_transaction, transaction, timeout)
+        return self._submit_transaction(transaction, timeout)
+    
+    def _submit_transaction(self, transaction, timeout):
+        """submit() without the profiler."""
+        
+        if transaction.type in ('AUTH_ONLY', 'AUTH_CAPTURE'):
+            if self.prescreen is not None:
+                self.prescreen.check(transaction.get('x_card_num'),
+                        transaction.get('x_exp_date'))
+            if self.velocity_filter is not None:
+                self.velocity_filter.check(transaction)
+        return self._submit(transaction.fields, timeout)
+    
+    def submit_async(self, transaction, callback=None, timeout=None):
+        """Process a Transaction on the worker pool.
+        
+        Returns:
+            A PendingTransaction whose result() is the Response.
+        """
+        
+        pending = self.worker_pool.submit(self.submit, transaction, timeout)
+        if callback:
+            pending.add_done_callback(callback)
+        return pending
+    
+    def _submit(self, transaction_data, timeout):
+        """Post transaction_data to the gateway and parse the response."""
+        
+        if timeout is None:
+            timeout = self.timeout
+        recorder = self.recorder
+        if recorder is not None:
+            started = time.time()
+        try:
+            if self.retry_policy is not None:
+                response = self._submit_retrying(transaction_data, timeout)
+            else:
+                response = self._submit_once(transaction_data, timeout)
+        except Exception, error:
+            if recorder is not None:
+                recorder.record(transaction_data, started, error=error)
+            raise
+        if recorder is not None:
+            recorder.record(transaction_data, started, response)
+        
+        if self.transaction_cache is not None and response.is_approved:
+            self._remember(transaction_data, response)
+        return response
+    
+    def _submit_once(self, transaction_data, timeout):
+        """Make one attempt at posting transaction_data."""
+        
+        if self.rate_limiter is not None:
+            started = time.time()
+            if not self.rate_limiter.acquire(self.configuration['x_login'],
+                    timeout=timeout):
+                raise RateLimited, 'No request token within the timeout.'
+            if timeout is not None:
+                timeout -= time.time() - started
+                if timeout <= 0:
+                    raise RateLimited, 'No time left after getting a token.'
+        
+        journal = self.journal
+        if journal is None:
+            return self._exchange_limited(transaction_data, timeout)
+        
+        request_id = journal.log_request(transaction_data)
+        try:
+            response = self._exchange_limited(transaction_data, timeout)
+        except Exception, error:
+            journal.log_error(request_id, error)
+            raise
+        journal.log_response(request_id, response)
+        return response
+    
+    def _exchange_limited(self, transaction_data, timeout):
+        """_exchange() once the concurrency limiter lets it through."""
+        
+        limiter = self.concurrency_limiter
+        if limiter is None:
+            return self._exchange(transaction_data, timeout)
+        
+        waited = time.time()
+        started = limiter.acquire(timeout)
+        if started is None:
+            raise ConcurrencyLimited, 'No turn to send within the timeout.'
+        if timeout is not None:
+            timeout -= started - waited
+            if timeout <= 0:
+                limiter.cancel()
+                raise ConcurrencyLimited, 'No time left after the wait.'
+        try:
+            response = self._exchange(transaction_data, timeout)
+        except Exception, error:
+            limiter.release(started, error=error)
+            raise
+        limiter.release(started, response=response)
+        return response
+    
+    def _exchange(self, transaction_data, timeout):
+        """Post transaction_data and parse the response."""
+        
+        if self.observers:
+            return self._submit_observed(transaction_data, timeout)
+        
+        encoded_post_data = self._encode(transaction_data)
+        response_string = self._send(encoded_post_data, timeout)
+        return self._parse(response_string)
+    
+    def _submit_retrying(self, transaction_data, timeout):
+        """_submit_once() retried as the retry policy allows."""
+        
+        policy = self.retry_policy
+        transaction_type = _field(transaction_data, 'x_type')
+        if transaction_type in ('PRIOR_AUTH_CAPTURE', 'VOID'):
+            is_repeatable = True
+        elif _field(transaction_data, 'x_invoice_num'):
+            is_repeatable = True
+            if (_field(transaction_data, 'x_duplicate_window') is None
+                    and 'x_duplicate_window' not in self.configuration):
+                if hasattr(transaction_data, 'items'):
+                    transaction_data = transaction_data.items()
+                transaction_data = list(transaction_data) + [
+                        ('x_duplicate_window', policy.duplicate_window)]
+        else:
+            is_repeatable = False
+        
+        started = time.time()
+        attempt = 1
+        may_have_sent = False
+        while True:
+            attempt_timeout = policy.budget - (time.time() - started)
+            if timeout is not None:
+                attempt_timeout = min(timeout, attempt_timeout)
+            
+            try:
+                response = self._submit_once(transaction_data,
+                        attempt_timeout)
+            except Exception, error:
+                if not policy.is_transient(error) or not (
+                        is_repeatable or policy.is_unsent(error)):
+                    raise
+                failure = sys.exc_info()
+                may_have_sent = may_have_sent or not policy.is_unsent(error)
+            else:
+                if (may_have_sent and response.response_code == '3'
+                        and response.reason_code == '11'
+                        and response.approval_code):
+                    # An earlier attempt went through after all; this is
+                    # the gateway's answer about that one.
+                    return _original_approval(response)
+                if (response.response_code != '3' or response.reason_code
+                        not in policy.retry_reason_codes):
+                    return response
+                failure = None
+                error = response
+            
+            delay = policy.delay(attempt)
+            if (attempt >= policy.max_attempts
+                    or time.time() + delay - started >= policy.budget):
+                if failure is not None:
+                    raise failure[0], failure[1], failure[2]
+                return response
+            
+            self._notify('on_retry', transaction_type, attempt, error)
+            time.sleep(delay)
+            attempt += 1
+    
+    def _remember(self, transaction_data, response):
+        """Record an approved transaction in the transaction cache."""
+        
+        transaction_type = _field(transaction_data, 'x_type')
+        if transaction_type in ('AUTH_ONLY', 'AUTH_CAPTURE'):
+            card_num = str(_field(transaction_data, 'x_card_num'))
+            self.transaction_cache.put(TransactionRecord(response.trans_id,
+                    transaction_type,
+                    response.amount or _field(transaction_data, 'x_amount'),
+                    card_num[-4:], time.time()))
+        elif transaction_type in ('PRIOR_AUTH_CAPTURE', 'VOID'):
+            trans_id = _field(transaction_data, 'x_trans_id')
+            record = self.transaction_cache.get(trans_id)
+            if record is not None:
+                self.transaction_cache.put(record._replace(
+                        type=transaction_type,
+                        amount=response.amount or record.amount,
+                        timestamp=time.time()))
+    
+    def _submit_observed(self, transaction_data, timeout):
+        """_submit() that reports to the observers."""
+        
+        transaction_type = _field(transaction_data, 'x_type')
+        started = time.time()
+        try:
+            encoded_post_data = self._encode(transaction_data)
+            encoded = time.time()
+            self._notify('on_phase', transaction_type, 'encoding',
+                    encoded - started)
+            
+            response_string = self._send(encoded_post_data, timeout)
+            sent = time.time()
+            self._notify('on_phase', transaction_type, 'network',
+                    sent - encoded)
+            
+            response = self._parse(response_string)
+            # Responses are split lazily; count the split as parsing.
+            response.response_code
+        except Exception, error:
+            self._notify('on_error', transaction_type, error,
+                    time.time() - started)
+            raise
+        
+        parsed = time.time()
+        self._notify('on_phase', transaction_type, 'parsing', parsed - sent)
+        self._notify('on_response', transaction_type, response,
+                len(encoded_post_data), len(response_string),
+                parsed - started)
+        return response
+    
+    def _notify(self, event, *args):
+        """Call the event method of every observer."""
+        
+        for observer in self.observers:
+            try:
+                getattr(observer, event)(*args)
+            except Exception:
+                logger.exception('Observer %r failed on %s.', observer, event)
+    
+    def _send(self, encoded_post_data, timeout):
+        """Post the encoded data to the gateway and return its response."""
+        
+        if self.circuit_breaker is not None:
+            return self.circuit_breaker.call(self._transmit,
+                    encoded_post_data, timeout)
+        return self._transmit(encoded_post_data, timeout)
+    
+    def _transmit(self, encoded_post_data, timeout):
+        """_send() without the circuit breaker."""
+        
+        return self.transport.request(self.post_url, encoded_post_data,
+                timeout)
+    
+    def _parse(self, response_string):
+        """Return the Response for a gateway response string."""
+        
+        return Response(response_string, self.configuration['x_delim_char'],
+                self.configuration.get('x_encap_char', ''))
+    
+    def _encode(self, transaction_data):
+        """Encode the configuration and transaction_data for posting.
+        
+        transaction_data may be a dictionary or a sequence of (name, value)
+        pairs.
+        """
+        
+        if hasattr(transaction_data, 'iteritems'):
+            transaction_data = transaction_data.iteritems()
+        
+        post_list = [self._encode_configuration()]
+        for name, value in transaction_data:
+            encoded_name = _ENCODED_NAMES.get(name)
+            if encoded_name is None:
+                encoded_name = '%s=' % quote_plus(str(name))
+            post_list.append(encoded_name + quote_plus(str(value)))
+        
+        return '&'.join(post_list)
+    
+    def _encode_configuration(self):
+        """Return the encoded configuration, encoding it if it changed.
+        
+        A configuration replaced by a plain dictionary can't tell when it
+        changes, so it is encoded every time.
+        """
+        
+        configuration = self.configuration
+        version = getattr(configuration, 'version', None)
+        cached = self._encoded_configuration
+        if (cached is not None and version is not None
+                and cached[0] is configuration and cached[1] == version
+                and cached[2] == self.x_test_request):
+            return cached[3]
+        
+        post_data = dict(configuration)
+        post_data['x_test_request'] = str(self.x_test_request)
+        encoded = urlencode(post_data)
+        self._encoded_configuration = (configuration, version,
+                self.x_test_request, encoded)
+        return encoded
+
+
+def _field(transaction_data, name):
+    """Return a field of a dictionary or sequence of (name, value) pairs."""
+    
+    if hasattr(transaction_data, 'get'):
+        return transaction_data.get(name)
+    for field_name, value in transaction_data:
+        if field_name == name:
+            return value
+
+
+def _observe_validation(transaction_type):
+    """Report the time a PaymentProcessor setup method takes to observers.
+    
+    A ValueError raised by the setup method is reported as an error. Calls
+    are also sampled by the processor's profiler.
+    """
+    
+    def decorator(setup):
+        @functools.wraps(setup)
+        def observed_setup(self):
+            if self.profiler is not None:
+                return self.profiler.call_setup(transaction_type,
+                        _observe_setup, self, setup, transaction_type)
+            if not self.observers:
+                return setup(self)
+            return _observe_setup(self, setup, transaction_type)
+        
+        return observed_setup
+    
+    return decorator
+
+
+def _observe_setup(processor, setup, transaction_type):
+    """Run a setup method, reporting to the processor's observers."""
+    
+    if not processor.observers:
+        return setup(processor)
+    
+    started = time.time()
+    try:
+        result = setup(processor)
+    except Exception, error:
+        processor._notify('on_error', transaction_type, error,
+                time.time() - started)
+        raise
+    
+    processor._notify('on_phase', transaction_type, 'validation',
+            time.time() - started)
+    return result
+
+
+# Encoded "name=" prefixes of the transaction fields this module sends.
+_ENCODED_NAMES = dict((name, '%s=' % name) for name in (
+        'x_type', 'x_trans_id', 'x_card_num', 'x_exp_date', 'x_amount',
+        'x_address', 'x_zip', 'x_card_code', 'x_invoice_num', 'x_first_name',
+        'x_last_name', 'x_customer_id', 'x_description', 'amount'))
+
+
+class PaymentProcessor(Gateway):
     """Process payments using Authorize.net AIM gateway.
     
     To initialize you must pass your x_login and x_tran_key:
@@ -50,24 +3758,39 @@ class PaymentProcessor(object):
     enable production mode by passing x_test_request=False:
     >>> p = PaymentProcessor(x_login='abcdef', x_tran_key='abc123',
     ...         x_test_request=True)
+    
+    Outside of App Engine, requests are sent over the module-level
+    connection_pool, so kept-alive connections to the gateway are shared
+    between processors. Set transport to another Transport to change
+    that for one processor, or the module-level transport for all of them.
+    
+    Timings and outcomes of transactions are reported to the Observers in
+    the observers list, e.g. a MetricsAggregator. Set profiler to a
+    Profiler to see where the CPU time of a sample of them goes.
+    
+    Set prescreen to a CardPrescreen to reject mistyped and expired cards
+    without a round trip to the gateway, and velocity_filter to a
+    VelocityFilter to reject card testing.
+    
+    Set transaction_cache to a MemoryTransactionCache or
+    ShelveTransactionCache, and settlement_cutoff to the datetime.time the
+    merchant's batches close, to let process_void_or_credit() send a
+    credit straight away for transactions that have settled.
+    
+    process_async() sends the transaction from the module-level worker_pool
+    instead of blocking the calling thread:
+    >>> p.auth_and_capture()
+    >>> pending = p.process_async(timeout=10)
+    >>> is_processed = pending.result()
+    
+    A PaymentProcessor holds the state of one transaction at a time; use a
+    Gateway and Transactions to share one client between threads.
     """
     
     def __init__(self, x_login, x_tran_key, x_test_request=True):
-        # Configuration
-        self.post_url = 'https://secure.authorize.net/gateway/transact.dll'
-        self.x_test_request = x_test_request
-        self.urllib = urllib2
+        Gateway.__init__(self, x_login, x_tran_key, x_test_request)
         self.is_avs_required = False
         self.is_ccv_required = False
-        self.configuration = {
-                'x_login' : x_login,
-                'x_tran_key' : x_tran_key,
-                'x_version' : '3.1',
-                'x_relay_response' : 'FALSE',
-                'x_delim_data' : 'TRUE',
-                'x_delim_char' : '|',
-                'x_method': 'CC',
-        }
         
         # Variable initialization
         self.transaction = None
@@ -91,19 +3814,23 @@ class PaymentProcessor(object):
         self.avs_response = None
         self.trans_id = None
         self.ccv_response = None
+        self.response = None
         
+    @_observe_validation('AUTH_ONLY')
     def auth_only(self):
         """Setup to process an authorization only."""
         
         self._auth()
         self.transaction_data['x_type'] = 'AUTH_ONLY'
         
+    @_observe_validation('AUTH_CAPTURE')
     def auth_and_capture(self):
         """Setup to process an authorization and immediate capture."""
         
         self._auth()
         self.transaction_data['x_type'] = 'AUTH_CAPTURE'
         
+    @_observe_validation('PRIOR_AUTH_CAPTURE')
     def prior_auth_capture(self):
         """Setup to process a previously authorized transaction."""
         
@@ -115,12 +3842,14 @@ class PaymentProcessor(object):
         else:
             self.transaction_data['amount'] = None
             
+    @_observe_validation('VOID')
     def void(self):
         """Setup for a void transaction."""
         
         self.transaction_data['x_type'] = 'VOID'
         self.transaction_data['x_trans_id'] = self._transaction()
         
+    @_observe_validation('CREDIT')
     def credit(self):
         """Setup for a credit transaction."""
         
@@ -130,147 +3859,146 @@ class PaymentProcessor(object):
         self.transaction_data['x_amount'] = self._amount()
         
     def process_void_or_credit(self):
-        """Attempt a void and process a full credit if not possible."""
+        """Attempt a void and process a full credit if not possible.
         
-        self.void()
-        is_processed = self.process()
-        if not is_processed:
-            self.credit()
-            is_processed = self.process()
-            transaction_type = 'Credit'
+        With a transaction_cache and settlement_cutoff set, a transaction
+        this library captured is credited first if it has probably settled,
+        and voided only if the credit fails. card_num and amount default to
+        the last four digits and amount of the cached transaction.
+        
+        Returns:
+            (is_processed, transaction_type) of the last request sent,
+            transaction_type being 'Void' or 'Credit'.
+        """
+        
+        record = None
+        if self.transaction_cache is not None and self.transaction:
+            record = self.transaction_cache.get(self._transaction())
+        
+        if record is not None:
+            if not self.card_num:
+                self.card_num = record.last_four
+            if not self.amount:
+                self.amount = record.amount
+        
+        if (record is not None and self.settlement_cutoff is not None
+                and predict_settled(record, self.settlement_cutoff)):
+            attempts = ((self.credit, 'Credit'), (self.void, 'Void'))
         else:
-            transaction_type = 'Void'
+            attempts = ((self.void, 'Void'), (self.credit, 'Credit'))
+        
+        for setup, transaction_type in attempts:
+            self.transaction_data = {}
+            setup()
+            is_processed = self.process()
+            if is_processed:
+                break
             
         return (is_processed, transaction_type)
         
-    def process(self):
+    def process_async(self, callback=None, timeout=None):
+        """Process the transaction on the worker pool.
+        
+        Don't change or reuse the processor until the transaction is done;
+        its response attributes are set just as process() would set them.
+        
+        Args:
+            callback: Optional callable passed the PendingTransaction once
+                it is done.
+            timeout: Optional seconds the request may take, overriding the
+                processor's timeout.
+        
+        Returns:
+            A PendingTransaction whose result() is what process() returned.
+        """
+        
+        pending = self.worker_pool.submit(self.process, timeout)
+        if callback:
+            pending.add_done_callback(callback)
+        return pending
+    
+    def process(self, timeout=None):
         """Actually process the transaction.
         
+        The gateway's full Response is kept in the response attribute.
+        
+        Args:
+            timeout: Optional seconds the request may take, overriding the
+                processor's timeout.
+        
         Returns:
             True if the transaction was successful.
             False in every other case.
         """
         
-        # Set transaction type
-        self.configuration['x_test_request'] = str(self.x_test_request)
-        post_list = ([urlencode(self.configuration),
-                      urlencode(self.transaction_data)])
-        encoded_post_data = '&'.join(post_list)
+        if self.profiler is not None:
+            return self.profiler.call(self.transaction_data.get('x_type'),
+                    self._process, timeout)
+        return self._process(timeout)
+    
+    def _process(self, timeout):
+        """process() without the profiler."""
         
-        if APPENGINE:
-            response = urlfetch.fetch(url=self.post_url, method=urlfetch.POST,
-                    payload=encoded_post_data, deadline=10)
-            response_string = response.content
-        else:
-            request = self.urllib.Request(url=self.post_url,
-                    data=encoded_post_data)
-            response = self.urllib.urlopen(request)
-            response_string = response.read()
+        response = self._submit(self.transaction_data, timeout)
         
-        response_list = response_string.split(
-                self.configuration['x_delim_char'])
-                
-        self.response_code = response_list[0]
-        self.reason_code = response_list[2]
-        self.reason_text = response_list[3]
-        self.approval_code = response_list[4]
-        self.avs_response = response_list[5]
-        self.trans_id = response_list[6]
-        self.ccv_response = response_list[39]
-        
-        if str(self.response_code) == '1':
-            return True
-        else:
-            return False
-            
+        self.response = response
+        self.response_code = response.response_code
+        self.reason_code = response.reason_code
+        self.reason_text = response.reason_text
+        self.approval_code = response.approval_code
+        self.avs_response = response.avs_response
+        self.trans_id = response.trans_id
+        self.ccv_response = response.ccv_response
+        
+        return response.is_approved
+    
+    def validation_errors(self, transaction_type):
+        """Return every validation error of the transaction, by field.
+        
+        Unlike the setup methods, which raise ValueError on the first
+        invalid field, this checks all of them; see validation_errors().
+        """
+        
+        return validation_errors(transaction_type, self.card_num,
+                self.exp_date, self.amount, self.transaction, self.card_code,
+                self.address, self.zip, self.is_avs_required,
+                self.is_ccv_required)
+    
     def _transaction(self):
         """Validate the transaction id and return it if successful."""
-        if not self.transaction:
-            raise ValueError, 'transaction is required.'
-        elif not re.search('^\d+$', self.transaction):
-            raise ValueError, ('Invalid transaction format. %s'
-                               % self.transaction)
-        else:
-            return self.transaction
+        return _valid_transaction(self.transaction)
     
     def _address(self):
         """Validate the address and return it if successful."""
-        if not self.address:
-            raise ValueError, 'address is required.'
-        elif not re.search("^[\w\d'/&#,.\- ]{1,60}$", self.address):
-            raise ValueError, 'Invalid address format. %s' % self.address
-        else:
-            return self.address
+        return _valid_address(self.address)
     
     def _zip(self):
         """Validate the zip code and return it if successful."""
-        if not self.zip:
-            raise ValueError, 'zip is required.'
-        elif not re.search('^\d{5}$|^\d{9}$', str(self.zip)):
-            raise ValueError, 'Invalid zip format. %s' % str(self.zip)
-        else:
-            return str(self.zip)
+        return _valid_zip(self.zip)
     
     def _card_num_last_four(self):
         """Validate the credit card last four and return it if successful."""
-        if not self.card_num:
-            raise ValueError, 'card_num is required.'
-        elif not re.search('^\d{4}$|^\d{13,16}$', str(self.card_num)):
-            raise ValueError, ('Invalid card_num_last_four format. %s'
-                               % str(self.card_num))
-        else:
-            return str(self.card_num)
+        return _valid_card_num_last_four(self.card_num)
     
     def _card_num(self):
         """Validate the credit card number and return it if successful."""
-        if not self.card_num:
-            raise ValueError, 'card_num is required'
-        elif not re.search('^\d{13,16}$', str(self.card_num)):
-            raise ValueError, 'Invalid card_num format. %s' % self.card_num
-        else:
-            return str(self.card_num)
+        return _valid_card_num(self.card_num)
     
     def _card_num_or_last_four(self):
         """Is this the full card_num or just the last four?"""
-        if not self.card_num:
-            raise ValueError, 'card_num is required'
-        elif len(self.card_num) == 4:
-            card_num = self._card_num_last_four()
-        else:
-            card_num = self._card_num()
-            
-        return card_num
+        return _valid_card_num_or_last_four(self.card_num)
     
     def _card_code(self):
         """Validate the card code and return it if successful."""
-        if not self.card_code:
-            raise ValueError, 'card_code is required.'
-        elif not re.search('^\d{3,4}$', str(self.card_code)):
-            raise ValueError, 'Invalid card_code format. %s' % self.card_code
-        else:
-            return str(self.card_code)
+        return _valid_card_code(self.card_code)
     
     def _exp_date(self):
         """Validate the expiration date and return it if successful."""
-        expiration_string = ('^[0-1]{1}[0-9]{1}[-/]{0,1}[0-9]{2}$'
-                             '|^[0-1]{1}[0-o{1}][-/]{0,1}20[0-9]{2}$')
-        if not self.exp_date:
-            raise ValueError, 'exp_date is required.'
-        elif not re.search(expiration_string, str(self.exp_date)):
-            raise ValueError, 'Invalid exp_date format. %s' % self.exp_date
-        else:
-            return self.exp_date
+        return _valid_exp_date(self.exp_date)
     
     def _amount(self):
         """Validate the amount and return it if successful."""
-        
-        if not self.amount:
-            raise ValueError, 'amount is required'
-        else:
-            # Authorize.net will take anything that can be float-ed
-            float(self.amount)
-        
-        return self.amount
+        return _valid_amount(self.amount)
     
     def _auth(self):
         """Setup to process an authorization."""
@@ -279,6 +4007,10 @@ class PaymentProcessor(object):
         self.transaction_data['x_exp_date'] = self._exp_date()
         self.transaction_data['x_amount'] = self._amount()
         
+        if self.prescreen is not None:
+            self.prescreen.check(self.transaction_data['x_card_num'],
+                    self.transaction_data['x_exp_date'])
+        
         if self.is_avs_required:
             self.transaction_data['x_address'] = self._address()
             self.transaction_data['x_zip'] = self._zip()
@@ -305,4 +4037,540 @@ class PaymentProcessor(object):
         
         if self.description:
             self.transaction_data['x_description'] = self.description
+        
+        if self.velocity_filter is not None:
+            self.velocity_filter.check(self.transaction_data)
+
+
+class MerchantRegistry(object):
+    """Configured Gateways for many merchant accounts, cached by x_login.
+    
+    Register each merchant's credentials once, with any configuration
+    overrides and Gateway attributes, such as limits, to give its client:
+    >>> registry = MerchantRegistry(max_size=200, idle_timeout=600)
+    >>> registry.register('abcdef', 'abc123', configuration={
+    ...         'x_delim_char': ','}, hot=True,
+    ...         rate_limiter=RateLimiter(rate=20))
+    >>> response = registry.gateway('abcdef').submit(transaction)
+    >>> p = registry.processor('abcdef')
+    
+    A merchant's Gateway is built on first use and kept, with its own
+    ConnectionPool of pool_size connections, so later requests reuse its
+    encoded configuration and kept-alive connections. Passing
+    x_test_request in configuration sets the gateway's x_test_request.
+    
+    At most max_size gateways are kept. The least recently used one is
+    dropped, and its connections closed, to make room for another, and
+    gateways unused for idle_timeout seconds are dropped as well. A
+    transport given to register() is shared, so it is left open. Hot
+    merchants are never dropped, and warm() opens their connections ahead
+    of their first request.
+    """
+    
+    # Gateway attributes a merchant's processors share with its gateway,
+    # besides any set by register().
+    SHARED_ATTRIBUTES = ('post_url', 'transport', 'worker_pool', 'timeout',
+            'retry_policy', 'circuit_breaker', 'journal', 'recorder',
+            'rate_limiter', 'concurrency_limiter', 'profiler', 'prescreen',
+            'velocity_filter', 'transaction_cache', 'settlement_cutoff')
+    
+    def __init__(self, max_size=100, idle_timeout=600, pool_size=4):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.pool_size = pool_size
+        self.stats = {
+                'hits' : 0,
+                'misses' : 0,
+                'evictions' : 0,
+        }
+        self._merchants = {}
+        self._gateways = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._gateways)
+    
+    def register(self, x_login, x_tran_key, x_test_request=True,
+                 configuration=None, hot=False, **attributes):
+        """Register a merchant, replacing any registration of its x_login.
+        
+        Args:
+            x_login: The merchant's API login id.
+            x_tran_key: Its transaction key.
+            x_test_request: Whether its requests are test requests.
+            configuration: Optional dictionary of configuration overrides,
+                e.g. {'x_delim_char': ','}.
+            hot: Keep the merchant's gateway and warm it up.
+            attributes: Gateway attributes to set, e.g. timeout,
+                retry_policy, rate_limiter or concurrency_limiter.
+        """
+        
+        configuration = dict(configuration or {})
+        if 'x_test_request' in configuration:
+            x_test_request = configuration.pop('x_test_request')
+        
+        self._lock.acquire()
+        try:
+            self._merchants[x_login] = (x_tran_key, x_test_request,
+                    configuration, hot, attributes)
+            dropped = self._gateways.pop(x_login, None)
+        finally:
+            self._lock.release()
+        
+        if dropped is not None:
+            _close_pool(dropped[2])
+    
+    def gateway(self, x_login):
+        """Return the Gateway of a merchant, building it if need be.
+        
+        Raises:
+            KeyError if the merchant isn't registered.
+        """
+        
+        now = time.time()
+        dropped = []
+        self._lock.acquire()
+        try:
+            entry = self._gateways.pop(x_login, None)
+            if entry is None:
+                self.stats['misses'] += 1
+                gateway, pool = self._build(x_login)
+            else:
+                self.stats['hits'] += 1
+                gateway, last_used, pool = entry
+            self._gateways[x_login] = (gateway, now, pool)
+            dropped = self._evict(now)
+        finally:
+            self._lock.release()
+        
+        for pool in dropped:
+            _close_pool(pool)
+        return gateway
+    
+    def processor(self, x_login):
+        """Return a new PaymentProcessor set up like the merchant's Gateway.
+        
+        The processor shares the gateway's transport, limits and other
+        attributes, but gets a copy of its configuration and observers, so
+        changing them for one processor doesn't change them for the others.
+        """
+        
+        gateway = self.gateway(x_login)
+        processor = PaymentProcessor(x_login,
+                gateway.configuration['x_tran_key'], gateway.x_test_request)
+        processor.configuration.update(gateway.configuration)
+        processor.observers = list(gateway.observers)
+        
+        self._lock.acquire()
+        try:
+            attributes = self._merchants[x_login][4]
+        finally:
+            self._lock.release()
+        for name in self.SHARED_ATTRIBUTES + tuple(attributes):
+            if name != 'observers':
+                setattr(processor, name, getattr(gateway, name))
+        return processor
+    
+    def warm(self, timeout=10):
+        """Open the connections of every hot merchant.
+        
+        Merchants are warmed concurrently on the worker pool. Failures are
+        logged, since a cold connection only makes the first request slower.
+        
+        Returns:
+            The number of connections opened.
+        """
+        
+        self._lock.acquire()
+        try:
+            hot = [x_login for x_login, merchant in self._merchants.items()
+                   if merchant[3]]
+        finally:
+            self._lock.release()
+        
+        pending = []
+        for x_login in hot:
+            gateway = self.gateway(x_login)
+            pending.append((x_login, gateway.worker_pool.submit(
+                    gateway.transport.warm, gateway.post_url,
+                    self.pool_size, timeout)))
+        
+        opened = 0
+        for x_login, warming in pending:
+            try:
+                opened += warming.result()
+            except Exception:
+                logger.exception('Warming up merchant %s failed.', x_login)
+        return opened
+    
+    def clear(self):
+        """Drop every cached gateway and close its connections."""
+        
+        self._lock.acquire()
+        try:
+            gateways = self._gateways
+            self._gateways = collections.OrderedDict()
+        finally:
+            self._lock.release()
+        
+        for gateway, last_used, pool in gateways.values():
+            _close_pool(pool)
+    
+    def _build(self, x_login):
+        """Build the Gateway of a registered merchant.
+        
+        Returns:
+            A (gateway, pool) tuple, pool being the ConnectionPool built
+            for the gateway, or None if register() gave it a transport.
+        """
+        
+        x_tran_key, x_test_request, configuration, hot, attributes = (
+                self._merchants[x_login])
+        gateway = Gateway(x_login, x_tran_key, x_test_request)
+        pool = gateway.transport = ConnectionPool(maxsize=self.pool_size)
+        gateway.configuration.update(configuration)
+        for name, value in attributes.items():
+            setattr(gateway, name, value)
+        if gateway.transport is not pool:
+            pool = None
+        return (gateway, pool)
+    
+    def _evict(self, now):
+        """Drop idle and least recently used gateways, except hot ones.
+        
+        Returns:
+            The pools built for the dropped gateways, or None for those
+            given a transport, whose connections are to be closed.
+        """
+        
+        dropped = []
+        excess = len(self._gateways) - self.max_size
+        for x_login, (gateway, last_used, pool) in self._gateways.items():
+            if self._merchants[x_login][3]:
+                continue
+            if excess > 0 or now - last_used > self.idle_timeout:
+                del self._gateways[x_login]
+                dropped.append(pool)
+                self.stats['evictions'] += 1
+                excess -= 1
+        return dropped
+
+
+def _close_pool(pool):
+    """Close a ConnectionPool a MerchantRegistry built, if there is one."""
+    
+    if pool is not None:
+        pool.close()
+
+
+def _auth_fields(card_num, exp_date, amount, card_code=None, address=None,
+                 zip=None, invoice_number=None, first_name=None,
+                 last_name=None, customer_id=None, description=None,
+                 is_avs_required=False, is_ccv_required=False):
+    """Validate an authorization and return its (name, value) fields."""
+    
+    fields = [
+            ('x_card_num', _valid_card_num(card_num)),
+            ('x_exp_date', _valid_exp_date(exp_date)),
+            ('x_amount', _valid_amount(amount)),
+    ]
+    
+    if is_avs_required or address:
+        fields.append(('x_address', _valid_address(address)))
+    if is_avs_required or zip:
+        fields.append(('x_zip', _valid_zip(zip)))
+    if is_ccv_required or card_code:
+        fields.append(('x_card_code', _valid_card_code(card_code)))
+    
+    for name, value in (('x_invoice_num', invoice_number),
+                        ('x_first_name', first_name),
+                        ('x_last_name', last_name),
+                        ('x_customer_id', customer_id),
+                        ('x_description', description)):
+        if value:
+            fields.append((name, value))
+    
+    return fields
+
+
+def validation_errors(transaction_type, card_num=None, exp_date=None,
+                      amount=None, transaction=None, card_code=None,
+                      address=None, zip=None, is_avs_required=False,
+                      is_ccv_required=False):
+    """Validate a whole transaction and return every error at once.
+    
+    The fields are checked as the PaymentProcessor setup method or
+    Transaction constructor of transaction_type would check them, but
+    instead of raising on the first invalid field, all of them are
+    reported:
+    >>> validation_errors('AUTH_CAPTURE', card_num='42', amount='12.00')
+    {'card_num': 'Invalid card_num format. 42',
+     'exp_date': 'exp_date is required.'}
+    
+    Returns:
+        Dictionary of error messages by field name, empty if the
+        transaction is valid.
+    
+    Raises:
+        ValueError if transaction_type isn't known.
+    """
+    
+    rules = _TRANSACTION_RULES.get(transaction_type)
+    if rules is None:
+        raise ValueError, 'Invalid transaction type. %s' % transaction_type
+    
+    values = {
+            'card_num' : card_num,
+            'exp_date' : exp_date,
+            'amount' : amount,
+            'transaction' : transaction,
+            'card_code' : card_code,
+            'address' : address,
+            'zip' : zip,
+    }
+    errors = {}
+    for name, validate, required in rules:
+        value = values[name]
+        if not value and not (required is True
+                or required == 'avs' and is_avs_required
+                or required == 'ccv' and is_ccv_required):
+            continue
+        try:
+            validate(value)
+        except ValueError, error:
+            errors[name] = str(error)
+    return errors
+
+
+def screen_columns(transaction_type, columns, is_avs_required=False,
+                   is_ccv_required=False):
+    """Validate a column-oriented batch of transactions.
+    
+    columns maps field names, as taken by validation_errors(), to
+    sequences holding the field of every record; missing columns count as
+    empty. Sequences may be lists, or NumPy string arrays whose digit-only
+    fields are checked with vectorized operations, so that only the records
+    failing them are looked at one by one:
+    >>> errors = screen_columns('CREDIT', {
+    ...         'transaction': numpy.array(['2149186775', 'x']),
+    ...         'card_num': numpy.array(['1111', '1111']),
+    ...         'amount': numpy.array(['12.00', '3.50'])})
+    >>> errors
+    {1: {'transaction': 'Invalid transaction format. x'}}
+    
+    Returns:
+        Dictionary of validation_errors() by record index, for the invalid
+        records only.
+    """
+    
+    rules = _TRANSACTION_RULES.get(transaction_type)
+    if rules is None:
+        raise ValueError, 'Invalid transaction type. %s' % transaction_type
+    
+    size = max([len(column) for column in columns.values()] or [0])
+    errors = {}
+    for name, validate, required in rules:
+        column = columns.get(name)
+        is_required = (required is True
+                or required == 'avs' and is_avs_required
+                or required == 'ccv' and is_ccv_required)
+        if column is None:
+            if is_required:
+                for index in xrange(size):
+                    errors.setdefault(index, {})[name] = (
+                            '%s is required.' % name)
+            continue
+        
+        for index in _screen_candidates(validate, column):
+            value = column[index]
+            if not value and not is_required:
+                continue
+            try:
+                validate(value)
+            except ValueError, error:
+                errors.setdefault(index, {})[name] = str(error)
+    return errors
+
+
+def _screen_candidates(validate, column):
+    """Return the indexes of the values of column that may be invalid.
+    
+    NumPy string arrays of digit-only fields are screened in one go;
+    every other value is a candidate.
+    """
+    
+    lengths = _DIGIT_FIELD_LENGTHS.get(validate)
+    numpy = sys.modules.get('numpy')
+    if (lengths is None or numpy is None
+            or not isinstance(column, numpy.ndarray)
+            or column.dtype.kind not in 'SU' or not column.dtype.itemsize):
+        return xrange(len(column))
+    
+    valid = numpy.char.isdigit(column)
+    if column.dtype.kind == 'U':
+        # unicode.isdigit() accepts digits of every script.
+        code_points = numpy.ascontiguousarray(column).view(numpy.uint32)
+        valid &= (code_points.reshape(len(column), -1) < 128).all(axis=1)
+    
+    column_lengths = numpy.char.str_len(column)
+    is_length_valid = numpy.zeros(len(column), dtype=bool)
+    for shortest, longest in lengths:
+        is_length_valid |= ((column_lengths >= shortest)
+                            & (column_lengths <= longest))
+    return numpy.flatnonzero(~(valid & is_length_valid))
+
+
+def _is_digits(value):
+    """Is value a non-empty str of the digits 0-9 only?"""
+    
+    # unicode.isdigit() accepts digits of every script.
+    return value.isdigit() and (value.__class__ is str
+                                or _DIGITS_PATTERN.match(value) is not None)
+
+
+_DIGITS_PATTERN = re.compile(r'[0-9]+\Z')
+_ADDRESS_PATTERN = re.compile(r"[\w\d'/&#,.\- ]{1,60}\Z")
+_EXP_DATE_PATTERN = re.compile(r'(?:0[1-9]|1[0-2])[-/]?(?:20)?[0-9]{2}\Z')
+
+
+def _valid_transaction(transaction):
+    """Validate a transaction id and return it if successful."""
+    if not transaction:
+        raise ValueError, 'transaction is required.'
+    elif not _is_digits(transaction):
+        raise ValueError, 'Invalid transaction format. %s' % transaction
+    else:
+        return transaction
+
+
+def _valid_address(address):
+    """Validate an address and return it if successful."""
+    if not address:
+        raise ValueError, 'address is required.'
+    elif not _ADDRESS_PATTERN.match(address):
+        raise ValueError, 'Invalid address format. %s' % address
+    else:
+        return address
+
+
+def _valid_zip(zip):
+    """Validate a zip code and return it if successful."""
+    if not zip:
+        raise ValueError, 'zip is required.'
+    zip = str(zip)
+    if len(zip) not in (5, 9) or not _is_digits(zip):
+        raise ValueError, 'Invalid zip format. %s' % zip
+    else:
+        return zip
+
+
+def _valid_card_num_last_four(card_num):
+    """Validate a credit card last four and return it if successful."""
+    if not card_num:
+        raise ValueError, 'card_num is required.'
+    card_num = str(card_num)
+    if (not (len(card_num) == 4 or 13 <= len(card_num) <= 16)
+            or not _is_digits(card_num)):
+        raise ValueError, 'Invalid card_num_last_four format. %s' % card_num
+    else:
+        return card_num
+
+
+def _valid_card_num(card_num):
+    """Validate a credit card number and return it if successful."""
+    if not card_num:
+        raise ValueError, 'card_num is required'
+    card_num = str(card_num)
+    if not 13 <= len(card_num) <= 16 or not _is_digits(card_num):
+        raise ValueError, 'Invalid card_num format. %s' % card_num
+    else:
+        return card_num
+
+
+def _valid_card_num_or_last_four(card_num):
+    """Validate a full card number or its last four digits."""
+    if not card_num:
+        raise ValueError, 'card_num is required'
+    elif len(card_num) == 4:
+        return _valid_card_num_last_four(card_num)
+    else:
+        return _valid_card_num(card_num)
+
+
+def _valid_card_code(card_code):
+    """Validate a card code and return it if successful."""
+    if not card_code:
+        raise ValueError, 'card_code is required.'
+    card_code = str(card_code)
+    if not 3 <= len(card_code) <= 4 or not _is_digits(card_code):
+        raise ValueError, 'Invalid card_code format. %s' % card_code
+    else:
+        return card_code
+
+
+def _valid_exp_date(exp_date):
+    """Validate an expiration date and return it if successful.
+    
+    Valid formats are MMYY, MMYYYY, MM/YY, MM-YY, MM/YYYY and MM-YYYY, with
+    YYYY in the 2000s.
+    """
+    if not exp_date:
+        raise ValueError, 'exp_date is required.'
+    elif not _EXP_DATE_PATTERN.match(str(exp_date)):
+        raise ValueError, 'Invalid exp_date format. %s' % exp_date
+    else:
+        return exp_date
+
+
+def _valid_amount(amount):
+    """Validate an amount and return it if successful."""
+    
+    if not amount:
+        raise ValueError, 'amount is required'
     
+    # Authorize.net will take anything that can be float-ed
+    try:
+        float(amount)
+    except (TypeError, ValueError):
+        raise ValueError, 'Invalid amount format. %s' % amount
+    
+    return amount
+
+
+# Field rules of each transaction type, as (name, validator, required)
+# triples; required is True, False (checked if given), or 'avs' / 'ccv'
+# for the fields required by is_avs_required / is_ccv_required.
+_AUTH_RULES = (
+        ('card_num', _valid_card_num, True),
+        ('exp_date', _valid_exp_date, True),
+        ('amount', _valid_amount, True),
+        ('address', _valid_address, 'avs'),
+        ('zip', _valid_zip, 'avs'),
+        ('card_code', _valid_card_code, 'ccv'),
+)
+_TRANSACTION_RULES = {
+        'AUTH_ONLY' : _AUTH_RULES,
+        'AUTH_CAPTURE' : _AUTH_RULES,
+        'PRIOR_AUTH_CAPTURE' : (
+                ('transaction', _valid_transaction, True),
+                ('amount', _valid_amount, False),
+        ),
+        'VOID' : (
+                ('transaction', _valid_transaction, True),
+        ),
+        'CREDIT' : (
+                ('transaction', _valid_transaction, True),
+                ('card_num', _valid_card_num_or_last_four, True),
+                ('amount', _valid_amount, True),
+        ),
+}
+
+# Allowed (shortest, longest) lengths of the digit-only fields, by
+# validator.
+_DIGIT_FIELD_LENGTHS = {
+        _valid_transaction : ((1, sys.maxint),),
+        _valid_zip : ((5, 5), (9, 9)),
+        _valid_card_num : ((13, 16),),
+        _valid_card_num_or_last_four : ((4, 4), (13, 16)),
+        _valid_card_code : ((3, 4),),
+}
@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+#Copyright (C) 2010 Analyte Media
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+#conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Batch runner for capture, void and refund jobs.
+
+Streams a CSV or JSON lines file of transactions through a Gateway with
+bounded concurrency, e.g.:
+    python -m pyauthorize_batch --type prior_auth_capture \
+            --checkpoint captures.checkpoint captures.csv results.jsonl
+
+Each row has a transaction id and, depending on the type, an amount and
+card number (the full number or its last four digits):
+    type,transaction,amount,card_num
+    credit,2149186775,12.00,1111
+
+The type column may be left out when --type is given. Results are written
+to the output file as they arrive, as JSON lines or, for a .csv output
+file, CSV. Answered rows carry the category of their reason code, e.g.
+'soft_decline', from pyauthorize.REASON_CODES.
+
+With --checkpoint, the runner records which rows have been sent, so a job
+that crashed or was stopped resumes where it left off when run again with
+the same arguments. Rows already answered, as the checkpoint and the
+output file tell, are not sent again. Rows that
+were in flight when the job stopped are sent again if they are captures
+or voids, which the gateway refuses to repeat, and reported with the
+status 'unknown' if they are credits, which could otherwise be refunded
+twice.
+"""
+
+__author__ = 'jordan.bouvier@analytemedia.com (Jordan Bouvier)'
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import pyauthorize
+
+
+# Transaction types the runner handles, as Transaction constructor names.
+TRANSACTION_TYPES = ('prior_auth_capture', 'void', 'credit')
+
+# Types the gateway refuses to process twice for the same transaction.
+REPEATABLE_TYPES = frozenset(['prior_auth_capture', 'void'])
+
+# Columns of the results, in CSV order.
+RESULT_FIELDS = ('row', 'type', 'transaction', 'amount', 'status',
+                 'response_code', 'reason_code', 'reason_text', 'trans_id',
+                 'error', 'category')
+
+
+class Checkpoint(object):
+    """Progress of a batch job, kept in a small JSON file.
+    
+    Every row before next_row has been answered, except the rows in
+    pending, which were sent without an answer being recorded yet. The
+    file is replaced atomically, and synced, before each row is sent, so
+    it stays readable if the job dies mid-write.
+    
+    Answers are recorded by the results in the output file rather than by
+    saving the checkpoint again. A finished row stays pending in the file
+    until commit() is called once its result is synced to disk, and rows
+    found in the output file are taken off pending by answered().
+    """
+    
+    def __init__(self, path, input_path):
+        self.path = path
+        self.input_path = os.path.abspath(input_path)
+        self.next_row = 1
+        self.pending = set()
+        self.in_doubt = frozenset()
+        self._unsynced = set()
+        
+        if path and os.path.exists(path):
+            checkpoint = open(path)
+            try:
+                state = json.load(checkpoint)
+            finally:
+                checkpoint.close()
+            if state['input'] != self.input_path:
+                raise ValueError, 'Checkpoint is for another input. %s' % (
+                        state['input'])
+            self.next_row = state['next_row']
+            # Rows in flight when the last run stopped may have been sent.
+            self.in_doubt = frozenset(state['pending'])
+            self.pending = set(self.in_doubt)
+    
+    def is_done(self, row):
+        """Was row answered by an earlier run?"""
+        
+        return row < self.next_row and row not in self.pending
+    
+    def start(self, row):
+        """Record that row is about to be sent."""
+        
+        self.pending.add(row)
+        self.next_row = max(self.next_row, row + 1)
+        self.save()
+    
+    def finish(self, row):
+        """Record that row's result has been written, but not synced."""
+        
+        self.pending.discard(row)
+        self._unsynced.add(row)
+        self.next_row = max(self.next_row, row + 1)
+    
+    def commit(self):
+        """Record that the results written so far are synced to disk."""
+        
+        self._unsynced.clear()
+    
+    def answered(self, rows):
+        """Take rows whose results are in the output file off pending."""
+        
+        rows = set(rows)
+        self.pending -= rows
+        self.in_doubt -= rows
+    
+    def save(self):
+        """Write the checkpoint file."""
+        
+        if not self.path:
+            return
+        
+        temporary_path = self.path + '.tmp'
+        checkpoint = open(temporary_path, 'w')
+        try:
+            json.dump({
+                    'input' : self.input_path,
+                    'next_row' : self.next_row,
+                    'pending' : sorted(self.pending | self._unsynced),
+            }, checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        finally:
+            checkpoint.close()
+        os.rename(temporary_path, self.path)
+
+
+def read_rows(path):
+    """Yield the rows of a CSV or JSON lines file as dictionaries.
+    
+    Files ending in .jsonl or .json hold one JSON object per line; any
+    other file is read as CSV with a header row. The file is read one row
+    at a time.
+    """
+    
+    rows = open(path, 'rb')
+    try:
+        if path.endswith(('.jsonl', '.json')):
+            for line in rows:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for row in csv.DictReader(rows):
+                yield row
+    finally:
+        rows.close()
+
+
+def build_transaction(row, transaction_type=None):
+    """Return the validated Transaction of a row.
+    
+    Raises:
+        ValueError if the row is invalid.
+    """
+    
+    transaction_type = (row.get('type') or transaction_type or '').lower()
+    transaction = _text(row.get('transaction'))
+    if transaction_type == 'prior_auth_capture':
+        return pyauthorize.Transaction.prior_auth_capture(transaction,
+                _text(row.get('amount')))
+    elif transaction_type == 'void':
+        return pyauthorize.Transaction.void(transaction)
+    elif transaction_type == 'credit':
+        return pyauthorize.Transaction.credit(transaction,
+                _text(row.get('card_num')), _text(row.get('amount')))
+    raise ValueError, 'Invalid type. %s' % transaction_type
+
+
+def run_batch(gateway, input_path, output_path, checkpoint_path=None,
+              transaction_type=None, max_concurrency=10, timeout=None,
+              sync_interval=1.0):
+    """Process every row of input_path through gateway.
+    
+    Args:
+        gateway: The Gateway to submit the transactions through.
+        input_path: CSV or JSON lines file of transactions.
+        output_path: File the results are appended to.
+        checkpoint_path: Optional file to record progress in, and resume
+            from if it exists.
+        transaction_type: Type of rows without a type column.
+        max_concurrency: Number of transactions sent at once.
+        timeout: Optional seconds each request may take.
+        sync_interval: Seconds between syncs of the output file. Results
+            are written as they arrive, but synced together; only the
+            checkpoint is synced before each row is sent.
+    
+    Returns:
+        Dictionary counting the rows by status: 'approved', 'declined',
+        'error', 'invalid', 'unknown' and 'skipped', the latter being rows
+        answered by an earlier run.
+    """
+    
+    checkpoint = Checkpoint(checkpoint_path, input_path)
+    if checkpoint.pending:
+        checkpoint.answered(_answered_rows(output_path))
+    counts = dict.fromkeys(('approved', 'declined', 'error', 'invalid',
+                            'unknown', 'skipped'), 0)
+    output = _ResultWriter(output_path, sync_interval)
+    rows = {}
+    
+    def transactions():
+        for row_number, row in enumerate(read_rows(input_path), 1):
+            if checkpoint.is_done(row_number):
+                counts['skipped'] += 1
+                continue
+            
+            result = {
+                    'row' : row_number,
+                    'type' : row.get('type') or transaction_type,
+                    'transaction' : row.get('transaction'),
+                    'amount' : row.get('amount'),
+            }
+            try:
+                transaction = build_transaction(row, transaction_type)
+            except ValueError, error:
+                result.update(status='invalid', error=str(error))
+            else:
+                if (row_number not in checkpoint.in_doubt
+                        or result['type'].lower() in REPEATABLE_TYPES):
+                    rows[transaction] = result
+                    checkpoint.start(row_number)
+                    yield transaction
+                    continue
+                result.update(status='unknown',
+                        error='May have been sent before the restart.')
+            
+            _finish(result, output, checkpoint, counts)
+    
+    try:
+        for transaction, response, error in pyauthorize.process_many(
+                transactions(), max_concurrency, timeout=timeout,
+                gateway=gateway):
+            result = rows.pop(transaction)
+            if error is not None:
+                result.update(status='error', error=str(error))
+            else:
+                if response.is_approved:
+                    result['status'] = 'approved'
+                else:
+                    result['status'] = 'declined'
+                result.update(response_code=response.response_code,
+                        reason_code=response.reason_code,
+                        reason_text=response.reason_text,
+                        trans_id=response.trans_id,
+                        category=response.category)
+            _finish(result, output, checkpoint, counts)
+    finally:
+        output.close()
+        checkpoint.commit()
+        checkpoint.save()
+    
+    return counts
+
+
+def _finish(result, output, checkpoint, counts):
+    """Write out the result of a row and mark it done."""
+    
+    if output.write(result):
+        checkpoint.commit()
+    checkpoint.finish(result['row'])
+    counts[result['status']] += 1
+
+
+def _answered_rows(path):
+    """Return the numbers of the rows with a result in an output file.
+    
+    A last line cut short by a crash is left out.
+    """
+    
+    if not os.path.exists(path):
+        return set()
+    
+    output = open(path, 'rb')
+    try:
+        lines = _complete_lines(output)
+        if path.endswith('.csv'):
+            results = csv.DictReader(lines)
+        else:
+            results = (json.loads(line) for line in lines if line.strip())
+        return set(int(result['row']) for result in results)
+    finally:
+        output.close()
+
+
+def _complete_lines(output):
+    """Yield the lines of output up to one without a line ending."""
+    
+    for line in output:
+        if not line.endswith('\n'):
+            return
+        yield line
+
+
+def _text(value):
+    """Return value as a string, or None if it is empty."""
+    
+    if value is None or value == '':
+        return None
+    return str(value)
+
+
+def _cut_torn_line(path):
+    """Truncate a file after its last complete line."""
+    
+    output = open(path, 'r+b')
+    try:
+        output.seek(0, os.SEEK_END)
+        start = max(output.tell() - 65536, 0)
+        output.seek(start)
+        tail = output.read()
+        if not tail.endswith('\n'):
+            output.truncate(start + tail.rfind('\n') + 1)
+    finally:
+        output.close()
+
+
+class _ResultWriter(object):
+    """Appends results to a JSON lines or CSV file.
+    
+    Each result is flushed, so it survives the job dying, and the file is
+    synced at most every sync_interval seconds, so that it survives the
+    machine dying. A last line cut short by a crash is cut off before
+    appending to the file.
+    """
+    
+    def __init__(self, path, sync_interval=1.0):
+        if os.path.exists(path):
+            _cut_torn_line(path)
+        is_new = not os.path.exists(path) or not os.path.getsize(path)
+        self.sync_interval = sync_interval
+        self._file = open(path, 'ab')
+        self._csv = None
+        self._last_sync = time.time()
+        if path.endswith('.csv'):
+            self._csv = csv.DictWriter(self._file, RESULT_FIELDS)
+            if is_new:
+                self._csv.writerow(dict(zip(RESULT_FIELDS, RESULT_FIELDS)))
+    
+    def write(self, result):
+        """Write a result.
+        
+        Returns:
+            True if the results written before it have been synced.
+        """
+        
+        is_synced = False
+        if time.time() - self._last_sync >= self.sync_interval:
+            self.sync()
+            is_synced = True
+        if self._csv is not None:
+            self._csv.writerow(result)
+        else:
+            self._file.write(json.dumps(result, sort_keys=True) + '\n')
+        self._file.flush()
+        return is_synced
+    
+    def sync(self):
+        """Sync the results written so far to disk."""
+        
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.time()
+    
+    def close(self):
+        try:
+            self.sync()
+        finally:
+            self._file.close()
+
+
+def main(args=None):
+    """Run a batch job from the command line."""
+    
+    parser = argparse.ArgumentParser(prog='python -m pyauthorize_batch',
+            description='Process a file of captures, voids or credits.')
+    parser.add_argument('input', help='CSV or JSON lines file to process')
+    parser.add_argument('output', help='file to append the results to')
+    parser.add_argument('--type', choices=TRANSACTION_TYPES,
+            help='type of rows without a type column')
+    parser.add_argument('--checkpoint',
+            help='file to record progress in and resume from')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--timeout', type=float,
+            help='seconds each request may take')
+    parser.add_argument('--url', help='gateway URL to post to')
+    parser.add_argument('--live', action='store_true',
+            help='send live transactions instead of test requests')
+    parser.add_argument('--login', default=os.environ.get('x_login'),
+            help='x_login, by default from the x_login variable')
+    parser.add_argument('--tran-key', default=os.environ.get('x_tran_key'),
+            help='x_tran_key, by default from the x_tran_key variable')
+    
+    options = parser.parse_args(args)
+    if not options.login or not options.tran_key:
+        parser.error('x_login and x_tran_key are required.')
+    
+    gateway = pyauthorize.Gateway(options.login, options.tran_key,
+            x_test_request=not options.live)
+    if options.url:
+        gateway.post_url = options.url
+    
+    counts = run_batch(gateway, options.input, options.output,
+            options.checkpoint, options.type, options.concurrency,
+            options.timeout)
+    print ', '.join('%d %s' % (counts[status], status) for status in (
+            'approved', 'declined', 'error', 'invalid', 'unknown',
+            'skipped'))
+    return counts['error'] + counts['unknown'] and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
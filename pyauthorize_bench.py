@@ -0,0 +1,732 @@
+#!/usr/bin/env python
+#Copyright (C) 2010 Analyte Media
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+#conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Benchmarks for PyAuthorize.
+
+Run from the command line, e.g.:
+    python -m pyauthorize_bench encode --iterations 100000
+    python -m pyauthorize_bench transport --requests 2000
+    python -m pyauthorize_bench velocity --keys 1000000
+    python -m pyauthorize_bench load --requests 5000 --concurrency 8 \
+            --mode processes --latency 0.05 --output results.json
+    python -m pyauthorize_bench replay traffic.gz --speed 10 --latency 0.2
+    python -m pyauthorize_bench profile --output profile.json \
+            --baseline profile-1.1.3.json
+
+The load benchmark drives auth_and_capture() and process() against a
+local FakeGateway (or any stub given with --url) and reports throughput,
+latency percentiles and the time spent validating, encoding, on the
+network and parsing. Its JSON output can be kept to compare releases.
+
+The transport benchmark posts the same transaction through each Transport
+in turn to compare their per-request overhead.
+
+The velocity benchmark times pyauthorize.VelocityFilter over many distinct
+cards and reports how often its fixed-size sketches reject one wrongly.
+
+The profile benchmark runs auth_and_capture() + process() under a
+pyauthorize.Profiler and prints the functions taking the most CPU time,
+or with --baseline, how they changed since an earlier --output.
+
+The replay benchmark sends traffic captured in production with a
+pyauthorize.TrafficRecorder again, at its original pacing or faster, to
+load a stub gateway with the real mix of transactions.
+"""
+
+__author__ = 'jordan.bouvier@analytemedia.com (Jordan Bouvier)'
+
+from urllib import urlencode
+import argparse
+import datetime
+import json
+import math
+import multiprocessing
+import platform
+import threading
+import time
+import timeit
+
+import pyauthorize
+import pyauthorize_testing
+
+
+# Phases each transaction's time is broken down into.
+PHASES = ('validation', 'encoding', 'network', 'parsing')
+
+
+def bench_encode(iterations=100000, repeat=3):
+    """Time encoding one request, before and after precompiled prefixes.
+    
+    Returns:
+        Dictionary of microseconds per request, keyed by method.
+    """
+    
+    gateway = pyauthorize.Gateway('abcdef', 'abc123')
+    transaction = pyauthorize.Transaction.auth_and_capture(
+            '4111111111111111', '1220', '12.00', zip='60654',
+            invoice_number='1001', customer_id='42')
+    transaction_data = dict(transaction.fields)
+    
+    def urlencode_per_call():
+        # What process() did for every request up to PyAuthorize 1.1.3.
+        configuration = gateway.configuration.copy()
+        configuration['x_test_request'] = str(gateway.x_test_request)
+        return '&'.join([urlencode(configuration),
+                         urlencode(transaction_data)])
+    
+    def precompiled():
+        return gateway._encode(transaction_data)
+    
+    results = {}
+    for name, function in (('urlencode_per_call', urlencode_per_call),
+                           ('precompiled', precompiled)):
+        best = min(timeit.Timer(function).repeat(repeat, iterations))
+        results[name] = best / iterations * 1e6
+    return results
+
+
+def bench_transports(requests=1000, url=None, latency=None):
+    """Time requests sent through each available Transport.
+    
+    Every transport posts the same AUTH_ONLY, one request at a time, after
+    a few warm-up requests. AppEngineTransport is only timed on App Engine.
+    
+    Args:
+        requests: Number of requests timed per transport.
+        url: Gateway URL; a FakeGateway is started if not given.
+        latency: Seconds of latency added by the FakeGateway.
+    
+    Returns:
+        Dictionary of results keyed by transport name, each with the
+        throughput and latency distribution in milliseconds.
+    """
+    
+    transports = [('urllib', pyauthorize.UrllibTransport()),
+                  ('pool', pyauthorize.ConnectionPool())]
+    try:
+        transports.append(('appengine', pyauthorize.AppEngineTransport()))
+    except ImportError:
+        pass
+    
+    gateway = None
+    if url is None:
+        gateway = pyauthorize_testing.FakeGateway(latency=latency)
+        gateway.start()
+        url = gateway.url
+    
+    client = pyauthorize.Gateway('login', 'key')
+    client.post_url = url
+    transaction = pyauthorize.Transaction.auth_only('4111111111111111',
+            datetime.date.today().strftime('%m%Y'), '1.00')
+    
+    results = {}
+    try:
+        for name, transport in transports:
+            client.transport = transport
+            for i in range(min(10, requests)):
+                client.submit(transaction)
+            
+            latencies = []
+            started = time.time()
+            for i in xrange(requests):
+                request_started = time.time()
+                client.submit(transaction)
+                latencies.append(time.time() - request_started)
+            elapsed = time.time() - started
+            transport.close()
+            
+            results[name] = {
+                    'requests' : requests,
+                    'elapsed' : elapsed,
+                    'throughput' : elapsed and requests / elapsed or 0.0,
+                    'latency_ms' : _distribution(latencies),
+            }
+    finally:
+        if gateway is not None:
+            gateway.stop()
+    
+    return results
+
+
+def bench_velocity(keys=1000000, limit=3, width=2 ** 18, depth=4):
+    """Time VelocityFilter.check() over many distinct cards and customers.
+    
+    Every authorization has its own card number and customer id, so any
+    rejection is a false positive of the sketches.
+    
+    Returns:
+        Dictionary of results, with the microseconds per check, the memory
+        taken by the sketches and the rate of false rejections.
+    """
+    
+    velocity_filter = pyauthorize.VelocityFilter([
+            pyauthorize.VelocityRule(('card_num',), limit, 3600),
+            pyauthorize.VelocityRule(('customer_id',), limit, 3600),
+            pyauthorize.VelocityRule(('zip', 'amount'), keys, 3600),
+    ], width=width, depth=depth)
+    
+    rejected = 0
+    started = time.time()
+    for i in xrange(keys):
+        transaction_data = {
+                'x_card_num' : '4%015d' % i,
+                'x_customer_id' : str(i),
+                'x_zip' : '%05d' % (i % 40000),
+                'x_amount' : '%d.00' % (i % 100 + 1),
+        }
+        try:
+            velocity_filter.check(transaction_data)
+        except pyauthorize.VelocityExceeded:
+            rejected += 1
+    elapsed = time.time() - started
+    
+    return {
+            'keys' : keys,
+            'elapsed' : elapsed,
+            'throughput' : elapsed and keys / elapsed or 0.0,
+            'usec_per_check' : keys and elapsed / keys * 1e6 or 0.0,
+            'memory_bytes' : sum(sketch.memory
+                                 for sketch in velocity_filter.sketches),
+            'false_rejections' : keys and float(rejected) / keys or 0.0,
+    }
+
+
+def replay_traffic(path, speed=1.0, url=None, latency=None,
+                   max_concurrency=50):
+    """Replay traffic captured by a TrafficRecorder.
+    
+    Requests are sent at their recorded pacing, speed times faster, or as
+    fast as max_concurrency allows if speed is None. Masked card numbers
+    are filled in with zeros and card codes with nines. Voids, captures and
+    credits of a transaction authorized earlier in the replay wait for the
+    requests about it before them and refer to the transaction id the
+    replay got for it.
+    
+    Latency is measured from the time each request was due rather than
+    sent, so a replay falling behind shows up in the latency instead of
+    being hidden by it.
+    
+    Args:
+        path: The TrafficRecorder file.
+        speed: How many times faster than recorded to send requests.
+        url: Gateway URL; a FakeGateway is started if not given.
+        latency: Seconds of latency added by the FakeGateway.
+        max_concurrency: Number of requests in flight at most.
+    
+    Returns:
+        Dictionary of results, ready to be dumped as JSON, with the
+        recorded and replayed latency distributions in milliseconds.
+    """
+    
+    gateway = None
+    if url is None:
+        gateway = pyauthorize_testing.FakeGateway(latency=latency)
+        gateway.start()
+        url = gateway.url
+    
+    client = pyauthorize.Gateway('login', 'key')
+    client.post_url = url
+    workers = pyauthorize.WorkerPool(size=max_concurrency)
+    # Last call replaying a request about each recorded transaction id,
+    # returning the transaction id the replay got for it.
+    chains = {}
+    samples = []
+    lock = threading.Lock()
+    
+    def replay_one(record, due, previous):
+        trans_id = None
+        if previous is not None:
+            trans_id = previous.result()
+        transaction = _replay_transaction(record.fields, trans_id)
+        try:
+            response = client.submit(transaction)
+        except Exception:
+            outcome = 'error'
+        else:
+            outcome = response.category
+            if trans_id is None:
+                trans_id = response.trans_id
+        seconds = time.time() - due
+        lock.acquire()
+        try:
+            samples.append((transaction.type, seconds, record.seconds,
+                            outcome))
+        finally:
+            lock.release()
+        return trans_id
+    
+    pending = []
+    lag = 0.0
+    try:
+        started = time.time()
+        first = None
+        for record in pyauthorize.read_traffic(path):
+            if first is None:
+                first = record.timestamp
+            due = time.time()
+            if speed:
+                due = started + (record.timestamp - first) / speed
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lag = max(lag, -delay)
+            trans_id = dict(record.fields).get('x_trans_id')
+            call = workers.submit(replay_one, record, due,
+                                  chains.get(trans_id))
+            pending.append(call)
+            if trans_id is None and record.response is not None:
+                trans_id = record.response.trans_id
+            if trans_id not in (None, '', '0'):
+                chains[trans_id] = call
+            if len(pending) >= 1000:
+                pending = [call for call in pending if not call.done()]
+        for call in pending:
+            call.result()
+        elapsed = time.time() - started
+    finally:
+        workers.shutdown()
+        if gateway is not None:
+            gateway.stop()
+    
+    types = {}
+    outcomes = {}
+    for transaction_type, seconds, recorded, outcome in samples:
+        types[transaction_type] = types.get(transaction_type, 0) + 1
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    
+    return {
+            'benchmark' : 'replay',
+            'timestamp' : datetime.datetime.utcnow().isoformat(),
+            'python' : platform.python_version(),
+            'speed' : speed,
+            'max_concurrency' : max_concurrency,
+            'gateway_latency' : latency,
+            'requests' : len(samples),
+            'types' : types,
+            'outcomes' : outcomes,
+            'elapsed' : elapsed,
+            'throughput' : elapsed and len(samples) / elapsed or 0.0,
+            'max_lag_ms' : lag * 1000,
+            'latency_ms' : _distribution([sample[1] for sample in samples]),
+            'recorded_latency_ms' : _distribution([sample[2]
+                                                   for sample in samples]),
+    }
+
+
+def _replay_transaction(fields, trans_id=None):
+    """Return the Transaction to send again for recorded fields.
+    
+    trans_id replaces the recorded x_trans_id if given.
+    """
+    
+    transaction_type = None
+    replayed = []
+    for name, value in fields:
+        if name == 'x_type':
+            transaction_type = value
+            continue
+        elif name == 'x_card_num':
+            value = value.replace('*', '0')
+        elif name == 'x_card_code':
+            value = value.replace('*', '9')
+        elif name == 'x_trans_id' and trans_id:
+            value = trans_id
+        replayed.append((name, value))
+    return pyauthorize.Transaction(transaction_type, replayed)
+
+
+def bench_profile(requests=1000, url=None, latency=None, sample_rate=1.0):
+    """Profile auth_and_capture() + process() with a pyauthorize.Profiler.
+    
+    Returns:
+        The Profiler's report, ready to be dumped as JSON and compared
+        with pyauthorize.diff_profiles().
+    """
+    
+    gateway = None
+    if url is None:
+        gateway = pyauthorize_testing.FakeGateway(latency=latency)
+        gateway.start()
+        url = gateway.url
+    
+    processor = pyauthorize.PaymentProcessor('login', 'key')
+    processor.post_url = url
+    processor.profiler = pyauthorize.Profiler(sample_rate)
+    processor.card_num = '4111111111111111'
+    processor.exp_date = datetime.date.today().strftime('%m%Y')
+    try:
+        for i in xrange(requests):
+            processor.amount = '%d.00' % (i % 100 + 1)
+            processor.auth_and_capture()
+            processor.process()
+    finally:
+        if gateway is not None:
+            gateway.stop()
+    
+    return processor.profiler.report()
+
+
+def bench_load(requests=1000, concurrency=4, mode='threads', url=None,
+               latency=None):
+    """Measure auth_and_capture() + process() under concurrent load.
+    
+    Args:
+        requests: Number of transactions to process.
+        concurrency: Number of threads or processes processing them.
+        mode: 'threads' or 'processes'.
+        url: Gateway URL; a FakeGateway is started if not given.
+        latency: Seconds of latency added by the FakeGateway.
+    
+    Returns:
+        Dictionary of results, ready to be dumped as JSON.
+    """
+    
+    gateway = None
+    if url is None:
+        gateway = pyauthorize_testing.FakeGateway(latency=latency)
+        gateway.start()
+        url = gateway.url
+    
+    counts = [requests // concurrency] * concurrency
+    for i in range(requests % concurrency):
+        counts[i] += 1
+    jobs = [(url, count) for count in counts if count]
+    
+    try:
+        started = time.time()
+        if mode == 'threads':
+            samples = _run_threads(jobs)
+        elif mode == 'processes':
+            pool = multiprocessing.Pool(len(jobs))
+            try:
+                samples = sum(pool.map(_run_job, jobs), [])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            raise ValueError, 'Unknown mode. %s' % mode
+        elapsed = time.time() - started
+    finally:
+        if gateway is not None:
+            gateway.stop()
+    
+    return _summarize(samples, elapsed, mode, concurrency, latency)
+
+
+class _PhaseTimer(pyauthorize.Observer):
+    """Observer keeping the phase timings of the last transaction."""
+    
+    def __init__(self):
+        self.timings = dict.fromkeys(PHASES, 0.0)
+    
+    def on_phase(self, transaction_type, phase, seconds):
+        self.timings[phase] = seconds
+
+
+def _run_job(job):
+    """Process count transactions one after the other.
+    
+    Returns:
+        List of (total, validation, encoding, network, parsing, outcome)
+        samples, outcome being 'approved', 'declined' or 'error'.
+    """
+    
+    url, count = job
+    exp_date = datetime.date.today().strftime('%m%Y')
+    samples = []
+    for i in xrange(count):
+        timer = _PhaseTimer()
+        processor = pyauthorize.PaymentProcessor('login', 'key')
+        processor.observers.append(timer)
+        processor.post_url = url
+        processor.card_num = '4111111111111111'
+        processor.exp_date = exp_date
+        processor.amount = '%d.00' % (i % 100 + 1)
+        
+        started = time.time()
+        processor.auth_and_capture()
+        try:
+            if processor.process():
+                outcome = 'approved'
+            else:
+                outcome = 'declined'
+        except Exception:
+            outcome = 'error'
+        total = time.time() - started
+        
+        samples.append((total,) + tuple(timer.timings[phase]
+                                        for phase in PHASES) + (outcome,))
+    return samples
+
+
+def _run_threads(jobs):
+    """Run each job on its own thread and return all their samples."""
+    
+    samples = []
+    def run(job):
+        samples.extend(_run_job(job))
+    
+    threads = [threading.Thread(target=run, args=(job,)) for job in jobs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def _percentile(ordered, percent):
+    """Nearest-rank percentile of an ordered list."""
+    
+    if not ordered:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+def _distribution(values):
+    """Mean, percentiles and maximum of values, in milliseconds."""
+    
+    ordered = sorted(values)
+    result = {'mean': 0.0}
+    if ordered:
+        result['mean'] = sum(ordered) / len(ordered) * 1000
+    for percent in (50, 95, 99):
+        result['p%d' % percent] = _percentile(ordered, percent) * 1000
+    result['max'] = ordered and ordered[-1] * 1000 or 0.0
+    return result
+
+
+def _summarize(samples, elapsed, mode, concurrency, latency):
+    """Build the benchmark results from the samples."""
+    
+    outcomes = {'approved': 0, 'declined': 0, 'error': 0}
+    for sample in samples:
+        outcomes[sample[-1]] += 1
+    
+    phases = {}
+    for i, phase in enumerate(PHASES):
+        phases[phase] = _distribution([sample[i + 1] for sample in samples])
+    
+    return {
+            'benchmark' : 'load',
+            'timestamp' : datetime.datetime.utcnow().isoformat(),
+            'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'mode' : mode,
+            'concurrency' : concurrency,
+            'gateway_latency' : latency,
+            'requests' : len(samples),
+            'outcomes' : outcomes,
+            'elapsed' : elapsed,
+            'throughput' : elapsed and len(samples) / elapsed or 0.0,
+            'latency_ms' : _distribution([sample[0] for sample in samples]),
+            'phases_ms' : phases,
+    }
+
+
+def _print_load(results):
+    """Print load benchmark results for people."""
+    
+    print '%d requests, %s x %d: %.1f requests/s' % (results['requests'],
+            results['mode'], results['concurrency'], results['throughput'])
+    print 'outcomes: %(approved)d approved, %(declined)d declined, ' \
+            '%(error)d errors' % results['outcomes']
+    print '%-12s %9s %9s %9s %9s %9s' % ('ms', 'mean', 'p50', 'p95', 'p99',
+                                         'max')
+    rows = [('total', results['latency_ms'])]
+    rows.extend((phase, results['phases_ms'][phase]) for phase in PHASES)
+    for name, distribution in rows:
+        print '%-12s %9.3f %9.3f %9.3f %9.3f %9.3f' % (name,
+                distribution['mean'], distribution['p50'],
+                distribution['p95'], distribution['p99'],
+                distribution['max'])
+
+
+def _print_profile(report, limit=15):
+    """Print the functions taking the most CPU time for people."""
+    
+    for transaction_type, profile in sorted(
+            report['transaction_types'].items()):
+        print '%s: %d samples, %.1f usec CPU each' % (transaction_type,
+                profile['samples'], profile['cpu_us'])
+        print '%-56s %9s %9s %7s' % ('function', 'own us', 'total us',
+                                     'calls')
+        functions = sorted(profile['functions'].items(),
+                key=lambda (name, function): -function['own_us'])
+        for name, function in functions[:limit]:
+            print '%-56s %9.1f %9.1f %7.1f' % (name[:56], function['own_us'],
+                    function['total_us'], function['calls'])
+
+
+def _print_profile_diff(baseline, report, limit=15):
+    """Print how CPU time by function changed since a baseline."""
+    
+    print '%-12s %-46s %9s %9s %8s' % ('type', 'function', 'old us',
+                                       'new us', 'change')
+    for transaction_type, name, old_us, new_us in pyauthorize.diff_profiles(
+            baseline, report)[:limit]:
+        change = old_us and '%+7.0f%%' % ((new_us - old_us) / old_us * 100)
+        print '%-12s %-46s %9.1f %9.1f %8s' % (transaction_type, name[:46],
+                old_us, new_us, change or 'new')
+
+
+def _print_replay(results):
+    """Print replay results for people."""
+    
+    print '%d requests in %.1fs: %.1f requests/s, lagging %.1f ms at most' % (
+            results['requests'], results['elapsed'], results['throughput'],
+            results['max_lag_ms'])
+    print 'types: %s' % ', '.join('%s %d' % item
+                                  for item in sorted(results['types'].items()))
+    print 'outcomes: %s' % ', '.join('%s %d' % item
+            for item in sorted(results['outcomes'].items()))
+    print '%-12s %9s %9s %9s %9s %9s' % ('ms', 'mean', 'p50', 'p95', 'p99',
+                                         'max')
+    for name, key in (('recorded', 'recorded_latency_ms'),
+                      ('replayed', 'latency_ms')):
+        distribution = results[key]
+        print '%-12s %9.3f %9.3f %9.3f %9.3f %9.3f' % (name,
+                distribution['mean'], distribution['p50'],
+                distribution['p95'], distribution['p99'],
+                distribution['max'])
+
+
+def main(args=None):
+    """Run the benchmark named on the command line."""
+    
+    parser = argparse.ArgumentParser(prog='python -m pyauthorize_bench',
+            description='Benchmarks for PyAuthorize.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    
+    encode_parser = subparsers.add_parser('encode',
+            help='per-request encoding cost')
+    encode_parser.add_argument('--iterations', type=int, default=100000)
+    
+    transport_parser = subparsers.add_parser('transport',
+            help='per-request cost of each transport')
+    transport_parser.add_argument('--requests', type=int, default=1000)
+    transport_parser.add_argument('--url',
+            help='gateway to use instead of a local FakeGateway')
+    transport_parser.add_argument('--latency', type=float,
+            help='seconds of latency added by the local FakeGateway')
+    
+    velocity_parser = subparsers.add_parser('velocity',
+            help='cost and accuracy of the velocity filter')
+    velocity_parser.add_argument('--keys', type=int, default=1000000)
+    velocity_parser.add_argument('--limit', type=int, default=3)
+    velocity_parser.add_argument('--width', type=int, default=2 ** 18)
+    velocity_parser.add_argument('--depth', type=int, default=4)
+    
+    load_parser = subparsers.add_parser('load',
+            help='throughput and latency of auth_and_capture() + process()')
+    load_parser.add_argument('--requests', type=int, default=1000)
+    load_parser.add_argument('--concurrency', type=int, default=4)
+    load_parser.add_argument('--mode', choices=('threads', 'processes'),
+            default='threads')
+    load_parser.add_argument('--url',
+            help='gateway to use instead of a local FakeGateway')
+    load_parser.add_argument('--latency', type=float,
+            help='seconds of latency added by the local FakeGateway')
+    load_parser.add_argument('--output',
+            help='file to write the results to as JSON')
+    
+    profile_parser = subparsers.add_parser('profile',
+            help='CPU time of auth_and_capture() + process() by function')
+    profile_parser.add_argument('--requests', type=int, default=1000)
+    profile_parser.add_argument('--sample-rate', type=float, default=1.0)
+    profile_parser.add_argument('--url',
+            help='gateway to use instead of a local FakeGateway')
+    profile_parser.add_argument('--latency', type=float,
+            help='seconds of latency added by the local FakeGateway')
+    profile_parser.add_argument('--baseline',
+            help='earlier --output to compare with')
+    profile_parser.add_argument('--output',
+            help='file to write the report to as JSON')
+    
+    replay_parser = subparsers.add_parser('replay',
+            help='replay traffic captured with a TrafficRecorder')
+    replay_parser.add_argument('path')
+    replay_parser.add_argument('--speed', type=float, default=1.0,
+            help='times faster than recorded; 0 for as fast as possible')
+    replay_parser.add_argument('--concurrency', type=int, default=50)
+    replay_parser.add_argument('--url',
+            help='gateway to use instead of a local FakeGateway')
+    replay_parser.add_argument('--latency', type=float,
+            help='seconds of latency added by the local FakeGateway')
+    replay_parser.add_argument('--output',
+            help='file to write the results to as JSON')
+    
+    options = parser.parse_args(args)
+    if options.benchmark == 'encode':
+        results = bench_encode(options.iterations)
+        for name in ('urlencode_per_call', 'precompiled'):
+            print '%-20s %8.2f usec/request' % (name, results[name])
+    elif options.benchmark == 'transport':
+        results = bench_transports(options.requests, options.url,
+                options.latency)
+        print '%-12s %12s %9s %9s %9s' % ('transport', 'requests/s',
+                'mean ms', 'p50 ms', 'p99 ms')
+        for name, result in sorted(results.items()):
+            print '%-12s %12.1f %9.3f %9.3f %9.3f' % (name,
+                    result['throughput'], result['latency_ms']['mean'],
+                    result['latency_ms']['p50'], result['latency_ms']['p99'])
+    elif options.benchmark == 'velocity':
+        results = bench_velocity(options.keys, options.limit, options.width,
+                options.depth)
+        print '%d keys: %.1f checks/s, %.2f usec/check' % (results['keys'],
+                results['throughput'], results['usec_per_check'])
+        print '%.1f MB of sketches, %.4f%% false rejections' % (
+                results['memory_bytes'] / 1048576.0,
+                results['false_rejections'] * 100)
+    elif options.benchmark == 'load':
+        results = bench_load(options.requests, options.concurrency,
+                options.mode, options.url, options.latency)
+        _print_load(results)
+    elif options.benchmark == 'profile':
+        results = bench_profile(options.requests, options.url,
+                options.latency, options.sample_rate)
+        if options.baseline:
+            baseline = open(options.baseline)
+            try:
+                _print_profile_diff(json.load(baseline), results)
+            finally:
+                baseline.close()
+        else:
+            _print_profile(results)
+    elif options.benchmark == 'replay':
+        results = replay_traffic(options.path, options.speed or None,
+                options.url, options.latency, options.concurrency)
+        _print_replay(results)
+    if options.benchmark in ('load', 'profile', 'replay') and options.output:
+        output = open(options.output, 'w')
+        try:
+            json.dump(results, output, indent=2, sort_keys=True)
+        finally:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
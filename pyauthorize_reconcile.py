@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+#Copyright (C) 2010 Analyte Media
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+#conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Reconciliation of settlement files against a TransactionJournal.
+
+Matches the gateway's transaction detail download for a settlement
+period against the transactions journaled while sending them, e.g.:
+    python -m pyauthorize_reconcile --journal /var/lib/payments/journal \
+            --since 2010-06-01 --until 2010-06-02 settlement.csv \
+            mismatches.jsonl
+
+The journaled transactions are loaded into a Ledger first, which holds a
+small tuple per transaction id. The settlement file is then streamed in
+chunks, by as many processes as there are cores, so its size doesn't
+matter. Each Mismatch found is written out as a JSON line:
+    missing_locally: Settled, but never sent through the journal.
+    not_captured: Settled, but only authorized in the journal.
+    missing_in_settlement: Captured or credited in the journal, but not
+        settled.
+    amount_differs: Settled for another amount than journaled.
+    voided_but_settled: Voided in the journal, but settled anyway.
+    duplicate_capture: Settled more than once, or settled under several
+        transaction ids for the same invoice number.
+
+Settlement rows must not contain line breaks within fields; the files the
+gateway exports don't.
+"""
+
+__author__ = 'jordan.bouvier@analytemedia.com (Jordan Bouvier)'
+
+import argparse
+import collections
+import csv
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import pyauthorize
+
+
+# Settlement file columns, by the names used here.
+DEFAULT_COLUMNS = {
+        'trans_id' : 'Transaction ID',
+        'status' : 'Transaction Status',
+        'amount' : 'Settlement Amount',
+        'invoice_number' : 'Invoice Number',
+}
+
+# Statuses of the settlement rows that moved money.
+SETTLED_STATUSES = frozenset(['Settled Successfully'])
+REFUNDED_STATUSES = frozenset(['Refund Settled Successfully'])
+
+# Journaled transaction types expected to settle.
+SETTLING_TYPES = frozenset(['AUTH_CAPTURE', 'PRIOR_AUTH_CAPTURE', 'CREDIT'])
+
+# Bytes of the settlement file read by a process at a time.
+CHUNK_SIZE = 32 * 1024 * 1024
+
+
+class Mismatch(collections.namedtuple('Mismatch',
+        'kind trans_id invoice_number journaled_amount settled_amount')):
+    """A difference between the journal and the settlement file.
+    
+    Amounts are strings in dollars, or None when a side has no amount.
+    """
+    
+    __slots__ = ()
+
+
+class Ledger(object):
+    """The approved transactions sent to the gateway, by transaction id.
+    
+    Each transaction id maps to a (transaction_type, cents, invoice_number)
+    tuple, transaction_type being that of the last approved request about
+    it, e.g. 'VOID' once an authorization was voided.
+    """
+    
+    def __init__(self):
+        self.transactions = {}
+    
+    def __len__(self):
+        return len(self.transactions)
+    
+    @classmethod
+    def from_journal(cls, directory, since=None, until=None):
+        """Load the ledger of a TransactionJournal directory.
+        
+        Args:
+            directory: The journal directory.
+            since: Optional time.time() of the first response to load.
+            until: Optional time.time() after the last response to load.
+        """
+        
+        ledger = cls()
+        requests = {}
+        for record in pyauthorize.JournalReader(directory):
+            if record.kind == 'request':
+                requests[record.request_id] = record.data
+                continue
+            fields = requests.pop(record.request_id, None)
+            if (record.kind != 'response' or fields is None
+                    or not record.data.is_approved
+                    or since is not None and record.timestamp < since
+                    or until is not None and record.timestamp >= until):
+                continue
+            response = record.data
+            ledger.add(fields.get('x_type'), response.trans_id,
+                    response.amount or fields.get('x_amount'),
+                    response.invoice_number or fields.get('x_invoice_num'))
+        return ledger
+    
+    def add(self, transaction_type, trans_id, amount, invoice_number=None):
+        """Record an approved transaction."""
+        
+        cents = _cents(amount)
+        invoice_number = invoice_number or ''
+        previous = self.transactions.get(trans_id)
+        if previous is not None and transaction_type in (
+                'PRIOR_AUTH_CAPTURE', 'VOID'):
+            invoice_number = invoice_number or previous[2]
+            if transaction_type == 'VOID' or cents is None:
+                cents = previous[1]
+        self.transactions[trans_id] = (transaction_type, cents,
+                                       invoice_number)
+
+
+def reconcile(settlement_path, ledger, processes=None, columns=None,
+              chunk_size=CHUNK_SIZE):
+    """Match a settlement file against a Ledger.
+    
+    Args:
+        settlement_path: The settlement CSV file.
+        ledger: The Ledger of the settlement period.
+        processes: Number of processes reading the file; by default one
+            per core, and 1 reads it in this process.
+        columns: Optional dictionary of the column names, overriding
+            DEFAULT_COLUMNS.
+        chunk_size: Bytes of the file read by a process at a time.
+    
+    Yields:
+        Mismatches, those found in the file as it is read, then the
+        transactions missing from it and the duplicate captures.
+    """
+    
+    names = dict(DEFAULT_COLUMNS)
+    names.update(columns or {})
+    settlement = open(settlement_path, 'rb')
+    try:
+        header = settlement.readline()
+        size = os.fstat(settlement.fileno()).st_size
+    finally:
+        settlement.close()
+    
+    fields = csv.reader([header.lstrip('\xef\xbb\xbf')]).next()
+    indexes = {}
+    for name, column in names.items():
+        if column in fields:
+            indexes[name] = fields.index(column)
+        elif name != 'invoice_number':
+            raise ValueError, 'Missing settlement column. %s' % column
+    
+    tasks = [(settlement_path, start, min(start + chunk_size, size))
+             for start in xrange(len(header), size, chunk_size)]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes == 1 or len(tasks) < 2:
+        pool = None
+        _start_worker(ledger, indexes)
+        results = itertools.imap(_reconcile_chunk, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, _start_worker,
+                                    (ledger, indexes))
+        results = pool.imap_unordered(_reconcile_chunk, tasks)
+    
+    settled = {}
+    # The first transaction id settled for each invoice number, and all
+    # of them for those settled more than once.
+    invoices = {}
+    duplicates = {}
+    try:
+        for mismatches, settled_ids, invoice_ids in results:
+            for mismatch in mismatches:
+                yield mismatch
+            for trans_id in settled_ids:
+                settled[trans_id] = settled.get(trans_id, 0) + 1
+            for invoice_number, trans_id in invoice_ids:
+                first = invoices.setdefault(invoice_number, trans_id)
+                if first != trans_id:
+                    duplicates.setdefault(invoice_number,
+                            set([first])).add(trans_id)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    
+    missing = []
+    for trans_id, (transaction_type, cents, invoice_number) in (
+            ledger.transactions.iteritems()):
+        count = settled.get(trans_id, 0)
+        if not count and transaction_type in SETTLING_TYPES:
+            missing.append(Mismatch('missing_in_settlement', trans_id,
+                    invoice_number, _dollars(cents), None))
+        elif count > 1:
+            missing.append(Mismatch('duplicate_capture', trans_id,
+                    invoice_number, _dollars(cents), None))
+    missing.sort(key=lambda mismatch: mismatch.trans_id)
+    for mismatch in missing:
+        yield mismatch
+    
+    for invoice_number, trans_ids in sorted(duplicates.iteritems()):
+        for trans_id in sorted(trans_ids):
+            entry = ledger.transactions[trans_id]
+            yield Mismatch('duplicate_capture', trans_id, invoice_number,
+                    _dollars(entry[1]), None)
+
+
+# Ledger and column indexes of the process reconciling chunks.
+_worker_state = None
+
+
+def _start_worker(ledger, indexes):
+    """Set the state of a process reconciling chunks."""
+    
+    global _worker_state
+    _worker_state = (ledger, indexes)
+
+
+def _reconcile_chunk(task):
+    """Reconcile the rows starting between two offsets of a settlement file.
+    
+    Returns:
+        (mismatches, settled_ids, invoice_ids): The mismatches found in the
+        rows, the journaled transaction ids settled by them, and the
+        (invoice_number, trans_id) of those capturing a journaled invoice.
+    """
+    
+    path, start, end = task
+    ledger, indexes = _worker_state
+    transactions = ledger.transactions
+    trans_id_index = indexes['trans_id']
+    status_index = indexes['status']
+    amount_index = indexes['amount']
+    invoice_index = indexes.get('invoice_number')
+    
+    mismatches = []
+    settled_ids = []
+    invoice_ids = []
+    for row in csv.reader(_chunk_lines(path, start, end)):
+        if not row:
+            continue
+        status = row[status_index]
+        is_refund = status in REFUNDED_STATUSES
+        if not is_refund and status not in SETTLED_STATUSES:
+            continue
+        
+        trans_id = row[trans_id_index]
+        cents = _cents(row[amount_index])
+        invoice_number = ''
+        if invoice_index is not None:
+            invoice_number = row[invoice_index]
+        entry = transactions.get(trans_id)
+        if entry is None:
+            mismatches.append(Mismatch('missing_locally', trans_id,
+                    invoice_number, None, _dollars(cents)))
+            continue
+        
+        settled_ids.append(trans_id)
+        transaction_type, journaled_cents, journaled_invoice = entry
+        if not is_refund and journaled_invoice:
+            invoice_ids.append((journaled_invoice, trans_id))
+        
+        if transaction_type == 'VOID':
+            kind = 'voided_but_settled'
+        elif transaction_type == 'AUTH_ONLY':
+            kind = 'not_captured'
+        elif is_refund != (transaction_type == 'CREDIT'):
+            kind = 'missing_locally'
+        elif journaled_cents != cents:
+            kind = 'amount_differs'
+        else:
+            continue
+        mismatches.append(Mismatch(kind, trans_id,
+                invoice_number or journaled_invoice,
+                _dollars(journaled_cents), _dollars(cents)))
+    return (mismatches, settled_ids, invoice_ids)
+
+
+def _chunk_lines(path, start, end):
+    """Yield the lines of a file that start at or after start, before end."""
+    
+    lines = open(path, 'rb')
+    try:
+        lines.seek(start - 1)
+        position = start - 1 + len(lines.readline())
+        while position < end:
+            line = lines.readline()
+            if not line:
+                break
+            yield line
+            position += len(line)
+    finally:
+        lines.close()
+
+
+def _cents(amount):
+    """Return an amount in dollars, e.g. '$1,234.50', as cents."""
+    
+    if amount is None or amount == '':
+        return None
+    amount = str(amount)
+    if '$' in amount or ',' in amount:
+        amount = amount.replace('$', '').replace(',', '')
+    return int(round(float(amount) * 100))
+
+
+def _dollars(cents):
+    """Return cents as a string in dollars."""
+    
+    if cents is None:
+        return None
+    sign = cents < 0 and '-' or ''
+    return '%s%d.%02d' % (sign, abs(cents) // 100, abs(cents) % 100)
+
+
+def _timestamp(date):
+    """Return the time.time() of the start of a YYYY-MM-DD date."""
+    
+    day = datetime.datetime.strptime(date, '%Y-%m-%d')
+    return time.mktime(day.timetuple())
+
+
+def main(args=None):
+    """Reconcile a settlement file from the command line."""
+    
+    parser = argparse.ArgumentParser(prog='python -m pyauthorize_reconcile',
+            description='Match a settlement file against a journal.')
+    parser.add_argument('settlement', help='settlement CSV file')
+    parser.add_argument('output', nargs='?',
+            help='file to write the mismatches to; standard output if not '
+                 'given')
+    parser.add_argument('--journal', required=True,
+            help='TransactionJournal directory')
+    parser.add_argument('--since', help='first day journaled, YYYY-MM-DD')
+    parser.add_argument('--until', help='day after the last, YYYY-MM-DD')
+    parser.add_argument('--processes', type=int,
+            help='processes reading the settlement file')
+    
+    options = parser.parse_args(args)
+    since = options.since and _timestamp(options.since)
+    until = options.until and _timestamp(options.until)
+    ledger = Ledger.from_journal(options.journal, since, until)
+    
+    output = sys.stdout
+    if options.output:
+        output = open(options.output, 'w')
+    counts = {}
+    try:
+        for mismatch in reconcile(options.settlement, ledger,
+                                  options.processes):
+            counts[mismatch.kind] = counts.get(mismatch.kind, 0) + 1
+            output.write(json.dumps(mismatch._asdict()) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    
+    print >>sys.stderr, '%d journaled transactions, %s' % (len(ledger),
+            ', '.join('%d %s' % (count, kind) for kind, count
+                      in sorted(counts.items())) or 'no mismatches')
+    return counts and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -28,15 +28,117 @@ __author__ = 'jordan.bouvier@analytemedia.com (Jordan Bouvier)'
 
 from nose.tools import with_setup
 from nose import tools
+import BaseHTTPServer
+import SocketServer
+import csv
 import datetime
+import gzip
+import httplib
+import json
+import multiprocessing
 import os
 import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+import urlparse
 
 import pyauthorize
+import pyauthorize_batch
+import pyauthorize_bench
+import pyauthorize_reconcile
+import pyauthorize_testing
 
 
 
+APPROVED_RESPONSE = '|'.join(['1', '1', '1',
+        'This transaction has been approved.', 'ABC123', 'Y', '2149186775']
+        + [''] * 32 + ['P'])
+
+
+class StubGatewayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers every POST with APPROVED_RESPONSE over keep-alive HTTP/1.1."""
+    
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(APPROVED_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(APPROVED_RESPONSE)
+        # Drop the connection without telling the client, like a gateway
+        # timing out an idle keep-alive connection.
+        self.close_connection = self.server.drop_connections
+    
+    def log_message(self, *args):
+        pass
+
+
+class StubGateway(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local gateway stub running in a background thread.
+    
+    stop() shuts it down and waits for its threads, so none are left
+    running at interpreter shutdown.
+    """
+    
+    daemon_threads = True
+    drop_connections = False
+    
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                StubGatewayHandler)
+        self.url = 'http://127.0.0.1:%s/gateway/transact.dll' % (
+                self.server_address[1])
+        self.hung_up = threading.Event()
+        self._handlers = []
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever,
+                kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread,
+                args=(request, client_address))
+        thread.daemon = True
+        self._lock.acquire()
+        try:
+            self._handlers.append((thread, request))
+        finally:
+            self._lock.release()
+        thread.start()
+    
+    def shutdown_request(self, request):
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+        self.hung_up.set()
+    
+    def stop(self):
+        """Stop serving, hang up on clients and wait for every thread."""
+        
+        self.shutdown()
+        self._thread.join()
+        self.server_close()
+        
+        self._lock.acquire()
+        try:
+            handlers = self._handlers
+            self._handlers = []
+        finally:
+            self._lock.release()
+        for thread, request in handlers:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+
+
 class PyAuthorizeTest(unittest.TestCase):
     
     def setUp(self):
@@ -441,8 +543,17 @@ class PyAuthorizeProcessingTest(PyAuthorizeTest):
         
         # Authorize.net actually does not provide a mechanism for testing
         # this functionality.
-        # TODO: Mock this
-        pass
+        with pyauthorize_testing.FakeGateway() as gateway:
+            self.pp.post_url = gateway.url
+            self.pp.amount = '1.00'
+            self.pp.auth_only()
+            tools.eq_(self.pp.process(), True)
+            
+            self.pp.transaction = self.pp.trans_id
+            self.pp.prior_auth_capture()
+            response = self.pp.process()
+        
+        tools.eq_(response, True)
     
     def test_prior_auth_capture_fails_without_transaction(self):
         """prior_auth_capture fails without transaction."""
@@ -474,8 +585,17 @@ class PyAuthorizeProcessingTest(PyAuthorizeTest):
         """void can successfully complete"""
         
         # Authorize.net doesn't provide any mechanism for testing void.
-        # TODO: Mock this
-        pass
+        with pyauthorize_testing.FakeGateway() as gateway:
+            self.pp.post_url = gateway.url
+            self.pp.amount = '1.00'
+            self.pp.auth_and_capture()
+            tools.eq_(self.pp.process(), True)
+            
+            self.pp.transaction = self.pp.trans_id
+            self.pp.void()
+            response = self.pp.process()
+        
+        tools.eq_(response, True)
     
     def test_void_fails_without_transaction(self):
         """void fails if transaction is invalid or not set."""
@@ -490,8 +610,19 @@ class PyAuthorizeProcessingTest(PyAuthorizeTest):
         """credit can successfully complete."""
         
         # Authorize.net doesn't provide any mechanism for testing credit
-        # TODO: Mock it
-        pass
+        with pyauthorize_testing.FakeGateway() as gateway:
+            self.pp.post_url = gateway.url
+            self.pp.amount = '1.00'
+            self.pp.auth_and_capture()
+            tools.eq_(self.pp.process(), True)
+            gateway.settle()
+            
+            self.pp.transaction = self.pp.trans_id
+            self.pp.card_num = self.pp.card_num[-4:]
+            self.pp.credit()
+            response = self.pp.process()
+        
+        tools.eq_(response, True)
     
     def test_credit_fails_without_transaction(self):
         """credit fails if transaction is unset or invalid."""
@@ -549,3 +680,2273 @@ class PyAuthorizeProcessingTest(PyAuthorizeTest):
         tools.assert_raises(ValueError, self.pp.auth_only)
     
 
+class PyAuthorizeConnectionPoolTest(PyAuthorizeTest):
+    """Tests pertaining to ConnectionPool."""
+    
+    def setUp(self):
+        """Point the processor at a local stub and a private pool."""
+        
+        PyAuthorizeTest.setUp(self)
+        self.gateway = StubGateway()
+        self.pool = pyauthorize.ConnectionPool(maxsize=1, idle_timeout=60)
+        self.pp.post_url = self.gateway.url
+        self.pp.connection_pool = self.pool
+        self.pp.amount = '1.00'
+    
+    def tearDown(self):
+        self.pool.clear()
+        self.gateway.stop()
+    
+    def test_process_reuses_connection(self):
+        """process reuses the kept-alive connection for later requests."""
+        
+        for i in range(3):
+            self.pp.auth_only()
+            tools.eq_(self.pp.process(), True)
+        
+        tools.eq_(self.pp.trans_id, '2149186775')
+        tools.eq_(self.pool.stats['connections'], 1)
+        tools.eq_(self.pool.stats['hits'], 2)
+    
+    def test_idle_connections_are_evicted(self):
+        """Connections idle for longer than idle_timeout aren't reused."""
+        
+        self.pool.idle_timeout = -1
+        self.pp.auth_only()
+        self.pp.process()
+        self.pp.process()
+        
+        tools.eq_(self.pool.stats['connections'], 2)
+        tools.eq_(self.pool.stats['hits'], 0)
+        tools.eq_(self.pool.stats['evictions'], 1)
+    
+    def test_stale_connection_is_replaced(self):
+        """A connection dropped by the server is replaced transparently."""
+        
+        self.gateway.drop_connections = True
+        self.pp.auth_only()
+        self.pp.process()
+        self.gateway.hung_up.wait(5)
+        
+        tools.eq_(self.pp.process(), True)
+        tools.eq_(self.pool.stats['reconnects'], 1)
+    
+    def test_lost_response_is_not_resent(self):
+        """A request whose response is lost isn't sent again by the pool."""
+        
+        gateway = pyauthorize_testing.FakeGateway()
+        gateway.start()
+        try:
+            self.pp.post_url = gateway.url
+            self.pp.auth_and_capture()
+            tools.eq_(self.pp.process(), True)
+            gateway.lost_response_rate = 1
+            tools.assert_raises((httplib.HTTPException, socket.error),
+                    self.pp.process)
+        finally:
+            gateway.stop()
+        
+        tools.eq_(len(gateway.transactions), 2)
+        tools.eq_(self.pool.stats['hits'], 1)
+        tools.eq_(self.pool.stats['reconnects'], 0)
+    
+
+class PyAuthorizeProcessAsyncTest(PyAuthorizeTest):
+    """Tests pertaining to process_async and WorkerPool."""
+    
+    def setUp(self):
+        """Point the processor at a local stub and a private worker pool."""
+        
+        PyAuthorizeTest.setUp(self)
+        self.gateway = StubGateway()
+        self.workers = pyauthorize.WorkerPool(size=1)
+        self.pp.post_url = self.gateway.url
+        self.pp.worker_pool = self.workers
+        self.pp.amount = '1.00'
+    
+    def tearDown(self):
+        self.workers.shutdown(wait=True)
+        self.gateway.stop()
+    
+    def test_process_async(self):
+        """process_async returns what process would and sets the response."""
+        
+        done = []
+        self.pp.auth_and_capture()
+        pending = self.pp.process_async(callback=done.append, timeout=10)
+        
+        tools.eq_(pending.result(timeout=10), True)
+        tools.eq_(self.pp.trans_id, '2149186775')
+        tools.eq_(done, [pending])
+    
+    def test_process_async_raises_errors_from_result(self):
+        """Errors raised while processing are raised again by result."""
+        
+        self.pp.post_url = 'http://127.0.0.1:1/gateway/transact.dll'
+        self.pp.auth_only()
+        pending = self.pp.process_async()
+        
+        tools.assert_raises(IOError, pending.result, 10)
+    
+    def test_cancel_pending_transaction(self):
+        """A transaction can be cancelled until a worker picks it up."""
+        
+        started = threading.Event()
+        blocker = threading.Event()
+        def block():
+            started.set()
+            blocker.wait()
+        
+        busy = self.workers.submit(block)
+        started.wait(10)
+        self.pp.auth_only()
+        pending = self.pp.process_async()
+        
+        tools.assert_raises(pyauthorize.TransactionTimeout, pending.result, 0)
+        tools.eq_(pending.cancel(), True)
+        tools.eq_(busy.cancel(), False)
+        blocker.set()
+        
+        tools.eq_(pending.cancelled(), True)
+        tools.assert_raises(pyauthorize.TransactionCancelled, pending.result)
+    
+
+class PyAuthorizeProcessManyTest(PyAuthorizeTest):
+    """Tests pertaining to process_many."""
+    
+    def setUp(self):
+        PyAuthorizeTest.setUp(self)
+        self.gateway = StubGateway()
+        self.pool = pyauthorize.ConnectionPool()
+    
+    def tearDown(self):
+        self.pool.close()
+        self.gateway.stop()
+    
+    def _credits(self, amounts):
+        """Yield (processor, 'credit') pairs, one for each amount."""
+        
+        for amount in amounts:
+            processor = pyauthorize.PaymentProcessor('login', 'key')
+            processor.post_url = self.gateway.url
+            processor.connection_pool = self.pool
+            processor.transaction = '123123'
+            processor.card_num = '1111'
+            processor.amount = amount
+            yield (processor, 'credit')
+    
+    def test_process_many(self):
+        """process_many processes every transaction."""
+        
+        results = list(pyauthorize.process_many(
+                self._credits(['1.00'] * 10), max_concurrency=3))
+        
+        tools.eq_(len(results), 10)
+        for (processor, transaction_type), is_processed, error in results:
+            tools.eq_((is_processed, error), (True, None))
+            tools.eq_(processor.trans_id, '2149186775')
+    
+    def test_process_many_reports_invalid_records(self):
+        """An invalid record is reported without stopping the batch."""
+        
+        amounts = ['1.00', 'ten dollars', '3.00', None, '5.00']
+        results = list(pyauthorize.process_many(self._credits(amounts),
+                max_concurrency=2, ordered=True))
+        
+        tools.eq_([item[0].amount for item, is_processed, error in results],
+                amounts)
+        tools.eq_([is_processed for item, is_processed, error in results],
+                [True, False, True, False, True])
+        tools.eq_([error.__class__ for item, is_processed, error in results],
+                [type(None), ValueError, type(None), ValueError, type(None)])
+    
+    def test_process_many_reads_input_lazily(self):
+        """process_many only reads a bounded window ahead of its results."""
+        
+        read = []
+        def amounts():
+            while True:
+                read.append(None)
+                yield '1.00'
+        
+        results = pyauthorize.process_many(self._credits(amounts()),
+                max_concurrency=2)
+        for i in range(5):
+            results.next()
+        results.close()
+        
+        assert len(read) <= 5 + 4
+    
+
+class PyAuthorizeGatewayTest(unittest.TestCase):
+    """Tests pertaining to Gateway, Transaction and Response."""
+    
+    def setUp(self):
+        self.stub = StubGateway()
+        self.gateway = pyauthorize.Gateway('login', 'key')
+        self.gateway.post_url = self.stub.url
+        self.exp_date = datetime.date.today().strftime('%m%Y')
+    
+    def tearDown(self):
+        self.stub.stop()
+    
+    def test_submit(self):
+        """submit processes a Transaction and returns its Response."""
+        
+        transaction = pyauthorize.Transaction.auth_and_capture(
+                '4111111111111111', self.exp_date, '1.00')
+        response = self.gateway.submit(transaction)
+        
+        tools.eq_(response.is_approved, True)
+        tools.eq_(response.trans_id, '2149186775')
+        tools.eq_(response.ccv_response, 'P')
+    
+    def test_submit_async(self):
+        """submit_async returns the Response through a PendingTransaction."""
+        
+        transaction = pyauthorize.Transaction.void('2149186775')
+        pending = self.gateway.submit_async(transaction)
+        
+        tools.eq_(pending.result(timeout=10).approval_code, 'ABC123')
+    
+    def test_auth_fields_match_payment_processor(self):
+        """Transaction.auth_only posts what PaymentProcessor.auth_only does."""
+        
+        pp = pyauthorize.PaymentProcessor('login', 'key')
+        pp.card_num = '4111111111111111'
+        pp.exp_date = self.exp_date
+        pp.amount = '12.00'
+        pp.card_code = '123'
+        pp.is_ccv_required = True
+        pp.zip = '60654'
+        pp.invoice_number = '1001'
+        pp.auth_only()
+        
+        transaction = pyauthorize.Transaction.auth_only(pp.card_num,
+                pp.exp_date, pp.amount, card_code='123', zip='60654',
+                invoice_number='1001')
+        
+        tools.eq_(transaction.type, 'AUTH_ONLY')
+        tools.eq_(dict(transaction.fields), pp.transaction_data)
+    
+    def test_transactions_are_validated(self):
+        """Transaction constructors raise ValueError on invalid fields."""
+        
+        tools.assert_raises(ValueError, pyauthorize.Transaction.auth_only,
+                '42', self.exp_date, '1.00')
+        tools.assert_raises(ValueError, pyauthorize.Transaction.auth_only,
+                '4111111111111111', self.exp_date, '1.00',
+                is_avs_required=True)
+        tools.assert_raises(ValueError, pyauthorize.Transaction.credit,
+                '123123', '1111', 'a lot')
+        tools.assert_raises(ValueError, pyauthorize.Transaction.void, 'abc')
+    
+    def test_transactions_are_immutable(self):
+        """Transactions can't be changed once built."""
+        
+        transaction = pyauthorize.Transaction.prior_auth_capture('123123')
+        
+        tools.eq_(transaction.get('x_trans_id'), '123123')
+        tools.eq_(transaction.get('x_amount'), None)
+        tools.assert_raises(AttributeError, setattr, transaction, 'type',
+                'CREDIT')
+        tools.assert_raises(AttributeError, setattr, transaction, 'extra', 1)
+    
+    def test_process_many_through_gateway(self):
+        """process_many submits Transactions through a shared Gateway."""
+        
+        transactions = [pyauthorize.Transaction.void(str(i))
+                        for i in range(1, 6)]
+        results = list(pyauthorize.process_many(transactions,
+                max_concurrency=2, ordered=True, gateway=self.gateway))
+        
+        tools.eq_([item for item, response, error in results], transactions)
+        for transaction, response, error in results:
+            tools.eq_((response.is_approved, error), (True, None))
+    
+
+class PyAuthorizeResponseTest(unittest.TestCase):
+    """Tests pertaining to Response."""
+    
+    def test_named_fields(self):
+        """Every documented field can be read by name."""
+        
+        fields = [''] * 55
+        fields[0] = '1'
+        fields[6] = '2149186775'
+        fields[9] = '12.00'
+        fields[38] = 'M'
+        fields[39] = 'P'
+        fields[50] = 'XXXX1111'
+        fields[51] = 'Visa'
+        response = pyauthorize.Response('|'.join(fields))
+        
+        tools.eq_(response.is_approved, True)
+        tools.eq_(response.trans_id, '2149186775')
+        tools.eq_(response.amount, '12.00')
+        tools.eq_(response.card_code_response, 'M')
+        tools.eq_(response.ccv_response, 'P')
+        tools.eq_(response.account_number, 'XXXX1111')
+        tools.eq_(response.card_type, 'Visa')
+        tools.eq_(response.balance_on_card, '')
+        tools.eq_(len(response), 55)
+        tools.eq_(list(response), fields)
+    
+    def test_missing_fields_are_empty(self):
+        """Fields missing from a short response read as ''."""
+        
+        response = pyauthorize.Response('3,1,13,The merchant login ID '
+                'or password is invalid or the account is inactive.', ',')
+        
+        tools.eq_(response.reason_code, '13')
+        tools.eq_(response.split_tender_id, '')
+        tools.assert_raises(IndexError, response.__getitem__, 4)
+        tools.eq_(response[-1][:12], 'The merchant')
+    
+    def test_encapsulated_fields(self):
+        """Encapsulated fields may contain the delimiter."""
+        
+        response = pyauthorize.Response('"2"|"1"|"2"|"Declined | sorry"|'
+                '""|"N"|"0"|"|"', '|', '"')
+        
+        tools.eq_(response.response_code, '2')
+        tools.eq_(response.reason_text, 'Declined | sorry')
+        tools.eq_(response.approval_code, '')
+        tools.eq_(response.trans_id, '0')
+        tools.eq_(response[7], '|')
+        tools.eq_(len(response), 8)
+    
+    def test_process_keeps_response(self):
+        """process keeps the full Response on the processor."""
+        
+        stub = StubGateway()
+        try:
+            pp = pyauthorize.PaymentProcessor('login', 'key')
+            pp.post_url = stub.url
+            pp.transaction = '2149186775'
+            pp.void()
+            pp.process()
+        finally:
+            stub.stop()
+        
+        tools.eq_(pp.response.reason_text,
+                'This transaction has been approved.')
+        tools.eq_(pp.response.ccv_response, pp.ccv_response)
+    
+    def test_classification(self):
+        """Responses are classified by reason code."""
+        
+        fields = [''] * 39
+        fields[:4] = ['2', '1', '27', 'AVS mismatch.']
+        fields[5] = 'N'
+        fields[38] = 'M'
+        response = pyauthorize.Response(','.join(fields), ',')
+        
+        tools.eq_(response.category, 'soft_decline')
+        tools.eq_(response.is_retryable, False)
+        assert 'billing address' in response.user_message
+        tools.eq_(response.avs_result.category, 'no_match')
+        tools.eq_(response.card_code_result.category, 'match')
+        
+        response = pyauthorize.Response('3,1,19,An error occurred during '
+                'processing. Please try again in 5 minutes.', ',')
+        tools.eq_(response.classification,
+                pyauthorize.REASON_CODES['19'])
+        tools.eq_(response.is_retryable, True)
+        tools.eq_(response.card_code_result,
+                pyauthorize.UNAVAILABLE_CHECK)
+        
+        # Unknown reason codes fall back on the response code.
+        tools.eq_(pyauthorize.Response('4,1,9999,', ',').category, 'held')
+        tools.eq_(pyauthorize.Response('').classification,
+                pyauthorize.UNKNOWN_RESPONSE)
+    
+    def test_retry_reason_codes(self):
+        """The retryable reason codes are those to retry in 5 minutes."""
+        
+        tools.eq_(pyauthorize.RetryPolicy.RETRY_REASON_CODES,
+                frozenset(['19', '20', '21', '22', '23', '25', '26', '57',
+                           '58', '59', '60', '61', '62', '63']))
+    
+
+class PyAuthorizeEncodeTest(unittest.TestCase):
+    """Tests pertaining to request encoding."""
+    
+    def setUp(self):
+        self.gateway = pyauthorize.Gateway('login', 'key')
+        self.transaction_data = {'x_type': 'CREDIT', 'x_trans_id': '123123',
+                                 'x_description': 'Refund & thanks'}
+    
+    def _decode(self, post_data):
+        """Return the posted fields as a dictionary."""
+        
+        return dict(urlparse.parse_qsl(post_data))
+    
+    def test_encode(self):
+        """_encode posts the configuration and the transaction fields."""
+        
+        expected = dict(self.gateway.configuration, x_test_request='True',
+                        **self.transaction_data)
+        
+        tools.eq_(self._decode(self.gateway._encode(self.transaction_data)),
+                expected)
+        tools.eq_(self._decode(self.gateway._encode(
+                self.transaction_data.items())), expected)
+    
+    def test_configuration_is_encoded_once(self):
+        """The encoded configuration is reused while it doesn't change."""
+        
+        first = self.gateway._encode_configuration()
+        
+        assert self.gateway._encode_configuration() is first
+    
+    def test_configuration_changes_are_encoded(self):
+        """Changes to configuration or x_test_request are picked up."""
+        
+        self.gateway._encode(self.transaction_data)
+        self.gateway.configuration['x_delim_char'] = ','
+        self.gateway.x_test_request = False
+        fields = self._decode(self.gateway._encode(self.transaction_data))
+        tools.eq_((fields['x_delim_char'], fields['x_test_request']),
+                (',', 'False'))
+        
+        self.gateway.configuration.update(x_encap_char='"')
+        fields = self._decode(self.gateway._encode(self.transaction_data))
+        tools.eq_(fields['x_encap_char'], '"')
+        
+        self.gateway.configuration = {'x_login': 'other'}
+        fields = self._decode(self.gateway._encode(self.transaction_data))
+        tools.eq_(fields['x_login'], 'other')
+        self.gateway.configuration['x_login'] = 'changed'
+        fields = self._decode(self.gateway._encode(self.transaction_data))
+        tools.eq_(fields['x_login'], 'changed')
+    
+
+class PyAuthorizeFakeGatewayTest(unittest.TestCase):
+    """Tests pertaining to pyauthorize_testing.FakeGateway."""
+    
+    def setUp(self):
+        self.gateway = pyauthorize_testing.FakeGateway(seed=1)
+        self.gateway.start()
+        self.pp = pyauthorize.PaymentProcessor('login', 'key')
+        self.pp.post_url = self.gateway.url
+        self.pp.card_num = '4111111111111111'
+        self.pp.exp_date = datetime.date.today().strftime('%m%Y')
+        self.pp.amount = '10.00'
+    
+    def tearDown(self):
+        self.gateway.stop()
+    
+    def _charge(self):
+        """Authorize and capture, then point transaction at the charge."""
+        
+        self.pp.auth_and_capture()
+        tools.eq_(self.pp.process(), True)
+        self.pp.transaction = self.pp.trans_id
+        self.pp.transaction_data = {}
+    
+    def test_approved_response(self):
+        """Approved charges get a full response."""
+        
+        self.pp.configuration['x_encap_char'] = '"'
+        self.pp.invoice_number = '1001'
+        self.pp.auth_and_capture()
+        
+        tools.eq_(self.pp.process(), True)
+        tools.eq_(self.pp.response.amount, '10.00')
+        tools.eq_(self.pp.response.invoice_number, '1001')
+        tools.eq_(self.pp.response.transaction_type, 'auth_capture')
+        tools.eq_(self.pp.response.account_number, 'XXXX1111')
+        tools.eq_(self.pp.response.card_type, 'Visa')
+    
+    def test_declines(self):
+        """Declined cards and expired cards are declined."""
+        
+        self.pp.card_num = '4222222222222'
+        self.pp.auth_only()
+        tools.eq_(self.pp.process(), False)
+        tools.eq_((self.pp.response_code, self.pp.reason_code), ('2', '2'))
+        
+        self.pp.card_num = '4111111111111111'
+        self.pp.exp_date = '0110'
+        self.pp.auth_only()
+        tools.eq_(self.pp.process(), False)
+        tools.eq_(self.pp.reason_code, '8')
+    
+    def test_prior_auth_capture_only_once(self):
+        """An authorization can only be captured once, and not for more."""
+        
+        self.pp.auth_only()
+        self.pp.process()
+        capture = pyauthorize.Transaction.prior_auth_capture
+        
+        response = self.pp.submit(capture(self.pp.trans_id, '20.00'))
+        tools.eq_(response.reason_code, '47')
+        
+        response = self.pp.submit(capture(self.pp.trans_id, '5.00'))
+        tools.eq_(response.is_approved, True)
+        tools.eq_(response.amount, '5.00')
+        
+        response = self.pp.submit(capture(self.pp.trans_id))
+        tools.eq_(response.reason_code, '311')
+    
+    def test_void_or_credit(self):
+        """Unsettled charges are voided, settled ones credited."""
+        
+        self._charge()
+        tools.eq_(self.pp.process_void_or_credit(), (True, 'Void'))
+        
+        self._charge()
+        self.gateway.settle()
+        tools.eq_(self.pp.process_void_or_credit(), (True, 'Credit'))
+        
+        self.pp.void()
+        tools.eq_(self.pp.process(), False)
+        self.pp.credit()
+        tools.eq_(self.pp.process(), False)
+        tools.eq_(self.pp.reason_code, '55')
+    
+    def test_injected_errors(self):
+        """Processing errors and HTTP errors can be injected."""
+        
+        self.pp.auth_only()
+        self.gateway.error_rate = 1
+        tools.eq_(self.pp.process(), False)
+        tools.eq_((self.pp.response_code, self.pp.reason_code), ('3', '19'))
+        
+        self.gateway.error_rate = 0
+        self.gateway.http_error_rate = 1
+        tools.assert_raises(urllib2.HTTPError, self.pp.process)
+        tools.eq_(self.gateway.stats['http_errors'], 1)
+    
+    def test_throttling(self):
+        """Requests over max_requests_per_second are throttled."""
+        
+        self.gateway.max_requests_per_second = 1
+        self.gateway._tokens = 1
+        self.pp.auth_only()
+        
+        tools.eq_(self.pp.process(), True)
+        tools.assert_raises(urllib2.HTTPError, self.pp.process)
+        tools.eq_(self.gateway.stats['throttled'], 1)
+    
+    def test_latency(self):
+        """Responses are delayed by the configured latency."""
+        
+        self.gateway.latency = pyauthorize_testing.constant_latency(0.2)
+        self.pp.auth_only()
+        started = time.time()
+        self.pp.process()
+        
+        assert time.time() - started >= 0.2
+    
+    def test_logins(self):
+        """Unknown credentials are rejected when logins are given."""
+        
+        self.gateway.logins = {'login': 'other key'}
+        self.pp.auth_only()
+        
+        tools.eq_(self.pp.process(), False)
+        tools.eq_(self.pp.reason_code, '13')
+    
+
+class PyAuthorizeBenchTest(unittest.TestCase):
+    """Tests pertaining to pyauthorize_bench."""
+    
+    def test_bench_load(self):
+        """bench_load reports every request, its latency and phases."""
+        
+        results = pyauthorize_bench.bench_load(requests=20, concurrency=3)
+        
+        tools.eq_(results['requests'], 20)
+        tools.eq_(results['outcomes']['approved'], 20)
+        assert results['throughput'] > 0
+        assert results['latency_ms']['max'] >= results['latency_ms']['p50']
+        tools.eq_(sorted(results['phases_ms']),
+                sorted(pyauthorize_bench.PHASES))
+    
+    def test_bench_transports(self):
+        """bench_transports times every transport available here."""
+        
+        results = pyauthorize_bench.bench_transports(requests=10)
+        
+        tools.eq_(sorted(results), ['pool', 'urllib'])
+        for result in results.values():
+            tools.eq_(result['requests'], 10)
+            assert result['throughput'] > 0
+    
+    def test_bench_velocity(self):
+        """bench_velocity checks distinct cards without rejecting them."""
+        
+        results = pyauthorize_bench.bench_velocity(keys=1000, width=1024)
+        
+        tools.eq_(results['keys'], 1000)
+        tools.eq_(results['false_rejections'], 0.0)
+        tools.eq_(results['memory_bytes'], 3 * 4 * 1024 * 4 * 4)
+    
+    def test_bench_profile(self):
+        """bench_profile reports the CPU time of every auth_and_capture()."""
+        
+        report = pyauthorize_bench.bench_profile(requests=5)
+        
+        profile = report['transaction_types']['AUTH_CAPTURE']
+        tools.eq_(profile['samples'], 5)
+        tools.ok_(profile['cpu_us'] > 0)
+        tools.ok_(profile['functions'])
+    
+    def test_percentile(self):
+        """_percentile uses the nearest rank."""
+        
+        ordered = range(1, 101)
+        
+        tools.eq_(pyauthorize_bench._percentile(ordered, 50), 50)
+        tools.eq_(pyauthorize_bench._percentile(ordered, 99), 99)
+        tools.eq_(pyauthorize_bench._percentile([7], 95), 7)
+    
+
+class PyAuthorizeObserverTest(PyAuthorizeTest):
+    """Tests pertaining to Observer and MetricsAggregator."""
+    
+    def setUp(self):
+        PyAuthorizeTest.setUp(self)
+        self.gateway = pyauthorize_testing.FakeGateway()
+        self.gateway.start()
+        self.metrics = pyauthorize.MetricsAggregator()
+        self.pp.post_url = self.gateway.url
+        self.pp.observers.append(self.metrics)
+        self.pp.amount = '1.00'
+    
+    def tearDown(self):
+        self.gateway.stop()
+    
+    def test_metrics(self):
+        """Phases, responses and sizes of transactions are aggregated."""
+        
+        self.pp.auth_and_capture()
+        self.pp.process()
+        self.pp.card_num = '4222222222222'
+        self.pp.auth_and_capture()
+        self.pp.process()
+        snapshot = self.metrics.snapshot()
+        
+        tools.eq_([(response['response_code'], response['reason_code'],
+                    response['count']) for response in snapshot['responses']],
+                [('1', '1', 1), ('2', '2', 1)])
+        tools.eq_(snapshot['categories'], {'approved': 1, 'declined': 1})
+        tools.eq_(sorted(snapshot['phases']),
+                ['encoding', 'network', 'parsing', 'validation'])
+        tools.eq_(snapshot['phases']['network']['count'], 2)
+        tools.eq_(snapshot['latencies']['AUTH_CAPTURE']['count'], 2)
+        assert snapshot['bytes_sent'] > 0
+        assert snapshot['bytes_received'] > 0
+    
+    def test_errors(self):
+        """Validation and network errors are counted."""
+        
+        self.pp.amount = None
+        tools.assert_raises(ValueError, self.pp.auth_only)
+        self.pp.amount = '1.00'
+        self.pp.auth_only()
+        self.gateway.http_error_rate = 1
+        tools.assert_raises(urllib2.HTTPError, self.pp.process)
+        
+        tools.eq_(self.metrics.snapshot()['errors'], [
+                {'transaction_type': 'AUTH_ONLY', 'error': 'HTTPError',
+                 'count': 1},
+                {'transaction_type': 'AUTH_ONLY', 'error': 'ValueError',
+                 'count': 1}])
+    
+    def test_failing_observer_is_ignored(self):
+        """An observer raising an exception doesn't fail the transaction."""
+        
+        class FailingObserver(pyauthorize.Observer):
+            def on_response(self, *args):
+                raise RuntimeError
+        
+        self.pp.observers.insert(0, FailingObserver())
+        self.pp.auth_only()
+        
+        tools.eq_(self.pp.process(), True)
+        tools.eq_(self.metrics.snapshot()['responses'][0]['count'], 1)
+    
+    def test_latency_histogram(self):
+        """LatencyHistogram estimates percentiles within a bucket."""
+        
+        histogram = pyauthorize.LatencyHistogram()
+        for i in range(1, 101):
+            histogram.add(i / 1000.0)
+        
+        tools.eq_(histogram.count, 100)
+        tools.eq_(histogram.max, 0.1)
+        assert 0.05 <= histogram.percentile(50) <= 0.05 * 1.19
+        assert 0.099 <= histogram.percentile(99) <= 0.1
+        tools.eq_(len(histogram.counts), len(histogram.BOUNDS) + 1)
+    
+
+class PyAuthorizeProfilerTest(PyAuthorizeTest):
+    """Tests pertaining to Profiler and diff_profiles."""
+    
+    def setUp(self):
+        PyAuthorizeTest.setUp(self)
+        self.gateway = pyauthorize_testing.FakeGateway()
+        self.gateway.start()
+        self.pp.post_url = self.gateway.url
+        self.pp.amount = '1.00'
+    
+    def tearDown(self):
+        self.gateway.stop()
+    
+    def test_profile(self):
+        """Sampled transactions are profiled by function."""
+        
+        self.pp.profiler = pyauthorize.Profiler(sample_rate=1)
+        for i in range(3):
+            self.pp.auth_only()
+            tools.eq_(self.pp.process(), True)
+        self.pp.transaction = self.pp.trans_id
+        self.pp.void()
+        self.pp.process()
+        
+        report = self.pp.profiler.report()
+        tools.eq_(sorted(report['transaction_types']), ['AUTH_ONLY', 'VOID'])
+        auth_only = report['transaction_types']['AUTH_ONLY']
+        tools.eq_(auth_only['samples'], 3)
+        for name in ('_auth', '_valid_card_num', '_encode', '_transmit',
+                     '_field_offsets'):
+            assert auth_only['functions']['pyauthorize.' + name]['calls'] >= 1
+        assert auth_only['cpu_us'] > 0
+        
+        path = os.path.join(tempfile.mkdtemp(), 'profile.json')
+        self.pp.profiler.dump(path)
+        tools.eq_(json.load(open(path))['transaction_types']['VOID']
+                ['samples'], 1)
+        shutil.rmtree(os.path.dirname(path))
+    
+    def test_unsampled(self):
+        """Calls that aren't sampled aren't profiled."""
+        
+        self.pp.profiler = pyauthorize.Profiler(sample_rate=0)
+        self.pp.auth_only()
+        self.pp.process()
+        
+        tools.eq_(self.pp.profiler.report()['transaction_types'], {})
+    
+    def test_diff_profiles(self):
+        """diff_profiles lists the biggest changes first."""
+        
+        def report(cpu_us, encode_us, parse_us):
+            return {'transaction_types': {'AUTH_ONLY': {
+                    'cpu_us': cpu_us,
+                    'functions': {
+                        'pyauthorize._encode': {'own_us': encode_us},
+                        'pyauthorize._parse': {'own_us': parse_us},
+                    }}}}
+        
+        tools.eq_(pyauthorize.diff_profiles(report(100, 30, 20),
+                                            report(130, 60, 20.5)),
+                [('AUTH_ONLY', '*', 100, 130),
+                 ('AUTH_ONLY', 'pyauthorize._encode', 30, 60)])
+        tools.eq_(pyauthorize.diff_profiles(report(100, 30, 20),
+                {'transaction_types': {}}, min_change_us=50),
+                [('AUTH_ONLY', '*', 100, 0.0)])
+    
+
+class PyAuthorizePrescreenTest(PyAuthorizeTest):
+    """Tests pertaining to CardPrescreen and BinIndex."""
+    
+    def test_luhn_valid(self):
+        """luhn_valid accepts valid card numbers only."""
+        
+        for card_num in ['4111111111111111', '5500000000000004',
+                         '340000000000009', '6011000000000004']:
+            tools.eq_(pyauthorize.luhn_valid(card_num), True)
+        for card_num in ['4111111111111112', '511111111111111']:
+            tools.eq_(pyauthorize.luhn_valid(card_num), False)
+    
+    def test_default_brands(self):
+        """The default BinIndex knows the major networks."""
+        
+        index = pyauthorize.BinIndex()
+        
+        tools.eq_(index.brand('4111111111111111'), 'Visa')
+        tools.eq_(index.brand('2720990000000007'), 'MasterCard')
+        tools.eq_(index.brand('378282246310005'), 'American Express')
+        tools.eq_(index.brand('6499000000000000'), 'Discover')
+        tools.eq_(index.brand('9111111111111111'), None)
+    
+    def test_narrowest_range_wins(self):
+        """Specific ranges override the broader ranges they fall in."""
+        
+        index = pyauthorize.BinIndex([('4', '4', 'Visa'),
+                                      ('412345', '412399', 'Visa Debit'),
+                                      ('41234567', '41234567', 'Prepaid')])
+        
+        tools.eq_(index.brand('4111111111111111'), 'Visa')
+        tools.eq_(index.brand('4123451111111111'), 'Visa Debit')
+        tools.eq_(index.brand('4123456711111111'), 'Prepaid')
+        tools.eq_(index.brand('4123456811111111'), 'Visa Debit')
+        tools.eq_(index.brand('4124000000000000'), 'Visa')
+        tools.eq_(len(index), 5)
+    
+    def test_load(self):
+        """BinIndex.load reads low,high,brand rows."""
+        
+        path = os.path.join(tempfile.mkdtemp(), 'bins.csv')
+        table = open(path, 'w')
+        table.write('# low,high,brand\n4,4,Visa\n\n51,55,MasterCard\n')
+        table.close()
+        index = pyauthorize.BinIndex.load(path)
+        
+        tools.eq_(index.brand('5500000000000004'), 'MasterCard')
+        tools.eq_(index.brand('340000000000009'), None)
+    
+    def test_prescreen_in_auth(self):
+        """auth_only rejects bad checksums, expired cards and brands."""
+        
+        self.pp.amount = '1.00'
+        self.pp.prescreen = pyauthorize.CardPrescreen(
+                supported_brands=['Visa', 'MasterCard'])
+        self.pp.auth_only()
+        
+        self.pp.card_num = '4111111111111112'
+        tools.assert_raises(ValueError, self.pp.auth_only)
+        
+        self.pp.card_num = '378282246310005'
+        tools.assert_raises(ValueError, self.pp.auth_only)
+        
+        self.pp.card_num = '5500000000000004'
+        last_month = datetime.date.today().replace(day=1) - (
+                datetime.timedelta(days=1))
+        self.pp.exp_date = last_month.strftime('%m/%y')
+        tools.assert_raises(ValueError, self.pp.auth_only)
+    
+    def test_prescreen_in_submit(self):
+        """Gateway.submit rejects authorizations failing the prescreen."""
+        
+        gateway = pyauthorize.Gateway('login', 'key')
+        gateway.post_url = 'http://127.0.0.1:1/gateway/transact.dll'
+        gateway.prescreen = pyauthorize.CardPrescreen()
+        transaction = pyauthorize.Transaction.auth_only('4111111111111112',
+                self.pp.exp_date, '1.00')
+        
+        tools.assert_raises(ValueError, gateway.submit, transaction)
+    
+
+class PyAuthorizeVelocityTest(PyAuthorizeTest):
+    """Tests pertaining to VelocityFilter and SlidingCountMinSketch."""
+    
+    def test_sketch_window(self):
+        """Counts are dropped a slot at a time once out of the window."""
+        
+        sketch = pyauthorize.SlidingCountMinSketch(60, width=1024, slots=4)
+        
+        tools.eq_(sketch.add('card', now=0), 1)
+        tools.eq_(sketch.add('card', count=2, now=20), 3)
+        tools.eq_(sketch.estimate('card', now=59), 3)
+        tools.eq_(sketch.estimate('card', now=61), 2)
+        tools.eq_(sketch.estimate('card', now=81), 0)
+        tools.eq_(sketch.estimate('other', now=20), 0)
+        tools.eq_(sketch.memory, 4 * 1024 * 4 * 4)
+        for size in [{'width': 1000}, {'width': 0}, {'slots': 0}]:
+            tools.assert_raises(ValueError,
+                    pyauthorize.SlidingCountMinSketch, 60, **size)
+        tools.assert_raises(ValueError, pyauthorize.SlidingCountMinSketch, 0)
+    
+    def test_sketch_reuses_slots(self):
+        """A slot is cleared when reused, and unicode keys are counted."""
+        
+        sketch = pyauthorize.SlidingCountMinSketch(60, width=64, slots=2)
+        for i in range(100):
+            sketch.add(str(i), now=0)
+        sketch.add(u'caf\xe9', count=5, now=0)
+        
+        tools.eq_(sketch.estimate(u'caf\xe9', now=0) >= 5, True)
+        tools.eq_(sketch.add(u'caf\xe9', now=60), 1)
+        tools.eq_(sketch.estimate('7', now=60), 0)
+        tools.eq_(sketch.estimate(u'caf\xe9'.encode('utf-8'), now=60), 1)
+    
+    def test_sketch_never_underestimates(self):
+        """Estimates are at least the true counts, even when crowded."""
+        
+        sketch = pyauthorize.SlidingCountMinSketch(60, width=256, depth=3)
+        counts = {}
+        for i in range(2000):
+            key = str(random.randint(0, 999))
+            counts[key] = counts.get(key, 0) + 1
+            sketch.add(key, now=1)
+        
+        for key, count in counts.items():
+            assert sketch.estimate(key, now=1) >= count
+    
+    def test_velocity_in_auth(self):
+        """auth_only rejects a card over its limit."""
+        
+        self.pp.amount = '1.00'
+        self.pp.velocity_filter = pyauthorize.VelocityFilter([
+                pyauthorize.VelocityRule(('card_num',), 2, 3600),
+                pyauthorize.VelocityRule(('customer_id',), 1, 3600),
+        ])
+        self.pp.auth_only()
+        self.pp.auth_only()
+        
+        tools.assert_raises(pyauthorize.VelocityExceeded, self.pp.auth_only)
+        self.pp.card_num = '5500000000000004'
+        self.pp.auth_only()
+        tools.eq_(self.pp.velocity_filter.stats,
+                {'checked': 4, 'rejected': 1})
+    
+    def test_velocity_in_submit(self):
+        """Gateway.submit counts authorizations by zip and amount bucket."""
+        
+        gateway = pyauthorize.Gateway('login', 'key')
+        gateway.post_url = 'http://127.0.0.1:1/gateway/transact.dll'
+        gateway.velocity_filter = pyauthorize.VelocityFilter([
+                pyauthorize.VelocityRule(('zip', 'amount'), 1, 600)])
+        velocity_filter = gateway.velocity_filter
+        
+        def transaction(amount, card_num='4111111111111111', zip='60654'):
+            return pyauthorize.Transaction.auth_only(card_num,
+                    self.pp.exp_date, amount, zip=zip)
+        
+        velocity_filter.check(transaction('0.50'))
+        velocity_filter.check(transaction('2.00'))
+        velocity_filter.check(transaction('0.99', zip='10001'))
+        velocity_filter.check(pyauthorize.Transaction.auth_only(
+                '4111111111111111', self.pp.exp_date, '0.99'))
+        tools.assert_raises(ValueError, gateway.submit,
+                transaction('0.99', card_num='5500000000000004'))
+        tools.assert_raises(ValueError, pyauthorize.VelocityFilter,
+                [pyauthorize.VelocityRule(('email',), 1, 600)])
+    
+
+class PyAuthorizeTransactionCacheTest(PyAuthorizeTest):
+    """Tests pertaining to transaction caches and process_void_or_credit."""
+    
+    def setUp(self):
+        PyAuthorizeTest.setUp(self)
+        self.gateway = pyauthorize_testing.FakeGateway()
+        self.gateway.start()
+        self.pp.post_url = self.gateway.url
+        self.pp.amount = '10.00'
+        self.pp.transaction_cache = pyauthorize.MemoryTransactionCache()
+        self.pp.settlement_cutoff = datetime.time(0, 0)
+    
+    def tearDown(self):
+        self.gateway.stop()
+    
+    def _refund(self, charged_days_ago):
+        """Charge, then refund with a new processor sharing the cache."""
+        
+        self.pp.auth_and_capture()
+        tools.eq_(self.pp.process(), True)
+        record = self.pp.transaction_cache.get(self.pp.trans_id)
+        self.pp.transaction_cache.put(record._replace(
+                timestamp=record.timestamp - charged_days_ago * 86400))
+        
+        refund = pyauthorize.PaymentProcessor('login', 'key')
+        refund.post_url = self.gateway.url
+        refund.transaction_cache = self.pp.transaction_cache
+        refund.settlement_cutoff = self.pp.settlement_cutoff
+        refund.transaction = self.pp.trans_id
+        return refund
+    
+    def test_charges_are_recorded(self):
+        """Approved charges and captures are recorded."""
+        
+        self.pp.auth_only()
+        self.pp.process()
+        record = self.pp.transaction_cache.get(self.pp.trans_id)
+        tools.eq_((record.type, record.amount, record.last_four),
+                ('AUTH_ONLY', '10.00', '1111'))
+        
+        self.pp.transaction = self.pp.trans_id
+        self.pp.prior_auth_capture()
+        self.pp.process()
+        record = self.pp.transaction_cache.get(self.pp.trans_id)
+        tools.eq_((record.type, record.amount),
+                ('PRIOR_AUTH_CAPTURE', '10.00'))
+        
+        self.pp.card_num = '4222222222222'
+        self.pp.auth_only()
+        self.pp.process()
+        tools.eq_(self.pp.transaction_cache.get(self.pp.trans_id), None)
+    
+    def test_settled_charge_is_credited_first(self):
+        """A charge that has settled is credited in one request."""
+        
+        refund = self._refund(charged_days_ago=2)
+        self.gateway.settle()
+        
+        tools.eq_(refund.process_void_or_credit(), (True, 'Credit'))
+        tools.eq_(self.gateway.stats.get('VOID', 0), 0)
+        tools.eq_(self.gateway.stats['CREDIT'], 1)
+    
+    def test_unsettled_charge_is_voided_first(self):
+        """A charge that can't have settled yet is voided."""
+        
+        refund = self._refund(charged_days_ago=0)
+        refund.settlement_cutoff = (datetime.datetime.now()
+                + datetime.timedelta(hours=1)).time()
+        
+        tools.eq_(refund.process_void_or_credit(), (True, 'Void'))
+        tools.eq_(self.gateway.stats.get('CREDIT', 0), 0)
+    
+    def test_wrong_guess_falls_back_to_void(self):
+        """A charge wrongly predicted to have settled is still voided."""
+        
+        refund = self._refund(charged_days_ago=2)
+        
+        tools.eq_(refund.process_void_or_credit(), (True, 'Void'))
+        tools.eq_(self.gateway.stats['CREDIT'], 1)
+        tools.eq_(self.gateway.stats['VOID'], 1)
+        tools.eq_(sorted(refund.transaction_data), ['x_trans_id', 'x_type'])
+    
+    def test_predict_settled(self):
+        """Captures settle at the first cutoff after them."""
+        
+        captured = time.mktime((2026, 3, 10, 15, 0, 0, 0, 0, -1))
+        record = pyauthorize.TransactionRecord('1', 'AUTH_CAPTURE', '1.00',
+                '1111', captured)
+        cutoff = datetime.time(16, 0)
+        
+        tools.eq_(pyauthorize.predict_settled(record, cutoff,
+                captured + 3599), False)
+        tools.eq_(pyauthorize.predict_settled(record, cutoff,
+                captured + 3600), True)
+        tools.eq_(pyauthorize.predict_settled(record._replace(
+                timestamp=captured + 7200), cutoff, captured + 86399), False)
+        tools.eq_(pyauthorize.predict_settled(record._replace(
+                type='AUTH_ONLY'), cutoff, captured + 86400 * 30), False)
+    
+    def test_memory_cache_limits(self):
+        """MemoryTransactionCache drops old and least recently used records."""
+        
+        cache = pyauthorize.MemoryTransactionCache(max_size=2, max_age=60)
+        now = time.time()
+        for trans_id in '123':
+            cache.put(pyauthorize.TransactionRecord(trans_id, 'AUTH_CAPTURE',
+                    '1.00', '1111', now))
+        cache.put(pyauthorize.TransactionRecord('4', 'AUTH_CAPTURE', '1.00',
+                '1111', now - 61))
+        
+        tools.eq_(len(cache), 2)
+        tools.eq_(cache.get('1'), None)
+        tools.eq_(cache.get('4'), None)
+        tools.eq_(cache.get('3').trans_id, '3')
+    
+    def test_shelve_cache_survives_restarts(self):
+        """ShelveTransactionCache keeps records on disk."""
+        
+        path = os.path.join(tempfile.mkdtemp(), 'transactions')
+        cache = pyauthorize.ShelveTransactionCache(path, max_age=60)
+        record = pyauthorize.TransactionRecord('1', 'AUTH_CAPTURE', '1.00',
+                '1111', time.time())
+        cache.put(record)
+        cache.put(record._replace(trans_id='2', timestamp=time.time() - 61))
+        cache.close()
+        
+        cache = pyauthorize.ShelveTransactionCache(path, max_age=60)
+        tools.eq_(cache.get('1'), record)
+        tools.eq_(len(cache), 1)
+        cache.close()
+
+
+class PyAuthorizeRetryTest(PyAuthorizeTest):
+    """Tests pertaining to RetryPolicy, timeouts and retries."""
+    
+    def setUp(self):
+        PyAuthorizeTest.setUp(self)
+        self.gateway = pyauthorize_testing.FakeGateway()
+        self.gateway.start()
+        self.pp.post_url = self.gateway.url
+        self.pp.connection_pool = pyauthorize.ConnectionPool()
+        self.pp.amount = '10.00'
+        self.pp.retry_policy = pyauthorize.RetryPolicy(backoff=0)
+        self.retries = []
+        self.pp.observers.append(self)
+    
+    def tearDown(self):
+        self.gateway.stop()
+    
+    def on_retry(self, transaction_type, attempt, error):
+        """Observer method recording retries and healing the gateway."""
+        
+        self.retries.append((transaction_type, attempt, error))
+        self.gateway.error_rate = 0
+        self.gateway.http_error_rate = 0
+        self.gateway.lost_response_rate = 0
+        self.gateway.max_requests_per_second = None
+    
+    def test_transient_errors_are_retried(self):
+        """HTTP 500s and "try again" responses are retried."""
+        
+        self.pp.auth_and_capture()
+        tools.eq_(self.pp.process(), True)
+        self.pp.transaction = self.pp.trans_id
+        self.pp.void()
+        self.gateway.http_error_rate = 1
+        tools.eq_(self.pp.process(), True)
+        
+        self.pp.auth_and_capture()
+        self.gateway.error_rate = 1
+        tools.eq_(self.pp.process(), True)
+        
+        tools.eq_([(transaction_type, attempt) for transaction_type, attempt,
+                   error in self.retries],
+                [('VOID', 1), ('AUTH_CAPTURE', 1)])
+        tools.eq_(self.retries[0][2].code, 500)
+        tools.eq_(self.retries[1][2].reason_code, '19')
+    
+    def test_unkeyed_charges_are_not_retried(self):
+        """Charges without an invoice number are only retried when unsent."""
+        
+        self.pp.auth_and_capture()
+        self.gateway.http_error_rate = 1
+        tools.assert_raises(urllib2.HTTPError, self.pp.process)
+        tools.eq_(self.retries, [])
+        
+        self.gateway.max_requests_per_second = 1
+        tools.eq_(self.pp.process(), True)
+        tools.eq_(self.retries[0][2].code, 503)
+    
+    def test_keyed_charges_are_not_charged_twice(self):
+        """A retried charge whose response was lost returns its approval."""
+        
+        self.pp.invoice_number = '1001'
+        self.pp.auth_and_capture()
+        self.gateway.lost_response_rate = 1
+        
+        tools.eq_(self.pp.process(), True)
+        tools.eq_(len(self.retries), 1)
+        tools.eq_(self.pp.reason_code, '1')
+        tools.eq_(self.pp.trans_id, '2149186775')
+        tools.eq_(self.pp.response.approval_code,
+                self.gateway.transactions['2149186775']['approval_code'])
+        tools.eq_(len(self.gateway.transactions), 1)
+    
+    def test_repeated_charges_are_duplicates(self):
+        """A charge repeated by the caller is still rejected as a duplicate."""
+        
+        self.pp.invoice_number = '1001'
+        self.pp.auth_and_capture()
+        tools.eq_(self.pp.process(), True)
+        
+        tools.eq_(self.pp.process(), False)
+        tools.eq_(self.pp.reason_code, '11')
+        tools.eq_(self.retries, [])
+        tools.eq_(len(self.gateway.transactions), 1)
+    
+    def test_attempts_are_limited(self):
+        """A transaction is sent at most max_attempts times."""
+        
+        self.pp.observers.remove(self)
+        self.pp.transaction = '2149186775'
+        self.pp.void()
+        self.gateway.http_error_rate = 1
+        
+        tools.assert_raises(urllib2.HTTPError, self.pp.process)
+        tools.eq_(self.gateway.stats['http_errors'], 3)
+    
+    def test_budget_bounds_retries(self):
+        """Timeouts are retried within the retry budget."""
+        
+        self.pp.retry_policy.budget = 0.5
+        self.pp.timeout = 0.2
+        self.gateway.latency = 1
+        self.pp.transaction = '2149186775'
+        self.pp.void()
+        
+        started = time.time()
+        tools.assert_raises(socket.timeout, self.pp.process)
+        assert time.time() - started < 0.7
+        tools.eq_(len(self.retries), 2)
+    
+    def test_timeout_covers_whole_request(self):
+        """The pool's timeout is a deadline, not a per-read timeout."""
+        
+        pool = pyauthorize.ConnectionPool()
+        self.gateway.latency = 0.3
+        started = time.time()
+        tools.assert_raises(socket.timeout, pool.request, self.gateway.url,
+                'x_type=VOID', 0.1)
+        assert time.time() - started < 0.3
+    
+    def test_delay(self):
+        """Backoff grows exponentially up to max_backoff, with jitter."""
+        
+        policy = pyauthorize.RetryPolicy(backoff=1, max_backoff=3)
+        for attempt, bound in ((1, 1), (2, 2), (3, 3), (10, 3)):
+            delays = [policy.delay(attempt) for i in range(100)]
+            assert 0 <= min(delays) and max(delays) <= bound
+            assert max(delays) > bound / 2.0
+
+
+class PyAuthorizeCircuitBreakerTest(PyAuthorizeTest):
+    """Tests pertaining to CircuitBreaker."""
+    
+    def setUp(self):
+        PyAuthorizeTest.setUp(self)
+        self.gateway = pyauthorize_testing.FakeGateway()
+        self.gateway.start()
+        self.breaker = pyauthorize.CircuitBreaker(window=4, min_calls=4,
+                open_seconds=60, half_open_probes=2)
+        self.transitions = []
+        self.breaker.listeners.append(lambda breaker, old, new:
+                self.transitions.append((old, new)))
+        self.pp.post_url = self.gateway.url
+        self.pp.circuit_breaker = self.breaker
+        self.pp.amount = '1.00'
+        self.pp.auth_only()
+    
+    def tearDown(self):
+        self.gateway.stop()
+    
+    def _trip(self):
+        """Fail enough requests to open the breaker."""
+        
+        self.gateway.http_error_rate = 1
+        for i in range(4):
+            tools.assert_raises(urllib2.HTTPError, self.pp.process)
+        self.gateway.http_error_rate = 0
+    
+    def test_opens_on_errors(self):
+        """The breaker opens on errors, then fails fast."""
+        
+        self._trip()
+        
+        tools.eq_(self.breaker.state, 'open')
+        tools.assert_raises(pyauthorize.CircuitOpen, self.pp.process)
+        tools.eq_(self.gateway.stats['requests'], 4)
+        tools.eq_(self.transitions, [('closed', 'open')])
+        
+        snapshot = self.breaker.snapshot()
+        tools.eq_(snapshot['stats'], {'calls': 4, 'failures': 4,
+                                      'slow_calls': 0, 'rejected': 1})
+        tools.eq_([transition[1:] for transition in snapshot['transitions']],
+                [('closed', 'open')])
+    
+    def test_opens_on_latency(self):
+        """The breaker opens when calls are slow."""
+        
+        self.breaker.slow_call_seconds = 0.05
+        self.breaker.min_calls = 2
+        self.gateway.latency = 0.1
+        
+        tools.eq_(self.pp.process(), True)
+        tools.eq_(self.pp.process(), True)
+        tools.assert_raises(pyauthorize.CircuitOpen, self.pp.process)
+    
+    def test_half_open_probes(self):
+        """Probes close the breaker again, or reopen it on a failure."""
+        
+        self._trip()
+        self.breaker.open_seconds = 0.05
+        time.sleep(0.1)
+        self.gateway.http_error_rate = 1
+        tools.assert_raises(urllib2.HTTPError, self.pp.process)
+        tools.eq_(self.breaker.state, 'open')
+        
+        time.sleep(0.1)
+        self.gateway.http_error_rate = 0
+        tools.eq_(self.pp.process(), True)
+        tools.eq_(self.breaker.state, 'half_open')
+        tools.eq_(self.pp.process(), True)
+        tools.eq_(self.breaker.state, 'closed')
+        tools.eq_(self.transitions, [('closed', 'open'), ('open', 'half_open'),
+                ('half_open', 'open'), ('open', 'half_open'),
+                ('half_open', 'closed')])
+    
+    def test_probes_are_limited(self):
+        """Calls beyond half_open_probes fail fast while half-open."""
+        
+        self._trip()
+        self.breaker.open_seconds = 0
+        self.breaker.half_open_probes = 1
+        
+        def probe():
+            tools.assert_raises(pyauthorize.CircuitOpen, self.breaker.call,
+                    self.pp.process)
+            return self.pp.process()
+        
+        self.pp.circuit_breaker = None
+        tools.eq_(self.breaker.call(probe), True)
+        tools.eq_(self.breaker.state, 'closed')
+    
+    def test_open_circuit_is_not_retried(self):
+        """CircuitOpen fails fast even with a retry policy."""
+        
+        self.pp.retry_policy = pyauthorize.RetryPolicy(backoff=0)
+        self.pp.transaction = '2149186775'
+        self.pp.void()
+        self.gateway.http_error_rate = 1
+        tools.assert_raises(urllib2.HTTPError, self.pp.process)
+        
+        # The breaker opens on the second attempt's failure.
+        tools.assert_raises(pyauthorize.CircuitOpen, self.pp.process)
+        tools.eq_(self.gateway.stats['requests'], 4)
+
+
+class RecordingTransport(pyauthorize.Transport):
+    """Transport answering every request with APPROVED_RESPONSE."""
+    
+    def __init__(self):
+        self.requests = []
+    
+    def request(self, url, data, timeout=None):
+        self.requests.append((url, data, timeout))
+        return APPROVED_RESPONSE
+
+
+class PyAuthorizeTransportTest(PyAuthorizeTest):
+    """Tests pertaining to Transport and its implementations."""
+    
+    def setUp(self):
+        PyAuthorizeTest.setUp(self)
+        self.gateway = pyauthorize_testing.FakeGateway()
+        self.gateway.start()
+        self.pp.post_url = self.gateway.url
+        self.pp.amount = '1.00'
+        self.pp.auth_only()
+    
+    def tearDown(self):
+        self.gateway.stop()
+    
+    def test_default_transport(self):
+        """Outside of App Engine, processors share the connection pool."""
+        
+        tools.assert_raises(ImportError, pyauthorize.AppEngineTransport)
+        tools.assert_true(pyauthorize.default_transport()
+                is pyauthorize.connection_pool)
+        tools.assert_true(self.pp.transport is pyauthorize.connection_pool)
+    
+    def test_module_transport(self):
+        """The module-level transport is used by new processors."""
+        
+        transport = RecordingTransport()
+        original = pyauthorize.transport
+        pyauthorize.transport = transport
+        try:
+            processor = pyauthorize.PaymentProcessor('login', 'key')
+        finally:
+            pyauthorize.transport = original
+        
+        tools.assert_true(processor.transport is transport)
+    
+    def test_custom_transport(self):
+        """process() posts through the processor's transport."""
+        
+        transport = RecordingTransport()
+        self.pp.transport = transport
+        
+        tools.eq_(self.pp.process(5), True)
+        url, data, timeout = transport.requests[0]
+        tools.eq_(url, self.gateway.url)
+        tools.eq_(urlparse.parse_qs(data)['x_type'], ['AUTH_ONLY'])
+        tools.eq_(timeout, 5)
+        tools.eq_(self.gateway.stats['requests'], 0)
+    
+    def test_urllib_transport(self):
+        """UrllibTransport posts and raises HTTPError on HTTP errors."""
+        
+        self.pp.transport = pyauthorize.UrllibTransport()
+        tools.eq_(self.pp.process(), True)
+        
+        self.gateway.http_error_rate = 1
+        tools.assert_raises(urllib2.HTTPError, self.pp.process)
+    
+    def test_connection_pool_none(self):
+        """Setting connection_pool to None falls back to urllib2."""
+        
+        self.pp.connection_pool = None
+        
+        tools.assert_true(isinstance(self.pp.transport,
+                pyauthorize.UrllibTransport))
+        tools.eq_(self.pp.process(), True)
+
+
+class PyAuthorizeBatchTest(unittest.TestCase):
+    """Tests pertaining to pyauthorize_batch."""
+    
+    def setUp(self):
+        self.gateway = pyauthorize_testing.FakeGateway()
+        self.gateway.start()
+        self.client = pyauthorize.Gateway('login', 'key')
+        self.client.post_url = self.gateway.url
+        self.directory = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.directory, 'results.jsonl')
+        self.checkpoint_path = os.path.join(self.directory, 'checkpoint')
+        
+        # Two settled charges to refund.
+        self.trans_ids = []
+        exp_date = datetime.date.today().strftime('%m%Y')
+        for i in range(2):
+            response = self.client.submit(pyauthorize.Transaction
+                    .auth_and_capture('4111111111111111', exp_date, '10.00'))
+            self.trans_ids.append(response.trans_id)
+        self.gateway.settle()
+    
+    def tearDown(self):
+        self.gateway.stop()
+        shutil.rmtree(self.directory)
+    
+    def _write(self, name, content):
+        """Write an input file and return its path."""
+        
+        path = os.path.join(self.directory, name)
+        input_file = open(path, 'w')
+        try:
+            input_file.write(content)
+        finally:
+            input_file.close()
+        return path
+    
+    def _results(self):
+        """Return the results written so far, by row."""
+        
+        output = open(self.output_path)
+        try:
+            results = [json.loads(line) for line in output]
+        finally:
+            output.close()
+        return sorted(results, key=lambda result: result['row'])
+    
+    def test_run_batch(self):
+        """Every row is validated, sent and written out."""
+        
+        input_path = self._write('refunds.csv',
+                'transaction,amount,card_num\n'
+                '%s,4.00,1111\n'
+                'not a transaction,4.00,1111\n'
+                '%s,6.00,1111\n' % tuple(self.trans_ids))
+        
+        counts = pyauthorize_batch.run_batch(self.client, input_path,
+                self.output_path, self.checkpoint_path, 'credit',
+                max_concurrency=2)
+        
+        tools.eq_(counts['approved'], 2)
+        tools.eq_(counts['invalid'], 1)
+        tools.eq_([result['status'] for result in self._results()],
+                ['approved', 'invalid', 'approved'])
+        tools.eq_([result.get('category') for result in self._results()],
+                ['approved', None, 'approved'])
+        tools.eq_(self.gateway.stats['CREDIT'], 2)
+        
+        # Running the finished job again sends nothing.
+        counts = pyauthorize_batch.run_batch(self.client, input_path,
+                self.output_path, self.checkpoint_path, 'credit')
+        tools.eq_(counts['skipped'], 3)
+        tools.eq_(self.gateway.stats['CREDIT'], 2)
+    
+    def test_resume(self):
+        """A restarted job doesn't send credits that may have been sent."""
+        
+        input_path = self._write('refunds.jsonl', '\n'.join(json.dumps(row)
+                for row in [
+                    {'type': 'credit', 'transaction': self.trans_ids[0],
+                     'amount': '4.00', 'card_num': '1111'},
+                    {'type': 'credit', 'transaction': self.trans_ids[1],
+                     'amount': '4.00', 'card_num': '1111'},
+                    {'type': 'void', 'transaction': self.trans_ids[1]},
+                    {'type': 'credit', 'transaction': self.trans_ids[1],
+                     'amount': 5, 'card_num': '1111'},
+                ]))
+        # The first run answered row 1 and stopped with rows 2 and 3 sent.
+        checkpoint = pyauthorize_batch.Checkpoint(self.checkpoint_path,
+                input_path)
+        checkpoint.pending = set([2, 3])
+        checkpoint.next_row = 4
+        checkpoint.save()
+        
+        counts = pyauthorize_batch.run_batch(self.client, input_path,
+                self.output_path, self.checkpoint_path)
+        
+        tools.eq_(counts, {'approved': 1, 'declined': 1, 'error': 0,
+                           'invalid': 0, 'unknown': 1, 'skipped': 1})
+        tools.eq_([(result['row'], result['status'])
+                   for result in self._results()],
+                [(2, 'unknown'), (3, 'declined'), (4, 'approved')])
+        tools.eq_(self.gateway.stats['CREDIT'], 1)
+        tools.eq_(self.gateway.stats['VOID'], 1)
+    
+    def test_resume_from_results(self):
+        """Rows with a result in the output file count as answered."""
+        
+        input_path = self._write('refunds.csv',
+                'transaction,amount,card_num\n'
+                '%s,4.00,1111\n'
+                '%s,4.00,1111\n' % tuple(self.trans_ids))
+        # The first run wrote row 1 and crashed writing row 2, before the
+        # checkpoint was saved again.
+        checkpoint = pyauthorize_batch.Checkpoint(self.checkpoint_path,
+                input_path)
+        checkpoint.start(1)
+        checkpoint.start(2)
+        output = open(self.output_path, 'w')
+        try:
+            output.write('%s\n{"row": 2, "sta' % json.dumps({'row': 1,
+                    'status': 'approved'}))
+        finally:
+            output.close()
+        
+        counts = pyauthorize_batch.run_batch(self.client, input_path,
+                self.output_path, self.checkpoint_path, 'credit')
+        
+        tools.eq_((counts['skipped'], counts['unknown']), (1, 1))
+        tools.eq_(self.gateway.stats.get('CREDIT', 0), 0)
+        tools.eq_([(result['row'], result['status'])
+                   for result in self._results()],
+                [(1, 'approved'), (2, 'unknown')])
+        tools.eq_(pyauthorize_batch.Checkpoint(self.checkpoint_path,
+                input_path).pending, set())
+    
+    def test_checkpoint_of_other_input(self):
+        """A checkpoint isn't used for another input file."""
+        
+        checkpoint = pyauthorize_batch.Checkpoint(self.checkpoint_path,
+                'captures.csv')
+        checkpoint.save()
+        
+        tools.assert_raises(ValueError, pyauthorize_batch.Checkpoint,
+                self.checkpoint_path, 'refunds.csv')
+    
+    def test_main(self):
+        """The command line runner writes CSV results."""
+        
+        input_path = self._write('voids.csv', 'transaction\n%s\n' %
+                self.trans_ids[0])
+        output_path = os.path.join(self.directory, 'results.csv')
+        
+        status = pyauthorize_batch.main(['--type', 'void', '--url',
+                self.gateway.url, '--login', 'login', '--tran-key', 'key',
+                input_path, output_path])
+        
+        tools.eq_(status, 0)
+        output = open(output_path)
+        try:
+            rows = list(csv.DictReader(output))
+        finally:
+            output.close()
+        tools.eq_([(row['row'], row['status']) for row in rows],
+                [('1', 'declined')])
+
+
+class PyAuthorizeReconcileTest(unittest.TestCase):
+    """Tests pertaining to pyauthorize_reconcile."""
+    
+    def setUp(self):
+        self.gateway = pyauthorize_testing.FakeGateway()
+        self.gateway.start()
+        self.directory = tempfile.mkdtemp()
+        self.journal = pyauthorize.TransactionJournal(
+                os.path.join(self.directory, 'journal'))
+        self.client = pyauthorize.Gateway('login', 'key')
+        self.client.post_url = self.gateway.url
+        self.client.journal = self.journal
+        self.settlement_path = os.path.join(self.directory, 'settlement.csv')
+    
+    def tearDown(self):
+        self.journal.close()
+        self.gateway.stop()
+        shutil.rmtree(self.directory)
+    
+    def _submit(self, transaction_type, *args, **kwargs):
+        """Submit a transaction and return its transaction id."""
+        
+        if transaction_type in ('auth_only', 'auth_and_capture'):
+            args = ('4111111111111111',
+                    datetime.date.today().strftime('%m%Y')) + args
+        response = self.client.submit(getattr(pyauthorize.Transaction,
+                transaction_type)(*args, **kwargs))
+        tools.eq_(response.is_approved, True)
+        return response.trans_id
+    
+    def _settle(self):
+        """Journal transactions, settle them and tamper with the file.
+        
+        Returns:
+            The expected mismatches, as sorted (kind, trans_id) pairs.
+        """
+        
+        settled = self._submit('auth_and_capture', '10.00',
+                invoice_number='A1')
+        captured = self._submit('auth_only', '20.00')
+        self._submit('prior_auth_capture', captured, '15.00')
+        voided = self._submit('auth_and_capture', '5.00')
+        self._submit('void', voided)
+        authorized = self._submit('auth_only', '7.00')
+        changed = self._submit('auth_and_capture', '8.00')
+        first = self._submit('auth_and_capture', '1.00', invoice_number='B2')
+        second = self._submit('auth_and_capture', '2.00', invoice_number='B2')
+        self.gateway.settle()
+        self._submit('credit', settled, '1111', '3.00')
+        unsettled = self._submit('auth_and_capture', '4.00')
+        self.gateway.write_settlement(self.settlement_path)
+        
+        settlement = open(self.settlement_path, 'rb')
+        contents = settlement.read()
+        settlement.close()
+        contents = contents.replace('%s,Settled Successfully,8.00' % changed,
+                '%s,Settled Successfully,9.00' % changed)
+        contents += ''.join('%s,Settled Successfully,%s,,\r\n' % row
+                            for row in [('1', '1.00'), (voided, '5.00'),
+                                        (settled, '10.00'),
+                                        (authorized, '7.00')])
+        settlement = open(self.settlement_path, 'wb')
+        settlement.write(contents)
+        settlement.close()
+        
+        return sorted([('missing_locally', '1'),
+                       ('voided_but_settled', voided),
+                       ('duplicate_capture', settled),
+                       ('not_captured', authorized),
+                       ('amount_differs', changed),
+                       ('missing_in_settlement', unsettled),
+                       ('duplicate_capture', first),
+                       ('duplicate_capture', second)])
+    
+    def test_reconcile(self):
+        """Every kind of mismatch is found, however the file is split."""
+        
+        expected = self._settle()
+        ledger = pyauthorize_reconcile.Ledger.from_journal(
+                self.journal.directory)
+        
+        for processes, chunk_size in ((1, 1024 * 1024), (2, 64)):
+            mismatches = list(pyauthorize_reconcile.reconcile(
+                    self.settlement_path, ledger, processes,
+                    chunk_size=chunk_size))
+            tools.eq_(sorted((mismatch.kind, mismatch.trans_id)
+                             for mismatch in mismatches), expected)
+        
+        amount_differs = [mismatch for mismatch in mismatches
+                          if mismatch.kind == 'amount_differs'][0]
+        tools.eq_((amount_differs.journaled_amount,
+                   amount_differs.settled_amount), ('8.00', '9.00'))
+    
+    def test_ledger_period(self):
+        """Only the responses within the period are loaded."""
+        
+        self._submit('auth_and_capture', '10.00')
+        
+        tools.eq_(len(pyauthorize_reconcile.Ledger.from_journal(
+                self.journal.directory)), 1)
+        tools.eq_(len(pyauthorize_reconcile.Ledger.from_journal(
+                self.journal.directory, until=time.time() - 3600)), 0)
+    
+    def test_chunk_lines(self):
+        """Every line is read by exactly one chunk."""
+        
+        path = os.path.join(self.directory, 'lines')
+        lines = open(path, 'wb')
+        lines.write('header\n' + ''.join('%d\n' % i for i in range(100)))
+        lines.close()
+        
+        for chunk_size in (1, 2, 3, 7, 50, 1000):
+            read = []
+            for start in range(7, os.path.getsize(path), chunk_size):
+                read.extend(pyauthorize_reconcile._chunk_lines(path, start,
+                        start + chunk_size))
+            tools.eq_(read, ['%d\n' % i for i in range(100)])
+    
+
+class PyAuthorizeJournalTest(PyAuthorizeTest):
+    """Tests pertaining to TransactionJournal and JournalReader."""
+    
+    def setUp(self):
+        PyAuthorizeTest.setUp(self)
+        self.gateway = pyauthorize_testing.FakeGateway()
+        self.gateway.start()
+        self.directory = tempfile.mkdtemp()
+        self.journal = pyauthorize.TransactionJournal(self.directory)
+        self.pp.post_url = self.gateway.url
+        self.pp.journal = self.journal
+        self.pp.amount = '12.00'
+        self.pp.card_code = '123'
+        self.pp.is_ccv_required = True
+        self.pp.invoice_number = '1001'
+    
+    def tearDown(self):
+        self.journal.close()
+        self.gateway.stop()
+        shutil.rmtree(self.directory)
+    
+    def test_requests_and_responses_are_logged(self):
+        """Requests are logged masked, with their responses and errors."""
+        
+        self.pp.auth_and_capture()
+        tools.eq_(self.pp.process(), True)
+        self.gateway.http_error_rate = 1
+        tools.assert_raises(urllib2.HTTPError, self.pp.process)
+        
+        records = list(pyauthorize.JournalReader(self.directory))
+        
+        tools.eq_([record.kind for record in records],
+                ['request', 'response', 'request', 'error'])
+        tools.eq_(records[0].request_id, records[1].request_id)
+        tools.eq_(records[0].data['x_card_num'], '1111')
+        assert 'x_card_code' not in records[0].data
+        tools.eq_(records[1].data.trans_id, self.pp.trans_id)
+        assert records[3].data.startswith('HTTPError')
+        assert '4111111111111111' not in open(os.path.join(self.directory,
+                os.listdir(self.directory)[0]), 'rb').read()
+    
+    def test_lookup(self):
+        """Records are found by transaction id and invoice number."""
+        
+        self.pp.invoice_number = '1002'
+        self.pp.auth_only()
+        self.pp.process()
+        self.pp.invoice_number = '1001'
+        self.pp.auth_only()
+        self.pp.process()
+        trans_id = self.pp.trans_id
+        self.pp.transaction = trans_id
+        self.pp.prior_auth_capture()
+        self.pp.process()
+        
+        reader = pyauthorize.JournalReader(self.directory)
+        
+        records = reader.lookup(trans_id=trans_id)
+        tools.eq_([record.kind for record in records],
+                ['request', 'response', 'request', 'response'])
+        tools.eq_(records[0].data['x_type'], 'AUTH_ONLY')
+        tools.eq_(records[2].data['x_type'], 'PRIOR_AUTH_CAPTURE')
+        tools.eq_(records[3].data.trans_id, trans_id)
+        tools.eq_(len(reader.lookup(invoice_number='1002')), 2)
+        tools.eq_(reader.lookup(trans_id='42'), [])
+    
+    def test_segments_rotate(self):
+        """A new segment is started once one is full."""
+        
+        self.journal.segment_size = 512
+        self.pp.auth_only()
+        for i in range(5):
+            self.pp.process()
+        
+        tools.assert_true(len(os.listdir(self.directory)) > 1)
+        tools.eq_(len(list(pyauthorize.JournalReader(self.directory))), 10)
+        
+        # Reopening the journal starts a new segment.
+        self.journal.close()
+        self.journal = pyauthorize.TransactionJournal(self.directory)
+        tools.eq_(self.journal.stats['segments'], 1)
+        tools.eq_(len(os.listdir(self.directory)),
+                self.journal._segment_number)
+    
+    def test_torn_record_is_ignored(self):
+        """A record cut short by a crash ends its segment."""
+        
+        self.pp.auth_only()
+        self.pp.process()
+        self.pp.process()
+        self.journal.close()
+        
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        segment = open(path, 'rb+')
+        try:
+            segment.truncate(os.path.getsize(path) - 3)
+        finally:
+            segment.close()
+        
+        tools.eq_(len(list(pyauthorize.JournalReader(self.directory))), 3)
+    
+    def test_group_commit(self):
+        """Concurrent writers share fsyncs."""
+        
+        self.journal.commit_interval = 0.01
+        
+        def log():
+            for i in range(10):
+                request_id = self.journal.log_request({'x_type': 'VOID'})
+                self.journal.log_error(request_id, ValueError('Oops.'))
+        
+        threads = [threading.Thread(target=log) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        tools.eq_(self.journal.stats['records'], 160)
+        assert self.journal.stats['commits'] < 80
+        tools.eq_(len(list(pyauthorize.JournalReader(self.directory))), 160)
+
+
+class PyAuthorizeTrafficRecorderTest(PyAuthorizeTest):
+    """Tests pertaining to TrafficRecorder and replaying traffic."""
+    
+    def setUp(self):
+        PyAuthorizeTest.setUp(self)
+        self.gateway = pyauthorize_testing.FakeGateway()
+        self.gateway.start()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'traffic.gz')
+        self.pp.post_url = self.gateway.url
+        self.pp.recorder = pyauthorize.TrafficRecorder(self.path)
+        self.pp.amount = '12.00'
+        self.pp.card_code = '123'
+        self.pp.is_ccv_required = True
+        self.pp.zip = '60654'
+    
+    def tearDown(self):
+        self.gateway.stop()
+        shutil.rmtree(self.directory)
+    
+    def _record(self):
+        """Record an authorization, its capture and a failed void."""
+        
+        self.pp.auth_only()
+        self.pp.process()
+        self.pp.transaction = self.pp.trans_id
+        self.pp.prior_auth_capture()
+        self.pp.process()
+        self.gateway.http_error_rate = 1
+        self.pp.void()
+        tools.assert_raises(urllib2.HTTPError, self.pp.process)
+        self.gateway.http_error_rate = 0
+        self.pp.recorder.close()
+    
+    def test_recording(self):
+        """Requests are recorded with their card number and code masked."""
+        
+        self._record()
+        records = list(pyauthorize.read_traffic(self.path))
+        
+        tools.eq_(len(records), 3)
+        fields = dict(records[0].fields)
+        tools.eq_(fields['x_type'], 'AUTH_ONLY')
+        tools.eq_(fields['x_card_num'], '411111******1111')
+        tools.eq_(fields['x_card_code'], '***')
+        tools.eq_(fields['x_zip'], '60654')
+        tools.eq_(records[0].response.is_approved, True)
+        tools.eq_(dict(records[1].fields)['x_type'], 'PRIOR_AUTH_CAPTURE')
+        assert records[2].error.startswith('HTTPError')
+        assert records[1].timestamp >= records[0].timestamp
+        
+        contents = gzip.open(self.path).read()
+        assert '4111111111111111' not in contents
+        assert self.pp.configuration['x_tran_key'] not in contents
+    
+    def test_replay(self):
+        """Replayed captures and voids refer to the replayed authorization."""
+        
+        self._record()
+        
+        results = pyauthorize_bench.replay_traffic(self.path, speed=None)
+        
+        tools.eq_(results['requests'], 3)
+        tools.eq_(results['types'], {'AUTH_ONLY': 1, 'PRIOR_AUTH_CAPTURE': 1,
+                                     'VOID': 1})
+        tools.eq_(results['outcomes'], {'approved': 3})
+        tools.eq_(results['recorded_latency_ms']['max'] > 0, True)
+    
+
+class PyAuthorizeRateLimiterTest(PyAuthorizeTest):
+    """Tests pertaining to RateLimiter and SharedRateLimiter."""
+    
+    def setUp(self):
+        PyAuthorizeTest.setUp(self)
+        self.directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_burst_then_rate(self):
+        """A bucket allows burst requests, then rate a second."""
+        
+        limiter = pyauthorize.RateLimiter(rate=20, burst=3)
+        
+        for i in range(3):
+            tools.eq_(limiter.acquire('login', blocking=False), True)
+        tools.eq_(limiter.acquire('login', blocking=False), False)
+        tools.eq_(limiter.acquire('other login', blocking=False), True)
+        
+        started = time.time()
+        tools.eq_(limiter.acquire('login'), True)
+        assert 0.02 < time.time() - started < 0.5
+        tools.eq_(limiter.acquire('login', timeout=0.01), False)
+    
+    def test_shared_buckets(self):
+        """Shared limiters on one directory draw from the same bucket."""
+        
+        first = pyauthorize.SharedRateLimiter(self.directory, rate=1,
+                burst=2)
+        second = pyauthorize.SharedRateLimiter(self.directory, rate=1,
+                burst=2)
+        try:
+            tools.eq_(first.acquire('login', blocking=False), True)
+            tools.eq_(second.acquire('login', blocking=False), True)
+            tools.eq_(first.acquire('login', blocking=False), False)
+            tools.eq_(second.acquire('login', blocking=False), False)
+            tools.eq_(second.acquire('other login', blocking=False), True)
+        finally:
+            first.close()
+            second.close()
+        
+        assert not any('login' in name for name in os.listdir(self.directory))
+    
+    def test_shared_between_processes(self):
+        """Processes sharing a directory share the bucket."""
+        
+        limiter = pyauthorize.SharedRateLimiter(self.directory, rate=0.001,
+                burst=5)
+        results = multiprocessing.Queue()
+        
+        def take():
+            results.put(sum(limiter.acquire('login', blocking=False)
+                            for i in range(5)))
+        
+        processes = [multiprocessing.Process(target=take) for i in range(3)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        
+        tools.eq_(sum(results.get() for process in processes), 5)
+        limiter.close()
+    
+    def test_processor_waits_for_tokens(self):
+        """process() waits for a token, and gives up after its timeout."""
+        
+        with pyauthorize_testing.FakeGateway() as gateway:
+            self.pp.post_url = gateway.url
+            self.pp.rate_limiter = pyauthorize.RateLimiter(rate=10, burst=1)
+            self.pp.amount = '1.00'
+            self.pp.auth_only()
+            
+            tools.eq_(self.pp.process(), True)
+            tools.eq_(self.pp.process(1), True)
+            tools.assert_raises(pyauthorize.RateLimited, self.pp.process,
+                    0.01)
+            tools.eq_(gateway.stats['requests'], 2)
+    
+    def test_no_time_left_after_waiting(self):
+        """A token coming as the timeout runs out isn't used to send."""
+        
+        class SlowLimiter(object):
+            def acquire(self, x_login, timeout=None):
+                time.sleep(timeout)
+                return True
+        
+        with pyauthorize_testing.FakeGateway() as gateway:
+            self.pp.post_url = gateway.url
+            self.pp.rate_limiter = SlowLimiter()
+            self.pp.amount = '1.00'
+            self.pp.auth_only()
+            
+            tools.assert_raises(pyauthorize.RateLimited, self.pp.process,
+                    0.01)
+            tools.eq_(gateway.stats['requests'], 0)
+
+
+class PyAuthorizeConcurrencyLimiterTest(unittest.TestCase):
+    """Tests pertaining to AdaptiveConcurrencyLimiter."""
+    
+    def setUp(self):
+        self.limiter = pyauthorize.AdaptiveConcurrencyLimiter(
+                initial_limit=4, max_limit=20, window=1000)
+    
+    def _answer(self, seconds, error=None):
+        """Let a request through and release it after seconds."""
+        
+        started = self.limiter.acquire()
+        self.limiter.release(started - seconds, error=error)
+    
+    def test_aimd(self):
+        """The limit grows on fast answers and is cut on failures."""
+        
+        for i in range(20):
+            self._answer(0.01)
+        tools.eq_(self.limiter.snapshot()['limit'], 7)
+        
+        self._answer(0.01, error=socket.timeout('timed out'))
+        tools.eq_(self.limiter.snapshot()['limit'], 5)
+        
+        # A decline is no sign of congestion.
+        self._answer(0.01, error=ValueError('Invalid card.'))
+        tools.eq_(self.limiter.snapshot()['limit'], 5)
+        
+        started = self.limiter.acquire()
+        time.sleep(0.05)
+        self.limiter.release(started)
+        snapshot = self.limiter.snapshot()
+        tools.eq_(snapshot['limit'], 3)
+        tools.eq_(snapshot['stats']['slow'], 1)
+        tools.eq_(snapshot['stats']['decreases'], 2)
+    
+    def test_one_cut_per_round_trip(self):
+        """Requests failing together cut the limit once."""
+        
+        started = [self.limiter.acquire() for i in range(4)]
+        for request_started in started:
+            self.limiter.release(request_started,
+                    error=socket.timeout('timed out'))
+        
+        tools.eq_(self.limiter.snapshot()['limit'], 2)
+        tools.eq_(self.limiter.stats['decreases'], 1)
+    
+    def test_queue(self):
+        """Requests beyond the limit wait, and give up after timeout."""
+        
+        self.limiter.limit = 1
+        started = self.limiter.acquire()
+        
+        tools.eq_(self.limiter.acquire(timeout=0.01), None)
+        tools.eq_(self.limiter.stats['rejected'], 1)
+        
+        waiter = threading.Thread(target=self.limiter.acquire)
+        waiter.start()
+        time.sleep(0.05)
+        tools.eq_(self.limiter.snapshot()['queued'], 1)
+        self.limiter.release(started)
+        waiter.join()
+        tools.eq_(self.limiter.snapshot()['in_flight'], 1)
+        
+        self.limiter.cancel()
+        tools.eq_(self.limiter.snapshot()['in_flight'], 0)
+        tools.eq_(self.limiter.stats['requests'], 1)
+    
+    def test_follows_gateway_latency(self):
+        """The limit grows while the gateway is fast, drops once it slows."""
+        
+        with pyauthorize_testing.FakeGateway() as gateway:
+            gateway.latency = pyauthorize_testing.step_latency((0, 0.005),
+                    (0.5, 0.05))
+            client = pyauthorize.Gateway('login', 'key')
+            client.post_url = gateway.url
+            client.concurrency_limiter = self.limiter
+            limits = []
+            
+            def transactions():
+                exp_date = datetime.date.today().strftime('%m%Y')
+                started = time.time()
+                while time.time() - started < 1:
+                    limits.append(self.limiter.snapshot()['limit'])
+                    yield pyauthorize.Transaction.auth_only(
+                            '4111111111111111', exp_date, '1.00')
+            
+            for transaction, response, error in pyauthorize.process_many(
+                    transactions(), max_concurrency=20, gateway=client):
+                tools.eq_(error, None)
+        
+        assert max(limits) > 4
+        assert self.limiter.stats['decreases'] > 0
+        assert limits[-1] < max(limits)
+
+
+class PyAuthorizeMerchantRegistryTest(unittest.TestCase):
+    """Tests pertaining to MerchantRegistry."""
+    
+    def setUp(self):
+        self.gateway = pyauthorize_testing.FakeGateway(logins={
+                'first': 'key1', 'second': 'key2', 'third': 'key3'})
+        self.gateway.start()
+        self.registry = pyauthorize.MerchantRegistry(max_size=2)
+        for x_login, x_tran_key in self.gateway.logins.items():
+            self.registry.register(x_login, x_tran_key,
+                    post_url=self.gateway.url)
+        self.transaction = pyauthorize.Transaction.auth_only(
+                '4111111111111111', datetime.date.today().strftime('%m%Y'),
+                '1.00')
+    
+    def tearDown(self):
+        self.registry.clear()
+        self.gateway.stop()
+    
+    def test_gateways_are_cached(self):
+        """Each merchant gets one gateway with its own connection pool."""
+        
+        first = self.registry.gateway('first')
+        tools.eq_(first.submit(self.transaction).is_approved, True)
+        tools.eq_(self.registry.gateway('first').submit(
+                self.transaction).is_approved, True)
+        second = self.registry.gateway('second')
+        
+        tools.assert_true(self.registry.gateway('first') is first)
+        tools.assert_true(first.transport is not second.transport)
+        tools.eq_(first.transport.stats['connections'], 1)
+        tools.eq_(first.transport.stats['hits'], 1)
+        tools.eq_(self.registry.stats['misses'], 2)
+        tools.assert_raises(KeyError, self.registry.gateway, 'unknown')
+    
+    def test_overrides(self):
+        """Configuration overrides and attributes apply to the gateway."""
+        
+        self.registry.register('first', 'key1', configuration={
+                'x_delim_char': ',', 'x_test_request': False},
+                timeout=5, post_url=self.gateway.url)
+        gateway = self.registry.gateway('first')
+        
+        tools.eq_(gateway.x_test_request, False)
+        tools.eq_(gateway.timeout, 5)
+        response = gateway.submit(self.transaction)
+        tools.eq_(response.delim_char, ',')
+        tools.eq_(response.is_approved, True)
+        
+        processor = self.registry.processor('first')
+        processor.amount = '1.00'
+        processor.card_num = '4111111111111111'
+        processor.exp_date = datetime.date.today().strftime('%m%Y')
+        processor.auth_only()
+        tools.eq_(processor.process(), True)
+        tools.eq_(processor.x_test_request, False)
+        tools.eq_(processor.timeout, 5)
+        tools.assert_true(processor.transport is gateway.transport)
+    
+    def test_processors_have_their_own_configuration(self):
+        """Configuring one processor leaves the gateway and others alone."""
+        
+        gateway = self.registry.gateway('first')
+        processor = self.registry.processor('first')
+        processor.configuration['x_duplicate_window'] = '0'
+        processor.observers.append(pyauthorize.MetricsAggregator())
+        
+        tools.eq_(processor.configuration['x_login'], 'first')
+        tools.assert_false('x_duplicate_window' in gateway.configuration)
+        tools.assert_false('x_duplicate_window' in
+                self.registry.processor('first').configuration)
+        tools.eq_(gateway.observers, [])
+    
+    def test_least_recently_used_are_dropped(self):
+        """Beyond max_size, the least recently used gateway is dropped."""
+        
+        first = self.registry.gateway('first')
+        first.submit(self.transaction)
+        self.registry.gateway('second')
+        self.registry.gateway('third')
+        
+        tools.eq_(len(self.registry), 2)
+        tools.eq_(self.registry.stats['evictions'], 1)
+        tools.eq_(first.transport._idle, {})
+        tools.assert_true(self.registry.gateway('first') is not first)
+        
+        # Gateways still in use don't keep connections in a closed pool.
+        tools.eq_(first.submit(self.transaction).is_approved, True)
+        tools.eq_(first.transport._idle, {})
+    
+    def test_shared_transports_stay_open(self):
+        """Dropping a gateway doesn't close a transport it was given."""
+        
+        pool = pyauthorize.ConnectionPool()
+        registry = pyauthorize.MerchantRegistry(max_size=1)
+        for x_login, x_tran_key in self.gateway.logins.items():
+            registry.register(x_login, x_tran_key, transport=pool,
+                    post_url=self.gateway.url)
+        
+        for x_login in self.gateway.logins:
+            tools.eq_(registry.gateway(x_login).submit(
+                    self.transaction).is_approved, True)
+        registry.clear()
+        
+        tools.eq_(registry.stats['evictions'], 2)
+        tools.eq_(pool._closed, False)
+        tools.eq_(pool.stats['connections'], 1)
+        pool.close()
+    
+    def test_hot_merchants(self):
+        """Hot merchants are warmed up and kept."""
+        
+        self.registry.register('first', 'key1', hot=True,
+                post_url=self.gateway.url)
+        self.registry.idle_timeout = 0
+        
+        tools.eq_(self.registry.warm(), self.registry.pool_size)
+        first = self.registry.gateway('first')
+        self.registry.gateway('second')
+        self.registry.gateway('third')
+        
+        tools.assert_true(self.registry.gateway('first') is first)
+        tools.eq_(first.submit(self.transaction).is_approved, True)
+        tools.eq_(first.transport.stats['hits'], 1)
+        tools.eq_(first.transport.stats['connections'],
+                self.registry.pool_size)
+
+
+class PyAuthorizeValidationTest(PyAuthorizeTest):
+    """Tests pertaining to validation_errors and screen_columns."""
+    
+    def test_exp_date_months(self):
+        """Only the months 01 to 12 are valid."""
+        
+        for exp_date in ('0012', '1312', '1a12', '1o2012', '01/1912'):
+            self.pp.exp_date = exp_date
+            tools.assert_raises(ValueError, self.pp._exp_date)
+        
+        self.pp.exp_date = '12/2030'
+        tools.eq_(self.pp._exp_date(), '12/2030')
+    
+    def test_digit_fields(self):
+        """Digit-only fields take the ASCII digits only."""
+        
+        for card_num in (u'4111111111111111', 4111111111111111):
+            self.pp.card_num = card_num
+            tools.eq_(self.pp._card_num(), '4111111111111111')
+        
+        for card_num in (u'\u0664111111111111111', '411111111111111\n',
+                         '4111-1111-1111-1111'):
+            self.pp.card_num = card_num
+            tools.assert_raises(ValueError, self.pp._card_num)
+    
+    def test_validation_errors(self):
+        """Every invalid field is reported at once."""
+        
+        self.pp.card_num = '42'
+        self.pp.exp_date = None
+        self.pp.amount = '12 dollars'
+        self.pp.zip = '123'
+        self.pp.is_ccv_required = True
+        
+        tools.eq_(self.pp.validation_errors('AUTH_CAPTURE'), {
+                'card_num': 'Invalid card_num format. 42',
+                'exp_date': 'exp_date is required.',
+                'amount': 'Invalid amount format. 12 dollars',
+                'zip': 'Invalid zip format. 123',
+                'card_code': 'card_code is required.',
+        })
+        tools.eq_(pyauthorize.validation_errors('CREDIT',
+                transaction='2149186775', card_num='1111', amount='1.00'), {})
+        tools.assert_raises(ValueError, pyauthorize.validation_errors,
+                'REFUND')
+    
+    def test_screen_columns(self):
+        """Invalid records of a column-oriented batch are found."""
+        
+        columns = {
+                'transaction': ['2149186775', 'x', '2149186777'],
+                'card_num': ['1111', '1111', '4111111111111111111'],
+                'amount': ['1.00', '2.00', ''],
+        }
+        
+        tools.eq_(pyauthorize.screen_columns('CREDIT', columns), {
+                1: {'transaction': 'Invalid transaction format. x'},
+                2: {'card_num': 'Invalid card_num format. 4111111111111111111',
+                    'amount': 'amount is required'},
+        })
+        tools.eq_(pyauthorize.screen_columns('VOID', {'card_num': ['1']}),
+                {0: {'transaction': 'transaction is required.'}})
+    
+    def test_screen_numpy_columns(self):
+        """NumPy columns give the same results as lists."""
+        
+        try:
+            import numpy
+        except ImportError:
+            raise unittest.SkipTest('NumPy is not installed.')
+        
+        columns = {
+                'card_num': ['4111111111111111', '42', '',
+                             u'\u0664111111111111111'],
+                'exp_date': ['1230', '1230', '1230', '1330'],
+                'amount': ['1.00', '1.00', '1.00', '1.00'],
+                'zip': ['60654', '606540000', '6065', ''],
+        }
+        expected = pyauthorize.screen_columns('AUTH_ONLY', columns)
+        
+        for dtype in ('U', 'S'):
+            if dtype == 'S':
+                columns['card_num'][3] = '4111111111111111'
+                expected[3].pop('card_num')
+            arrays = dict((name, numpy.array(column, dtype=dtype))
+                          for name, column in columns.items())
+            tools.eq_(pyauthorize.screen_columns('AUTH_ONLY', arrays),
+                    expected)
+        tools.eq_(sorted(expected), [1, 2, 3])
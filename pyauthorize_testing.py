@@ -0,0 +1,644 @@
+#!/usr/bin/env python
+#Copyright (C) 2010 Analyte Media
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+#conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Local stand-in for the Authorize.net AIM gateway.
+
+FakeGateway speaks the transact.dll POST protocol well enough to test and
+load-test code that uses PyAuthorize without a network:
+>>> gateway = FakeGateway(latency=uniform_latency(0.05, 0.2))
+>>> gateway.start()
+>>> p = pyauthorize.PaymentProcessor('login', 'key')
+>>> p.post_url = gateway.url
+...
+>>> gateway.settle()
+>>> gateway.stop()
+"""
+
+__author__ = 'jordan.bouvier@analytemedia.com (Jordan Bouvier)'
+
+import BaseHTTPServer
+import SocketServer
+import csv
+import datetime
+import itertools
+import math
+import random
+import socket
+import sys
+import threading
+import time
+import urlparse
+
+
+
+# Card numbers the fake gateway always declines.
+DECLINED_CARD_NUMS = frozenset(['4222222222222'])
+
+# Reason texts of the responses the fake gateway gives.
+REASON_TEXTS = {
+        1: 'This transaction has been approved.',
+        2: 'This transaction has been declined.',
+        5: 'A valid amount is required.',
+        6: 'The credit card number is invalid.',
+        7: 'The credit card expiration date is invalid.',
+        8: 'The credit card has expired.',
+        11: 'A duplicate transaction has been submitted.',
+        13: 'The merchant login ID or password is invalid or the account '
+            'is inactive.',
+        16: 'The transaction cannot be found.',
+        19: 'An error occurred during processing. Please try again in 5 '
+            'minutes.',
+        33: 'A valid referenced transaction ID is required.',
+        47: 'The amount requested for settlement may not be greater than the '
+            'original amount authorized.',
+        54: 'The referenced transaction does not meet the criteria for '
+            'issuing a credit.',
+        55: 'The sum of credits against the referenced transaction would '
+            'exceed the original debit amount.',
+        310: 'This transaction has already been voided.',
+        311: 'This transaction has already been captured.',
+}
+
+# Columns of the settlement files written by FakeGateway.write_settlement.
+SETTLEMENT_COLUMNS = ('Transaction ID', 'Transaction Status',
+                      'Settlement Amount', 'Invoice Number',
+                      'Transaction Type')
+
+# Settlement statuses of the fake transactions, by their status.
+SETTLEMENT_STATUSES = {
+        'settled' : 'Settled Successfully',
+        'credited' : 'Refund Settled Successfully',
+        'voided' : 'Voided',
+}
+
+# Settlement names of the transaction types.
+SETTLEMENT_TYPES = {
+        'AUTH_CAPTURE' : 'Authorization w/ Auto Capture',
+        'AUTH_ONLY' : 'Authorization Only',
+        'PRIOR_AUTH_CAPTURE' : 'Prior Authorization Capture',
+        'CREDIT' : 'Credit',
+}
+
+CARD_TYPES = (('4', 'Visa'), ('5', 'MasterCard'), ('34', 'American Express'),
+              ('37', 'American Express'), ('6', 'Discover'),
+              ('35', 'JCB'), ('30', 'Diners Club'), ('36', 'Diners Club'),
+              ('38', 'Diners Club'))
+
+
+def constant_latency(seconds):
+    """Latency distribution always returning seconds."""
+    
+    return lambda: seconds
+
+
+def uniform_latency(low, high):
+    """Latency distribution uniform between low and high seconds."""
+    
+    return lambda: random.uniform(low, high)
+
+
+def lognormal_latency(median, sigma=0.5):
+    """Log-normal latency distribution with the given median in seconds.
+    
+    This has the long tail of real gateway round trips.
+    """
+    
+    mu = math.log(median)
+    return lambda: random.lognormvariate(mu, sigma)
+
+
+def step_latency(*steps):
+    """Latency distribution changing over time.
+    
+    Each step is a (start, latency) pair: from start seconds after the
+    first request on, latency, itself seconds or a distribution, is used:
+    >>> gateway.latency = step_latency((0, 0.01), (5, uniform_latency(0.2,
+    ...         0.4)))
+    """
+    
+    steps = sorted(steps, key=lambda step: step[0])
+    started = []
+    
+    def latency():
+        now = time.time()
+        if not started:
+            started.append(now)
+        elapsed = now - started[0]
+        current = steps[0][1]
+        for start, value in steps:
+            if elapsed >= start:
+                current = value
+        if callable(current):
+            return current()
+        return current
+    
+    return latency
+
+
+class FakeGateway(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local fake of the AIM gateway, running on a background thread.
+    
+    AUTH_ONLY, AUTH_CAPTURE, PRIOR_AUTH_CAPTURE, VOID and CREDIT requests
+    are answered with realistic delimited responses, and the transactions
+    are remembered: authorizations can be captured once, unsettled
+    transactions voided, and settled ones credited up to their amount.
+    Call settle() to settle every captured transaction, as the nightly
+    batch would.
+    
+    Cards in DECLINED_CARD_NUMS are declined, as are expired cards and
+    invalid amounts. If logins is given, requests must use one of its
+    x_login / x_tran_key pairs.
+    
+    A charge or credit posted with x_duplicate_window is rejected with
+    reason code 11 if it repeats the type, card, amount, invoice number and
+    customer id of one approved less than that many seconds earlier. As on
+    the real gateway, the rejection carries the original transaction id
+    and approval code. Unlike the real gateway, transactions posted
+    without x_duplicate_window are never rejected as duplicates, so load
+    tests can repeat the same charge.
+    
+    Failures can be injected with:
+        latency: Seconds to wait before answering, or a callable returning
+            them such as uniform_latency(0.05, 0.2) or step_latency().
+        error_rate: Fraction of requests answered with a processing error
+            (response code 3, reason code 19).
+        http_error_rate: Fraction of requests answered with an HTTP 500.
+        lost_response_rate: Fraction of requests that are processed but
+            whose connection is closed without an answer, like a response
+            lost on its way back.
+        max_requests_per_second: Requests above this rate are throttled
+            with an HTTP 503.
+    
+    They are plain attributes and may be changed while the gateway runs.
+    The stats dictionary counts requests, transaction types, errors and
+    throttled requests.
+    """
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, host='127.0.0.1', port=0, latency=None, error_rate=0,
+                 http_error_rate=0, lost_response_rate=0,
+                 max_requests_per_second=None, logins=None, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                _FakeGatewayHandler)
+        self.url = 'http://%s:%s/gateway/transact.dll' % (
+                self.server_address[0], self.server_address[1])
+        self.latency = latency
+        self.error_rate = error_rate
+        self.http_error_rate = http_error_rate
+        self.lost_response_rate = lost_response_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.logins = logins
+        self.random = random.Random(seed)
+        self.transactions = {}
+        self.stats = {
+                'requests' : 0,
+                'errors' : 0,
+                'http_errors' : 0,
+                'throttled' : 0,
+                'lost_responses' : 0,
+        }
+        
+        self._trans_ids = itertools.count(2149186775)
+        self._recent = {}
+        self._tokens = 0
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._connections = {}
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.stop()
+    
+    def start(self):
+        """Start serving requests on a background thread."""
+        
+        self._thread = threading.Thread(target=self.serve_forever,
+                kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop(self):
+        """Stop serving requests and wait for the threads serving them."""
+        
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+        
+        # Hang up on clients keeping connections alive, so that no thread
+        # is left serving them at interpreter shutdown.
+        self._lock.acquire()
+        try:
+            connections = self._connections.items()
+        finally:
+            self._lock.release()
+        for connection, thread in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+    
+    def process_request_thread(self, request, client_address):
+        self._lock.acquire()
+        try:
+            self._connections[request] = threading.current_thread()
+        finally:
+            self._lock.release()
+        
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request,
+                    client_address)
+        finally:
+            self._lock.acquire()
+            try:
+                self._connections.pop(request, None)
+            finally:
+                self._lock.release()
+    
+    def handle_error(self, request, client_address):
+        """Ignore clients that hung up, e.g. after timing out."""
+        
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                    client_address)
+    
+    def settle(self):
+        """Settle every captured transaction."""
+        
+        self._lock.acquire()
+        try:
+            for transaction in self.transactions.values():
+                if transaction['status'] == 'captured':
+                    transaction['status'] = 'settled'
+        finally:
+            self._lock.release()
+    
+    def write_settlement(self, path):
+        """Write the settled, refunded and voided transactions as a CSV.
+        
+        The file has the columns of the gateway's transaction detail
+        download that pyauthorize_reconcile reads.
+        """
+        
+        self._lock.acquire()
+        try:
+            transactions = [transaction for trans_id, transaction
+                            in sorted(self.transactions.items())]
+        finally:
+            self._lock.release()
+        
+        settlement = open(path, 'wb')
+        try:
+            writer = csv.writer(settlement)
+            writer.writerow(SETTLEMENT_COLUMNS)
+            for transaction in transactions:
+                status = SETTLEMENT_STATUSES.get(transaction['status'])
+                if status is not None:
+                    writer.writerow([transaction['trans_id'], status,
+                            '%.2f' % transaction['amount'],
+                            transaction['invoice_number'],
+                            SETTLEMENT_TYPES[transaction['type']]])
+        finally:
+            settlement.close()
+    
+    def handle_transaction(self, fields):
+        """Process a posted transaction.
+        
+        Args:
+            fields: Dictionary of the posted fields.
+        
+        Returns:
+            A (status, body) tuple with the HTTP status and response body,
+            or None if the response is to be lost.
+        """
+        
+        self._lock.acquire()
+        try:
+            self.stats['requests'] += 1
+            if self._is_throttled():
+                self.stats['throttled'] += 1
+                return (503, 'Too many requests.')
+            if self.random.random() < self.http_error_rate:
+                self.stats['http_errors'] += 1
+                return (500, 'Internal server error.')
+            
+            transaction_type = fields.get('x_type', 'AUTH_CAPTURE').upper()
+            self.stats[transaction_type] = (
+                    self.stats.get(transaction_type, 0) + 1)
+            
+            if self.random.random() < self.error_rate:
+                self.stats['errors'] += 1
+                result = _Result(3, 19)
+            elif self.logins is not None and (self.logins.get(
+                    fields.get('x_login')) != fields.get('x_tran_key')):
+                result = _Result(3, 13)
+            elif transaction_type in ('AUTH_ONLY', 'AUTH_CAPTURE'):
+                result = self._authorize(transaction_type, fields)
+            elif transaction_type == 'PRIOR_AUTH_CAPTURE':
+                result = self._prior_auth_capture(fields)
+            elif transaction_type == 'VOID':
+                result = self._void(fields)
+            elif transaction_type == 'CREDIT':
+                result = self._credit(fields)
+            else:
+                result = _Result(3, 33)
+            
+            if self.random.random() < self.lost_response_rate:
+                self.stats['lost_responses'] += 1
+                return None
+        finally:
+            self._lock.release()
+        
+        return (200, result.encode(transaction_type, fields))
+    
+    def _is_throttled(self):
+        """Take a token from the rate limit bucket if there is one."""
+        
+        if not self.max_requests_per_second:
+            return False
+        
+        now = time.time()
+        self._tokens = min(self.max_requests_per_second, self._tokens
+                + (now - self._last_refill) * self.max_requests_per_second)
+        self._last_refill = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+    
+    def _authorize(self, transaction_type, fields):
+        """AUTH_ONLY or AUTH_CAPTURE."""
+        
+        card_num = fields.get('x_card_num', '')
+        amount = _amount(fields.get('x_amount'))
+        if amount is None:
+            return _Result(3, 5)
+        elif not card_num.isdigit() or not 13 <= len(card_num) <= 16:
+            return _Result(3, 6)
+        
+        expires = _expiration(fields.get('x_exp_date', ''))
+        if expires is None:
+            return _Result(3, 7)
+        elif expires < datetime.date.today().replace(day=1):
+            return _Result(3, 8)
+        elif card_num in DECLINED_CARD_NUMS:
+            return _Result(2, 2, card_num=card_num, amount=amount)
+        
+        if transaction_type == 'AUTH_ONLY':
+            status = 'authorized'
+        else:
+            status = 'captured'
+        return self._record_once(transaction_type, fields, status, card_num,
+                amount)
+    
+    def _prior_auth_capture(self, fields):
+        """PRIOR_AUTH_CAPTURE of an AUTH_ONLY."""
+        
+        transaction = self.transactions.get(fields.get('x_trans_id'))
+        if transaction is None:
+            return _Result(3, 16)
+        elif transaction['status'] == 'voided':
+            return _Result(3, 310)
+        elif transaction['status'] != 'authorized':
+            return _Result(3, 311)
+        
+        amount = transaction['amount']
+        if fields.get('x_amount'):
+            amount = _amount(fields['x_amount'])
+            if amount is None:
+                return _Result(3, 5)
+            elif amount > transaction['amount']:
+                return _Result(3, 47)
+        
+        transaction['status'] = 'captured'
+        transaction['type'] = 'PRIOR_AUTH_CAPTURE'
+        transaction['amount'] = amount
+        return _Result(1, 1, transaction['trans_id'],
+                transaction['approval_code'], transaction['card_num'], amount)
+    
+    def _void(self, fields):
+        """VOID of an unsettled transaction."""
+        
+        transaction = self.transactions.get(fields.get('x_trans_id'))
+        if transaction is None or transaction['status'] == 'settled':
+            return _Result(3, 16)
+        elif transaction['status'] == 'voided':
+            return _Result(3, 310)
+        
+        transaction['status'] = 'voided'
+        return _Result(1, 1, transaction['trans_id'],
+                transaction['approval_code'], transaction['card_num'],
+                transaction['amount'])
+    
+    def _credit(self, fields):
+        """CREDIT against a settled transaction."""
+        
+        transaction = self.transactions.get(fields.get('x_trans_id'))
+        amount = _amount(fields.get('x_amount'))
+        if transaction is None:
+            return _Result(3, 16)
+        elif amount is None:
+            return _Result(3, 5)
+        elif (transaction['status'] != 'settled' or
+                transaction['card_num'][-4:] !=
+                fields.get('x_card_num', '')[-4:]):
+            return _Result(3, 54)
+        elif transaction['credited'] + amount > transaction['amount']:
+            return _Result(3, 55)
+        
+        result = self._record_once('CREDIT', fields, 'credited',
+                transaction['card_num'], amount)
+        if result.response_code == 1:
+            transaction['credited'] += amount
+        return result
+    
+    def _record_once(self, transaction_type, fields, status, card_num,
+                     amount):
+        """_record() unless this is a duplicate of a recent transaction."""
+        
+        invoice_number = fields.get('x_invoice_num', '')
+        window = fields.get('x_duplicate_window')
+        if window is None:
+            return self._record(transaction_type, status, card_num, amount,
+                    invoice_number)
+        
+        now = time.time()
+        key = (transaction_type, card_num, amount, invoice_number,
+               fields.get('x_customer_id', ''))
+        recent = self._recent.get(key)
+        if recent is not None and now - recent[0] < int(window):
+            original = self.transactions[recent[1]]
+            return _Result(3, 11, original['trans_id'],
+                    original['approval_code'], card_num, amount)
+        
+        result = self._record(transaction_type, status, card_num, amount,
+                invoice_number)
+        self._recent[key] = (now, result.trans_id)
+        return result
+    
+    def _record(self, transaction_type, status, card_num, amount,
+                invoice_number):
+        """Remember a new approved transaction and return its result."""
+        
+        trans_id = str(self._trans_ids.next())
+        approval_code = '%06X' % self.random.randint(0, 0xFFFFFF)
+        self.transactions[trans_id] = {
+                'trans_id' : trans_id,
+                'type' : transaction_type,
+                'invoice_number' : invoice_number,
+                'status' : status,
+                'card_num' : card_num,
+                'amount' : amount,
+                'credited' : 0,
+                'approval_code' : approval_code,
+        }
+        return _Result(1, 1, trans_id, approval_code, card_num, amount)
+
+
+class _Result(object):
+    """Outcome of a fake transaction, to be encoded as an AIM response."""
+    
+    def __init__(self, response_code, reason_code, trans_id='0',
+                 approval_code='', card_num='', amount=None):
+        self.response_code = response_code
+        self.reason_code = reason_code
+        self.trans_id = trans_id
+        self.approval_code = approval_code
+        self.card_num = card_num
+        self.amount = amount
+    
+    def encode(self, transaction_type, fields):
+        """Return the delimited response for the posted fields."""
+        
+        response = [''] * 55
+        response[0] = str(self.response_code)
+        response[1] = '1'
+        response[2] = str(self.reason_code)
+        response[3] = REASON_TEXTS[self.reason_code]
+        response[4] = self.approval_code
+        response[6] = self.trans_id
+        response[7] = fields.get('x_invoice_num', '')
+        response[8] = fields.get('x_description', '')
+        response[10] = 'CC'
+        response[11] = transaction_type.lower()
+        response[12] = fields.get('x_customer_id', '')
+        response[13] = fields.get('x_first_name', '')
+        response[14] = fields.get('x_last_name', '')
+        response[16] = fields.get('x_address', '')
+        response[19] = fields.get('x_zip', '')
+        if self.amount is not None:
+            response[9] = '%.2f' % self.amount
+        
+        if self.response_code == 1 and transaction_type in (
+                'AUTH_ONLY', 'AUTH_CAPTURE'):
+            if fields.get('x_address') or fields.get('x_zip'):
+                response[5] = 'Y'
+            else:
+                response[5] = 'P'
+            if fields.get('x_card_code'):
+                response[38] = 'M'
+        
+        if self.card_num:
+            response[50] = 'XXXX%s' % self.card_num[-4:]
+            for prefix, card_type in CARD_TYPES:
+                if self.card_num.startswith(prefix):
+                    response[51] = card_type
+                    break
+        
+        encap_char = fields.get('x_encap_char', '')
+        if encap_char:
+            response = ['%s%s%s' % (encap_char, value, encap_char)
+                        for value in response]
+        return fields.get('x_delim_char', ',').join(response)
+
+
+class _FakeGatewayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler for FakeGateway."""
+    
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write rather than a write per header line,
+    # which would stall on delayed ACKs.
+    wbufsize = -1
+    
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        fields = dict(urlparse.parse_qsl(self.rfile.read(length)))
+        
+        latency = self.server.latency
+        if callable(latency):
+            latency = latency()
+        if latency:
+            time.sleep(latency)
+        
+        answer = self.server.handle_transaction(fields)
+        if answer is None:
+            self.close_connection = 1
+            return
+        
+        status, body = answer
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+def _amount(amount):
+    """Return amount as a positive float, or None if it isn't one."""
+    
+    try:
+        amount = float(amount)
+    except (TypeError, ValueError):
+        return None
+    if amount <= 0:
+        return None
+    return amount
+
+
+def _expiration(exp_date):
+    """Return the first day of the month exp_date ends, or None."""
+    
+    digits = exp_date.replace('/', '').replace('-', '')
+    if not digits.isdigit() or len(digits) not in (4, 6):
+        return None
+    
+    month = int(digits[:2])
+    year = int(digits[2:])
+    if len(digits) == 4:
+        year += 2000
+    if not 1 <= month <= 12:
+        return None
+    return datetime.date(year, month, 1)
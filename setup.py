@@ -47,5 +47,7 @@ setup(
             'Topic :: Office/Business :: Financial',
             'Topic :: Office/Business :: Financial :: Point-Of-Sale',
     ],
-    py_modules=['pyauthorize', 'pyauthorize_test']
+    py_modules=['pyauthorize', 'pyauthorize_batch', 'pyauthorize_bench',
+                'pyauthorize_reconcile', 'pyauthorize_test',
+                'pyauthorize_testing']
 )
\ No newline at end of file